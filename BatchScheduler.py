@@ -0,0 +1,412 @@
+import time
+import queue
+import logging
+import threading
+
+import torch
+from transformers import DynamicCache
+
+from PrefixCache import PrefixCache
+from GenerationControl import stop_reason
+from InferenceProfile import use_threads
+from Metrics import Counter, Histogram
+from SpeculativeDecoding import NgramDrafter
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+PROMPT_TOKENS = Histogram('qwen_prompt_tokens', '每个生成请求的提示词token数（含对话历史与知识库内容）',
+                          buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768))
+QUEUE_WAIT = Histogram('qwen_queue_wait_seconds', '生成请求在调度器中排队等待的时间')
+PREFILL_SECONDS = Histogram('qwen_prefill_seconds', '开始预填充到输出第一个token的时间')
+DECODE_RATE = Histogram('qwen_decode_tokens_per_second', '第一个token之后的解码速度（批次内每个请求单独计算）',
+                        buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 500))
+GENERATED_TOKENS = Histogram('qwen_generated_tokens', '每个生成请求输出的token数',
+                             buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 32768))
+GENERATIONS = Counter('qwen_generations_total', '已结束的生成请求数，按结束原因统计', labelnames=('reason',))
+DRAFT_TOKENS = Counter('qwen_speculative_draft_tokens_total', '投机解码提出的候选token数')
+ACCEPTED_TOKENS = Counter('qwen_speculative_accepted_tokens_total', '投机解码中通过验证的候选token数')
+
+
+class SchedulerBusyError(RuntimeError):
+    """等待队列已满，拒绝新的生成请求"""
+
+
+class GenerationRequest:
+    """一个生成请求：提示词token、停止条件、流式输出对象以及在批次中的解码状态"""
+
+    def __init__(self, input_ids, streamer, max_new_tokens, eos_token_ids, on_finish=None, cancel_token=None,
+                 deadline=None, cache_tokens=None):
+        self.input_ids = input_ids
+        self.streamer = streamer  # 与transformers的streamer接口一致：put(token_tensor) / end()
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = eos_token_ids
+        self.on_finish = on_finish
+        self.cancel_token = cancel_token
+        self.deadline = deadline  # time.monotonic() 的截止时间，None表示不限时
+        # 提示词中可供后续请求复用的前缀长度；等于整个提示词时生成的内容也可复用
+        self.cache_tokens = len(input_ids) if cache_tokens is None else min(cache_tokens, len(input_ids))
+        self.generated = []
+        self.next_position = len(input_ids)
+        self.error = None
+        self.stop_reason = None  # eos / length / cancelled / deadline / error
+        self.done = threading.Event()
+        # time.perf_counter() 时间点：提交、开始预填充、输出第一个token、结束
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self.drafter = None  # 启用投机解码时的候选token查找索引
+
+    @property
+    def last_token(self):
+        return self.generated[-1]
+
+    def is_finished(self):
+        if self.last_token in self.eos_token_ids:
+            self.stop_reason = 'eos'
+        elif len(self.generated) >= self.max_new_tokens:
+            self.stop_reason = 'length'
+        return self.stop_reason is not None
+
+    def abort_reason(self):
+        return stop_reason(self.cancel_token, self.deadline)
+
+
+class ContinuousBatchScheduler:
+    """连续批处理调度器：多个请求共享一个解码循环，每一步对所有进行中的请求做一次批量前向计算
+
+    新请求单独预填充（prefill）后并入批次，KV缓存左侧补齐到相同长度，
+    通过attention_mask屏蔽补齐位置、position_ids保持各自的真实位置。
+    只有请求加入或结束时才重组批量KV缓存，普通解码步直接在批量缓存上追加。
+    prefix_cache 不为None时，预填充前先查找已缓存的最长提示词前缀，只计算剩余部分；
+    预填充后缓存提示词的前 cache_tokens 个token的KV，整个提示词都可复用时，请求正常结束后再缓存提示词加生成内容的KV。
+    num_threads 是解码线程的算子内并行线程数，None表示使用torch的默认设置。
+    speculative_tokens 大于0时启用提示词查找投机解码（使用贪心解码）：批次中只有一个请求时，
+    每步用n-gram匹配提出最多 speculative_tokens 个候选token，在一次前向计算中验证，输出与逐个贪心解码相同。
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=4, max_waiting=32, prefix_cache=None, num_threads=None,
+                 speculative_tokens=0):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_waiting = max_waiting
+        self.prefix_cache = prefix_cache
+        self.num_threads = num_threads
+
+        generation_config = model.generation_config
+        eos_token_id = generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        self.eos_token_ids = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id])
+        self.do_sample = bool(generation_config.do_sample)
+        self.temperature = generation_config.temperature or 1.0
+        self.top_k = generation_config.top_k or 0
+        self.top_p = generation_config.top_p or 1.0
+        self.speculative_tokens = speculative_tokens
+        if speculative_tokens > 0 and self.do_sample:
+            logger.info("已启用投机解码，改为贪心解码")
+            self.do_sample = False
+        self._draft_tokens = 0
+        self._accepted_tokens = 0
+        self._speculative_steps = 0
+
+        self._waiting = queue.Queue(maxsize=max_waiting)
+        self._active = []          # 批次中的请求，顺序与KV缓存的batch维度一致
+        self._cache = None         # 批量KV缓存（DynamicCache），每层形状为 (batch, heads, 长度, head_dim)
+        self._attention_mask = None
+
+        self._thread = threading.Thread(target=self._loop, name="qwen-batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, input_ids, streamer, max_new_tokens=32768, on_finish=None, cancel_token=None, deadline=None,
+               cache_tokens=None):
+        """提交生成请求，等待队列已满时抛出 SchedulerBusyError
+
+        cancel_token 被取消或到达 deadline 后，请求在下一个解码步之前移出批次。
+        cache_tokens 是提示词中以后的请求可能复用的前缀长度（例如对话历史部分），None表示整个提示词。
+        """
+        request = GenerationRequest(list(input_ids), streamer, max_new_tokens, self.eos_token_ids, on_finish,
+                                    cancel_token=cancel_token, deadline=deadline, cache_tokens=cache_tokens)
+        try:
+            self._waiting.put_nowait(request)
+        except queue.Full:
+            raise SchedulerBusyError(f"生成请求过多，等待队列已满（{self.max_waiting}）")
+        return request
+
+    def stats(self):
+        """当前队列深度、准入上限以及前缀缓存命中率"""
+        stats = {
+            'waiting': self._waiting.qsize(),
+            'active': len(self._active),
+            'max_batch_size': self.max_batch_size,
+            'max_waiting': self.max_waiting
+        }
+        if self.prefix_cache is not None:
+            stats['prefix_cache'] = self.prefix_cache.stats()
+        if self.speculative_tokens > 0:
+            stats['speculative'] = {
+                'steps': self._speculative_steps,
+                'draft_tokens': self._draft_tokens,
+                'accepted_tokens': self._accepted_tokens,
+                'acceptance_rate': self._accepted_tokens / self._draft_tokens if self._draft_tokens else 0.0
+            }
+        return stats
+
+    def _loop(self):
+        use_threads(self.num_threads)
+        while True:
+            try:
+                with torch.no_grad():
+                    self._admit()
+                    self._abort_stopped()
+                    if self._active:
+                        self._decode_step()
+            except Exception as e:
+                logger.exception(f"批量解码出错: {str(e)}")
+                self._fail_all(e)
+
+    def _admit(self):
+        """批次未满时接纳新请求；批次为空时阻塞等待"""
+        while len(self._active) < self.max_batch_size:
+            try:
+                request = self._waiting.get(block=not self._active)
+            except queue.Empty:
+                return
+            # 排队期间已被取消或超时的请求不再预填充
+            reason = request.abort_reason()
+            if reason is not None:
+                request.stop_reason = reason
+                self._finish(request)
+                continue
+            request.started_at = time.perf_counter()
+            try:
+                self._prefill(request)
+            except Exception as e:
+                logger.exception(f"预填充出错: {str(e)}")
+                self._finish(request, error=e)
+
+    def _abort_stopped(self):
+        """把已取消或超时的请求移出批次，释放其KV缓存"""
+        for request in list(self._active):
+            reason = request.abort_reason()
+            if reason is not None:
+                logger.info(f"请求提前结束（{reason}），已生成 {len(request.generated)} 个token")
+                request.stop_reason = reason
+                self._remove(request)
+                self._finish(request)
+
+    def _prefill(self, request):
+        prompt = request.input_ids
+        reused, prefix_layers = 0, None
+        if self.prefix_cache is not None:
+            reused, prefix_layers = self.prefix_cache.lookup(prompt)
+        input_ids = torch.tensor([prompt[reused:]], dtype=torch.long)
+        if reused:
+            # 复用缓存的前缀KV，位置从前缀长度开始继续计算
+            outputs = self.model(input_ids=input_ids, past_key_values=_build_cache(prefix_layers), use_cache=True)
+        else:
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+        layers = _cache_layers(outputs.past_key_values)
+        if self.prefix_cache is not None and request.cache_tokens > 0:
+            length = request.cache_tokens
+            # 只缓存可复用的部分；截取时复制，释放其余部分（例如本轮的知识库内容）的内存
+            self.prefix_cache.put(prompt[:length], layers if length == len(prompt) else
+                                  [[tensor[:, :, :length].clone() for tensor in kv] for kv in layers])
+        token = self._sample(outputs.logits[:, -1, :])[0]
+        mask = torch.ones((1, len(prompt)), dtype=torch.long)
+        if self.speculative_tokens > 0:
+            request.drafter = NgramDrafter(prompt)
+
+        if self._cache is None:
+            self._cache, self._attention_mask = outputs.past_key_values, mask
+        else:
+            # 左侧补齐到相同长度后在batch维度拼接
+            length = max(self._attention_mask.shape[1], mask.shape[1])
+            self._cache = _build_cache([
+                [torch.cat([_left_pad(old, length), _left_pad(new, length)]) for old, new in zip(old_kv, new_kv)]
+                for old_kv, new_kv in zip(_cache_layers(self._cache), layers)
+            ])
+            self._attention_mask = torch.cat([_left_pad(self._attention_mask, length), _left_pad(mask, length)])
+        self._active.append(request)
+        logger.info(f"请求加入批次，提示词长度: {len(prompt)}，复用前缀: {reused}，当前批次大小: {len(self._active)}")
+        self._emit(request, token)
+
+    def _decode_step(self):
+        if self.speculative_tokens > 0 and len(self._active) == 1:
+            request = self._active[0]
+            # 最后一个token之后至少还要输出一个验证得到的token，候选数不超过剩余的生成额度
+            remaining = request.max_new_tokens - len(request.generated) - 1
+            draft = request.drafter.draft(min(self.speculative_tokens, remaining))
+            if draft:
+                self._speculative_step(request, draft)
+                return
+
+        input_ids = torch.tensor([[request.last_token] for request in self._active], dtype=torch.long)
+        position_ids = torch.tensor([[request.next_position] for request in self._active], dtype=torch.long)
+        self._attention_mask = torch.cat(
+            [self._attention_mask, torch.ones((len(self._active), 1), dtype=torch.long)], dim=1)
+
+        # 直接在批量缓存上追加，避免每一步重新构建缓存对象
+        outputs = self.model(input_ids=input_ids, attention_mask=self._attention_mask, position_ids=position_ids,
+                             past_key_values=self._cache, use_cache=True)
+        self._cache = outputs.past_key_values
+        tokens = self._sample(outputs.logits[:, -1, :])
+
+        for request, token in zip(list(self._active), tokens):
+            request.next_position += 1
+            self._emit(request, token)
+
+    def _speculative_step(self, request, draft):
+        """把最后一个token和候选token一起前向计算，接受与贪心结果一致的最长前缀，再加上模型给出的下一个token
+
+        只在批次中只有一个请求时使用，未被接受的候选位置从KV缓存末尾裁掉。
+        """
+        length = self._attention_mask.shape[1]
+        input_ids = torch.tensor([[request.last_token] + draft], dtype=torch.long)
+        position_ids = torch.arange(request.next_position, request.next_position + len(draft) + 1).unsqueeze(0)
+        attention_mask = torch.cat([self._attention_mask, torch.ones((1, len(draft) + 1), dtype=torch.long)], dim=1)
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                             past_key_values=self._cache, use_cache=True)
+        predicted = outputs.logits[0].argmax(dim=-1).tolist()
+
+        accepted = 0
+        while accepted < len(draft) and draft[accepted] == predicted[accepted]:
+            accepted += 1
+        self._speculative_steps += 1
+        self._draft_tokens += len(draft)
+        self._accepted_tokens += accepted
+        DRAFT_TOKENS.inc(len(draft))
+        ACCEPTED_TOKENS.inc(accepted)
+
+        # 保留最后一个token和已接受候选的KV，裁掉未被接受的候选
+        self._cache = outputs.past_key_values
+        if accepted < len(draft):
+            self._cache.crop(accepted - len(draft))
+        self._attention_mask = attention_mask[:, :length + 1 + accepted]
+        for token in draft[:accepted] + [predicted[accepted]]:
+            request.next_position += 1
+            self._emit(request, token)
+            if request.done.is_set():
+                break
+
+    def _emit(self, request, token):
+        """输出一个新token，满足停止条件时把请求移出批次"""
+        request.generated.append(token)
+        if request.drafter is not None:
+            request.drafter.extend([token])
+        if request.first_token_at is None:
+            request.first_token_at = time.perf_counter()
+        if token not in request.eos_token_ids:
+            request.streamer.put(torch.tensor([token]))
+        if request.is_finished():
+            self._cache_generated(request)
+            self._remove(request)
+            self._finish(request)
+
+    def _cache_generated(self, request):
+        """整个提示词都可复用时，把提示词加生成内容的KV放入前缀缓存，下一轮对话的历史部分可以直接复用
+
+        最后一个输出的token还没有计算KV，不包含在内。
+        """
+        if self.prefix_cache is None or request.cache_tokens < len(request.input_ids):
+            return
+        tokens = request.input_ids + request.generated[:-1]
+        row = self._active.index(request)
+        # 批次中各行右对齐，该行的有效KV从左侧补齐之后开始
+        start = self._attention_mask.shape[1] - int(self._attention_mask[row].sum())
+        self.prefix_cache.put(tokens, [[tensor[row:row + 1, :, start:start + len(tokens)].clone() for tensor in kv]
+                                       for kv in _cache_layers(self._cache)])
+
+    def _remove(self, request):
+        """从批量KV缓存中删除该请求所在的行，并裁掉所有行共有的左侧补齐"""
+        row = self._active.index(request)
+        del self._active[row]
+        if not self._active:
+            self._cache = self._attention_mask = None
+            return
+        keep = torch.tensor([i for i in range(len(self._active) + 1) if i != row])
+        mask = self._attention_mask.index_select(0, keep)
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self._attention_mask = mask[:, start:]
+        self._cache = _build_cache(
+            [[tensor.index_select(0, keep)[:, :, start:] for tensor in kv] for kv in _cache_layers(self._cache)])
+
+    def _finish(self, request, error=None):
+        request.error = error
+        request.finished_at = time.perf_counter()
+        if error is not None:
+            request.stop_reason = 'error'
+        _observe(request)
+        try:
+            request.streamer.end()
+        finally:
+            request.done.set()
+            if request.on_finish:
+                request.on_finish()
+
+    def _fail_all(self, error):
+        for request in self._active:
+            self._finish(request, error=error)
+        self._active = []
+        self._cache = self._attention_mask = None
+
+    def _sample(self, logits):
+        """按模型的generation_config采样（或贪心）得到每一行的下一个token"""
+        if not self.do_sample:
+            return logits.argmax(dim=-1).tolist()
+        logits = logits.float() / self.temperature
+        if self.top_k > 0:
+            kth = torch.topk(logits, min(self.top_k, logits.shape[-1]), dim=-1).values[:, -1:]
+            logits = logits.masked_fill(logits < kth, float('-inf'))
+        if self.top_p < 1.0:
+            sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+            cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+            # 保留累计概率首次超过top_p的那个token
+            remove = cumulative - torch.softmax(sorted_logits, dim=-1) > self.top_p
+            logits = logits.masked_fill(remove.scatter(1, sorted_indices, remove), float('-inf'))
+        return torch.multinomial(torch.softmax(logits, dim=-1), 1).squeeze(-1).tolist()
+
+
+def _cache_layers(cache):
+    """从模型返回的KV缓存中取出每层的 [key, value] 张量，兼容不同版本的transformers"""
+    if hasattr(cache, 'layers'):
+        return [[layer.keys, layer.values] for layer in cache.layers]
+    if hasattr(cache, 'key_cache'):
+        return [[key, value] for key, value in zip(cache.key_cache, cache.value_cache)]
+    return [[key, value] for key, value in cache]
+
+
+def _build_cache(layers):
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(layers):
+        cache.update(key, value, layer_idx)
+    return cache
+
+
+def _left_pad(tensor, length):
+    """在序列维度（KV为第2维，mask为第1维）左侧补零到指定长度"""
+    dim = 2 if tensor.dim() == 4 else 1
+    pad = length - tensor.shape[dim]
+    if pad == 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = pad
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+def _observe(request):
+    """记录一个已结束请求的各项指标"""
+    GENERATIONS.inc(reason=request.stop_reason or 'unknown')
+    PROMPT_TOKENS.observe(len(request.input_ids))
+    GENERATED_TOKENS.observe(len(request.generated))
+    if request.started_at is not None:
+        QUEUE_WAIT.observe(request.started_at - request.submitted_at)
+        if request.first_token_at is not None:
+            PREFILL_SECONDS.observe(request.first_token_at - request.started_at)
+    if request.first_token_at is not None and request.finished_at is not None and len(request.generated) > 1:
+        seconds = request.finished_at - request.first_token_at
+        if seconds > 0:
+            DECODE_RATE.observe((len(request.generated) - 1) / seconds)
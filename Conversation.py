@@ -0,0 +1,70 @@
+import logging
+import threading
+from collections import OrderedDict
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 聊天模板为每条消息额外添加的token数（<|im_start|>role\n ... <|im_end|>\n）
+MESSAGE_TEMPLATE_TOKENS = 5
+
+
+class Conversation:
+    """单个会话的对话历史，每条消息记录其token数，按token预算截取最近的若干轮"""
+
+    def __init__(self, max_turns=50):
+        self.max_turns = max_turns
+        self.messages = []  # {'role', 'content', 'tokens'}
+        self.lock = threading.Lock()
+
+    def window(self, token_budget):
+        """返回不超过token预算的最近若干轮对话（按轮次成对保留，不拆开问答）"""
+        with self.lock:
+            selected = []
+            used = 0
+            for i in range(len(self.messages) - 2, -1, -2):
+                turn = self.messages[i:i + 2]
+                tokens = sum(message['tokens'] + MESSAGE_TEMPLATE_TOKENS for message in turn)
+                if used + tokens > token_budget:
+                    break
+                selected = turn + selected
+                used += tokens
+            return [{'role': message['role'], 'content': message['content']} for message in selected]
+
+    def append_turn(self, question, question_tokens, answer, answer_tokens):
+        """记录一轮对话；超过最大轮数时丢弃最早的轮次"""
+        with self.lock:
+            self.messages.append({'role': 'user', 'content': question, 'tokens': question_tokens})
+            self.messages.append({'role': 'assistant', 'content': answer, 'tokens': answer_tokens})
+            overflow = len(self.messages) - self.max_turns * 2
+            if overflow > 0:
+                del self.messages[:overflow]
+
+    def __len__(self):
+        return len(self.messages)
+
+
+class ConversationManager:
+    """按会话ID保存对话历史，会话数量超过上限时淘汰最久未使用的会话"""
+
+    def __init__(self, max_sessions=256, max_turns=50):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            conversation = self._conversations.pop(session_id, None)
+            if conversation is None:
+                conversation = Conversation(max_turns=self.max_turns)
+            self._conversations[session_id] = conversation
+            while len(self._conversations) > self.max_sessions:
+                evicted_id, _ = self._conversations.popitem(last=False)
+                logger.info(f"对话历史数量超过上限，淘汰会话: {evicted_id}")
+            return conversation
+
+    def clear(self, session_id):
+        with self._lock:
+            self._conversations.pop(session_id, None)
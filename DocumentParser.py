@@ -0,0 +1,114 @@
+import os
+import logging
+import multiprocessing
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import PyPDF2
+import docx
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 页数不少于该值的PDF才使用多进程解析，页数少时进程间传输的开销不划算
+PARALLEL_MIN_PAGES = 32
+# 每个解析任务处理的页数
+PAGES_PER_TASK = 8
+# 文本文件每条记录的最大字符数
+TEXT_RECORD_SIZE = 64 * 1024
+
+# 解析得到的一段文本；page 为从1开始的页码，没有分页信息的格式为None
+PageRecord = namedtuple('PageRecord', ['text', 'page'])
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def get_parse_pool(max_workers=None):
+    """进程内共享的解析进程池及其进程数，首次使用时创建"""
+    global _pool, _pool_workers
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool_workers = max_workers or os.cpu_count() or 1
+                _pool = ProcessPoolExecutor(max_workers=_pool_workers, mp_context=_parse_context())
+    return _pool, _pool_workers
+
+
+def _parse_context():
+    """解析进程的启动方式
+
+    不能直接fork：创建进程池时本进程已有torch、Flask和入库线程在运行，fork可能复制被其他线程持有的锁，使子进程死锁。
+    forkserver 先启动一个只预先导入本模块的干净进程，解析进程都从它fork出来，不重新加载Web应用和模型相关的库；
+    不支持forkserver的平台使用spawn。
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def iter_document(file_path, filename, max_workers=None):
+    """按顺序逐条产出文档内容（PageRecord），不把整个文档拼成一个字符串"""
+    name = filename.lower()
+    if name.endswith('.txt'):
+        return _iter_text(file_path)
+    if name.endswith('.pdf'):
+        return _iter_pdf(file_path, max_workers)
+    if name.endswith(('.doc', '.docx')):
+        return _iter_docx(file_path)
+    return iter(())
+
+
+def _iter_text(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        while True:
+            text = f.read(TEXT_RECORD_SIZE)
+            if not text:
+                return
+            yield PageRecord(text, None)
+
+
+def _iter_docx(file_path):
+    doc = docx.Document(file_path)
+    for para in doc.paragraphs:
+        yield PageRecord(para.text + "\n", None)
+
+
+def _iter_pdf(file_path, max_workers):
+    pdf_reader = PyPDF2.PdfReader(file_path)
+    page_count = len(pdf_reader.pages)
+    if page_count < PARALLEL_MIN_PAGES or max_workers == 1:
+        for page_num in range(page_count):
+            yield PageRecord(_page_text(pdf_reader.pages[page_num]), page_num + 1)
+        return
+    del pdf_reader
+
+    # 多进程按页区间并行提取，按页码顺序产出；同时在途的任务数有上限，内存占用与文件大小无关
+    logger.info(f"多进程解析PDF: {file_path}，共 {page_count} 页")
+    pool, workers = get_parse_pool(max_workers)
+    max_in_flight = 2 * workers
+    ranges = deque((start, min(start + PAGES_PER_TASK, page_count))
+                   for start in range(0, page_count, PAGES_PER_TASK))
+    in_flight = deque()
+    while ranges or in_flight:
+        while ranges and len(in_flight) < max_in_flight:
+            start, end = ranges.popleft()
+            in_flight.append((start, pool.submit(_extract_pages, file_path, start, end)))
+        start, future = in_flight.popleft()
+        for offset, text in enumerate(future.result()):
+            yield PageRecord(text, start + offset + 1)
+
+
+def _extract_pages(file_path, start, end):
+    """在解析进程中提取 [start, end) 页的文本"""
+    pdf_reader = PyPDF2.PdfReader(file_path)
+    return [_page_text(pdf_reader.pages[page_num]) for page_num in range(start, end)]
+
+
+def _page_text(page):
+    return (page.extract_text() or "") + "\n"
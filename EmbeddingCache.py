@@ -0,0 +1,116 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = 'embeddings.sqlite'
+# sqlite单条语句的参数个数有上限，批量查询时分组
+SQLITE_BATCH = 500
+
+
+class EmbeddingCache:
+    """跨会话共享的文档块嵌入向量缓存，按内容寻址，保存在磁盘上的sqlite中
+
+    键为 (编码模型, 截断长度, 文档块文本) 的哈希，不同会话上传相同的文件或相同的段落时只编码一次。
+    总大小超过 max_bytes 时按最近访问时间淘汰。
+    """
+
+    def __init__(self, cache_dir='embedding_cache', max_bytes=1024 * 1024 * 1024):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, CACHE_FILE)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS embeddings '
+                           '(key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)')
+        self._conn.commit()
+        self._bytes = self._conn.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings').fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(encoder, text):
+        namespace = f"{encoder.model_id}\0{getattr(encoder, 'max_length', '')}\0"
+        # 量化或低精度模型的向量与float32略有差异，分开缓存；default配置保持原有的键
+        profile = getattr(encoder, 'profile', 'default')
+        if profile != 'default':
+            namespace += f"{profile}\0"
+        return hashlib.sha256((namespace + text).encode('utf-8')).digest()
+
+    def get_many(self, keys):
+        """返回 {键: 向量}，只包含命中的键，并刷新其访问时间"""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique_keys), SQLITE_BATCH):
+                batch = unique_keys[start:start + SQLITE_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch)
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+            if found:
+                now = time.time()
+                self._conn.executemany('UPDATE embeddings SET last_access = ? WHERE key = ?',
+                                       [(now, key) for key in found])
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(unique_keys) - len(found)
+        return found
+
+    def put_many(self, keys, vectors):
+        now = time.time()
+        rows = [(key, np.ascontiguousarray(vector, dtype=np.float32).tobytes(), now)
+                for key, vector in zip(keys, vectors)]
+        with self._lock:
+            # 并发入库时其他会话可能刚写入同一个键，已存在的保持不变
+            for row in rows:
+                cursor = self._conn.execute(
+                    'INSERT OR IGNORE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)', row)
+                if cursor.rowcount:
+                    self._bytes += len(row[1])
+            self._conn.commit()
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+    def _evict(self):
+        """按最近访问时间淘汰，直到总大小降到上限的90%以下"""
+        target = self.max_bytes * 0.9
+        evicted = 0
+        while self._bytes > target:
+            rows = self._conn.execute('SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_access LIMIT ?',
+                                      (SQLITE_BATCH,)).fetchall()
+            if not rows:
+                break
+            removed = []
+            for key, size in rows:
+                if self._bytes <= target:
+                    break
+                removed.append((key,))
+                self._bytes -= size
+            self._conn.executemany('DELETE FROM embeddings WHERE key = ?', removed)
+            evicted += len(removed)
+        self._conn.commit()
+        logger.info(f"嵌入向量缓存淘汰 {evicted} 条，当前大小: {self._bytes} 字节")
@@ -0,0 +1,143 @@
+import os
+import logging
+import threading
+
+import numpy as np
+import torch
+from safetensors.torch import save_file
+from transformers import AutoTokenizer, AutoModel
+
+from InferenceProfile import optimize_model, resolve_profile, use_threads
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_MODEL = 'damo/nlp_corom_sentence-embedding_english-base'
+DEFAULT_MODEL_DIR = '/model'
+
+
+class EmbeddingEncoder:
+    """进程内共享的文本嵌入模型，只加载一次，供所有会话的向量数据库使用"""
+
+    def __init__(self, model_id=DEFAULT_EMBEDDING_MODEL, cache_dir=DEFAULT_MODEL_DIR, max_length=128, batch_size=32,
+                 profile='default', num_threads=None):
+        self.model_id = model_id
+        self.max_length = max_length
+        self.batch_size = batch_size
+        # 编码使用的线程数，与生成解码的线程分开设置，入库时的批量编码不会占满所有核
+        self.num_threads = num_threads
+
+        # 首先尝试从本地加载模型，如果不存在则下载
+        local_model_path = os.path.join(cache_dir, model_id)
+        if not os.path.exists(local_model_path):
+            logger.info(f"本地模型不存在，正在下载到 {local_model_path}")
+            from modelscope.hub.snapshot_download import snapshot_download
+            local_model_path = snapshot_download(model_id, cache_dir=cache_dir)
+            state_dict = torch.load(os.path.join(local_model_path, 'pytorch_model.bin'), map_location='cpu')
+            save_file(state_dict, os.path.join(local_model_path, 'model.safetensors'))
+        else:
+            logger.info(f"使用本地模型: {local_model_path}")
+
+        logger.info(f"开始读取: {local_model_path}")
+        self.tokenizer = AutoTokenizer.from_pretrained(local_model_path)
+        self.model = AutoModel.from_pretrained(local_model_path)
+        self.model.to('cpu')
+        self.profile = resolve_profile(profile)
+        self.model = optimize_model(self.model, self.profile)
+        self.dimension = self.model.config.hidden_size  # modelscope模型的输出维度为768
+        # 编码时自动添加的特殊token数（如[CLS]/[SEP]），分块时需要从截断长度中扣除
+        self.num_special_tokens = self.tokenizer.num_special_tokens_to_add()
+        logger.info(f"读取完成: {local_model_path}")
+
+        # tokenizer（fast版本）不支持多线程并发调用，推理过程统一加锁
+        self._lock = threading.Lock()
+
+    def embedding_pipeline(self, text):
+        """对单条文本生成嵌入向量，返回格式与modelscope pipeline保持一致"""
+        return {'sentence_embedding': self.encode_batch([text])[0]}
+
+    def encode_batch(self, texts, batch_size=None):
+        """批量生成嵌入向量，返回 (len(texts), dimension) 的float32矩阵
+
+        先整体分词，再按token长度排序分桶，使同一批次内的padding尽量少；
+        每个批次单独加锁，长时间的入库任务不会阻塞其他请求的查询向量计算。
+        """
+        batch_size = batch_size or self.batch_size
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        if len(texts) == 0:
+            return embeddings
+
+        with self._lock:
+            encoded = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)
+        order = np.argsort([len(ids) for ids in encoded['input_ids']], kind='stable')
+
+        for start in range(0, len(order), batch_size):
+            batch_indices = order[start:start + batch_size]
+            features = [{key: encoded[key][i] for key in encoded.keys()} for i in batch_indices]
+            with self._lock:
+                inputs = self.tokenizer.pad(features, padding=True, return_tensors='pt')
+                inputs = {k: v.to('cpu') for k, v in inputs.items()}
+                use_threads(self.num_threads)
+                with torch.no_grad():
+                    outputs = self.model(**inputs)
+            embedding = self._pool(outputs, inputs['attention_mask'])
+            embeddings[batch_indices] = embedding.float().cpu().numpy()
+
+        return embeddings
+
+    def token_offsets(self, texts):
+        """对每条文本分词（不加特殊token），返回每个token在文本中的起始字符位置"""
+        with self._lock:
+            if not getattr(self.tokenizer, 'is_fast', False):
+                encoded = self.tokenizer(list(texts), add_special_tokens=False, return_offsets_mapping=True)
+                return [[start for start, _ in offsets] for offsets in encoded['offset_mapping']]
+            # 直接调用底层的tokenizers，省去transformers逐条转换输出的开销；
+            # 先清除上次编码时设置的截断和补齐，之后的调用会按需重新设置
+            backend = self.tokenizer.backend_tokenizer
+            backend.no_truncation()
+            backend.no_padding()
+            encodings = backend.encode_batch(list(texts), add_special_tokens=False)
+        return [[start for start, _ in encoding.offsets] for encoding in encodings]
+
+    def _pool(self, outputs, attention_mask):
+        """从模型输出中提取句子嵌入，不同模型可能有不同的提取方式"""
+        if hasattr(outputs, 'sentence_embedding'):
+            return outputs.sentence_embedding
+        elif hasattr(outputs, 'pooler_output') and outputs.pooler_output is not None:
+            return outputs.pooler_output
+        elif hasattr(outputs, 'last_hidden_state'):
+            hidden_state = outputs.last_hidden_state
+        else:
+            # 如果以上都没有，使用模型输出的第一个元素（兜底方案）
+            hidden_state = list(outputs.values())[0]
+        # 取最后一层隐藏状态的平均值作为句子嵌入，批量推理时需排除padding位置
+        mask = attention_mask.unsqueeze(-1).to(hidden_state.dtype)
+        return (hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+
+_encoder = None
+_encoder_lock = threading.Lock()
+_encoder_options = {}
+_encoder_factory = None
+
+
+def configure_embedding_encoder(factory=None, **options):
+    """设置共享嵌入模型的加载参数（推理配置、线程数等），需在首次调用 get_embedding_encoder 之前调用
+
+    factory 不为None时用它代替 EmbeddingEncoder 创建共享实例（例如连接模型服务进程的客户端）。
+    """
+    global _encoder_factory
+    if factory is not None:
+        _encoder_factory = factory
+    _encoder_options.update(options)
+
+
+def get_embedding_encoder():
+    """获取进程内共享的嵌入模型，首次调用时加载"""
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                _encoder = (_encoder_factory or EmbeddingEncoder)(**_encoder_options)
+    return _encoder
@@ -0,0 +1,46 @@
+import time
+import threading
+
+import torch
+from transformers import StoppingCriteria
+
+
+class CancellationToken:
+    """取消标记：客户端断开等情况下由请求方设置，解码循环在下一步检查后停止生成"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+def deadline_after(timeout):
+    """把超时秒数转换为单调时钟的截止时间；timeout 为None或不大于0时不限时"""
+    return time.monotonic() + timeout if timeout and timeout > 0 else None
+
+
+def stop_reason(cancel_token=None, deadline=None):
+    """返回需要提前停止的原因（cancelled/deadline），无需停止时返回None"""
+    if cancel_token is not None and cancel_token.cancelled:
+        return 'cancelled'
+    if deadline is not None and time.monotonic() >= deadline:
+        return 'deadline'
+    return None
+
+
+class GenerationStopCriteria(StoppingCriteria):
+    """model.generate 的停止条件：请求被取消或超过截止时间时结束生成"""
+
+    def __init__(self, cancel_token=None, deadline=None):
+        self.cancel_token = cancel_token
+        self.deadline = deadline
+        self.reason = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.reason = stop_reason(self.cancel_token, self.deadline)
+        return torch.full((input_ids.shape[0],), self.reason is not None, dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,77 @@
+import os
+import logging
+
+import torch
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# CPU推理配置：default（float32）、int8（线性层动态量化）、bf16（需要CPU支持bfloat16指令）
+PROFILES = ('default', 'int8', 'bf16')
+# 自动分配线程时嵌入模型占用的核数比例，其余留给生成解码
+EMBEDDING_CORE_SHARE = 0.25
+
+
+def available_cores():
+    """当前进程可用的CPU核数（容器中受cpuset限制时小于物理核数）"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def bf16_supported():
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def resolve_profile(profile):
+    """检查配置名，CPU不支持bf16时退回default"""
+    if profile not in PROFILES:
+        raise ValueError(f"不支持的推理配置: {profile}，可选: {', '.join(PROFILES)}")
+    if profile == 'bf16' and not bf16_supported():
+        logger.warning("CPU不支持bfloat16运算，使用default配置")
+        return 'default'
+    return profile
+
+
+def optimize_model(model, profile):
+    """按推理配置转换已加载的模型，返回转换后的模型"""
+    profile = resolve_profile(profile)
+    if profile == 'int8':
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif profile == 'bf16':
+        model = model.to(torch.bfloat16)
+    model.eval()
+    logger.info(f"推理配置: {profile}")
+    return model
+
+
+def thread_split(generation_threads=0, embedding_threads=0):
+    """返回 (生成线程数, 嵌入线程数)，为0的一项按可用核数自动分配
+
+    两者之和不超过可用核数，入库时的批量编码不会与对话解码争抢同一批核。
+    """
+    cores = available_cores()
+    if not embedding_threads:
+        embedding_threads = max(1, int(cores * EMBEDDING_CORE_SHARE))
+    if not generation_threads:
+        generation_threads = max(1, cores - embedding_threads)
+    return generation_threads, embedding_threads
+
+
+def use_threads(num_threads):
+    """设置调用线程的算子内并行线程数（OpenMP的设置按线程生效，不影响其他线程）"""
+    if num_threads and torch.get_num_threads() != num_threads:
+        torch.set_num_threads(num_threads)
+
+
+def configure_interop_threads(num_threads):
+    """设置算子间并行的线程数，只能在进程执行任何并行计算之前调用一次"""
+    try:
+        torch.set_num_interop_threads(num_threads)
+    except RuntimeError as e:
+        logger.warning(f"无法设置算子间并行线程数: {str(e)}")
@@ -0,0 +1,263 @@
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 文档入库的各个阶段，按顺序执行
+STAGES = ('parse', 'chunk', 'embed', 'index')
+
+
+class IngestionBusyError(RuntimeError):
+    """未完成的入库任务过多，拒绝新的上传"""
+
+
+class IngestionJob:
+    """一个文档入库任务：当前阶段、各阶段耗时与进度"""
+
+    def __init__(self, session_id, filename, parse, on_finish=None):
+        self.job_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.filename = filename
+        self.parse = parse  # 无参数的解析函数，返回逐条产出 (文本, 页码) 的迭代器
+        self.on_finish = on_finish  # 任务结束（成功或失败）后调用，例如删除上传的临时文件
+        self.pinned = False  # 是否持有向量数据库缓存的pin
+        self.status = 'queued'  # queued / running / done / failed
+        self.stage = None
+        self.stages = OrderedDict((stage, {'status': 'pending', 'seconds': None}) for stage in STAGES)
+        self.chunks = 0
+        self.embedded = 0
+        self.cache_hits = 0  # 从嵌入缓存直接取得、无需重新编码的块数
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._seconds = dict.fromkeys(STAGES, 0.0)
+
+    def start_stage(self, stage):
+        """进入一个阶段；交替执行的阶段可以多次进入，status 中的 stage 是最近进入的阶段"""
+        self.status = 'running'
+        self.stage = stage
+        self.stages[stage]['status'] = 'running'
+
+    def add_time(self, stage, seconds):
+        """累加某个阶段的耗时"""
+        self._seconds[stage] += seconds
+        self.stages[stage]['seconds'] = round(self._seconds[stage], 3)
+
+    def end_stage(self, stage):
+        self.stages[stage]['status'] = 'done'
+        self.stages[stage]['seconds'] = round(self._seconds[stage], 3)
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'filename': self.filename,
+            'status': self.status,
+            'stage': self.stage,
+            'stages': {name: dict(stage) for name, stage in self.stages.items()},
+            'chunks': self.chunks,
+            'embedded': self.embedded,
+            'cache_hit_ratio': self.cache_hits / self.embedded if self.embedded else 0.0,
+            'error': self.error
+        }
+
+
+class IngestionQueue:
+    """后台文档入库队列，上传请求只负责保存文件并立即返回任务id
+
+    解析和分块在 max_workers 个线程中并行执行；编码和写入数据段交给单独的线程，
+    因此一个文档在编码时，下一个文档可以同时解析（流水线）。
+    每累积 segment_chunks 个文档块就编码并写出一个数据段，文档结束后一次提交全部数据段，
+    每个任务同时最多持有两批文档块，内存占用与文档大小无关。
+    未完成的任务数超过 max_pending 时拒绝新任务，已结束的任务最多保留 max_jobs 个供查询。
+    """
+
+    def __init__(self, db_cache, max_workers=2, max_pending=16, max_jobs=1024, embed_batch_size=256,
+                 segment_chunks=1024):
+        self.db_cache = db_cache
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+        self.embed_batch_size = embed_batch_size
+        self.segment_chunks = segment_chunks
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._parse_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest-parse")
+        self._index_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest-index")
+
+    def submit(self, session_id, filename, parse, on_finish=None):
+        """提交入库任务，返回任务对象；未完成任务过多时抛出 IngestionBusyError"""
+        job = IngestionJob(session_id, filename, parse, on_finish)
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise IngestionBusyError(f"待处理的文档过多（{self.max_pending}），请稍后再上传")
+            self._pending += 1
+            self._jobs[job.job_id] = job
+            self._trim()
+        self._parse_pool.submit(self._parse_stage, job)
+        logger.info(f"入库任务已提交: {job.job_id}，文件: {filename}")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {'pending': self._pending, 'max_pending': self.max_pending, 'jobs': len(self._jobs)}
+
+    def _parse_stage(self, job):
+        vector_db = None
+        segments = []  # 已写出、等待提交的数据段
+        batch = None  # 正在编码写入的上一批文档块
+        try:
+            # 任务结束前数据库不会被缓存淘汰，编码和写入阶段使用的是同一个实例
+            vector_db = self.db_cache.pin(job.session_id)
+            job.pinned = True
+            # 解析与分块流式交替进行：等待解析结果的时间计入parse，其余计入chunk
+            clock = _StageClock(job)
+            clock.switch('chunk')
+            chunks, pages, paged = [], [], False
+            for chunk, page_start, page_end in vector_db.split_records(_timed(job.parse(), clock, 'parse')):
+                chunks.append(chunk)
+                pages.append((page_start or 0, page_end or 0))
+                paged = paged or page_start is not None
+                job.chunks += 1
+                if len(chunks) >= self.segment_chunks:
+                    # 等待上一批写完再提交这一批，等待时间不计入任何阶段
+                    clock.switch(None)
+                    if batch is not None:
+                        batch.result()
+                    batch = self._index_pool.submit(self._index_batch, job, vector_db, segments, chunks, pages, paged)
+                    chunks, pages = [], []
+                    clock.switch('chunk')
+            clock.switch(None)
+            job.end_stage('parse')
+            job.end_stage('chunk')
+            if not job.chunks:
+                raise ValueError("文档没有可提取的文本内容")
+            if chunks:
+                batch = self._index_pool.submit(self._index_batch, job, vector_db, segments, chunks, pages, paged)
+        except Exception as e:
+            if batch is not None:
+                # 等待仍在写入的一批结束，之后再删除已写出的数据段
+                try:
+                    batch.result()
+                except Exception:
+                    pass
+            self._fail(job, e, vector_db, segments)
+            return
+        # 写入线程按提交顺序执行，提交在最后一批写完之后进行
+        self._index_pool.submit(self._commit_stage, job, vector_db, segments, batch)
+
+    def _commit_stage(self, job, vector_db, segments, batch):
+        try:
+            batch.result()
+            clock = _StageClock(job)
+            clock.switch('index')
+            vector_db.add_segments(job.filename, segments)
+            clock.switch(None)
+            job.end_stage('embed')
+            job.end_stage('index')
+        except Exception as e:
+            self._fail(job, e, vector_db, segments)
+            return
+        self._complete(job, 'done')
+        timings = {name: stage['seconds'] for name, stage in job.stages.items()}
+        logger.info(f"入库任务完成: {job.job_id}，文件: {job.filename}，各阶段耗时: {timings}，"
+                    f"数据段: {len(segments)}，嵌入缓存命中: {job.cache_hits}/{job.embedded}")
+
+    def _index_batch(self, job, vector_db, segments, chunks, pages, paged):
+        """编码一批文档块并写出一个未提交的数据段"""
+        # 分批编码以便汇报进度
+        clock = _StageClock(job)
+        clock.switch('embed')
+        embeddings = []
+        for start in range(0, len(chunks), self.embed_batch_size):
+            batch = chunks[start:start + self.embed_batch_size]
+            batch_embeddings, reused = vector_db.embed_chunks(batch)
+            embeddings.append(batch_embeddings)
+            job.cache_hits += reused
+            job.embedded += len(batch)
+        clock.switch('index')
+        segments.append(vector_db.write_segment(job.filename, chunks, np.concatenate(embeddings),
+                                                pages=pages if paged else None))
+        clock.switch(None)
+
+    def _fail(self, job, error, vector_db=None, segments=()):
+        if segments:
+            # 删除已写出但未提交的数据段
+            try:
+                vector_db.discard_segments(segments)
+            except Exception as e:
+                logger.warning(f"入库任务 {job.job_id} 删除未提交的数据段失败: {str(e)}")
+        logger.error(f"入库任务失败: {job.job_id}，文件: {job.filename}，阶段: {job.stage}，错误: {str(error)}")
+        job.error = str(error)
+        for stage in job.stages.values():
+            if stage['status'] == 'running':
+                stage['status'] = 'failed'
+        self._complete(job, 'failed')
+
+    def _complete(self, job, status):
+        if job.pinned:
+            self.db_cache.unpin(job.session_id)
+            job.pinned = False
+        if job.on_finish is not None:
+            try:
+                job.on_finish()
+            except Exception as e:
+                logger.warning(f"入库任务 {job.job_id} 的清理操作失败: {str(e)}")
+        with self._lock:
+            job.status = status
+            job.finished = time.time()
+            self._pending -= 1
+            self._trim()
+
+    def _trim(self):
+        """只淘汰已结束的最早任务"""
+        excess = len(self._jobs) - self.max_jobs
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished is not None][:excess]:
+            del self._jobs[job_id]
+
+
+class _StageClock:
+    """在一个线程内交替执行的几个阶段之间切换计时，每段时间计入切换前的阶段"""
+
+    def __init__(self, job):
+        self.job = job
+        self.stage = None
+        self._start = None
+
+    def switch(self, stage):
+        """切换到 stage 并返回切换前的阶段；stage 为None表示暂停计时"""
+        now = time.perf_counter()
+        previous = self.stage
+        if previous is not None:
+            self.job.add_time(previous, now - self._start)
+        self.stage, self._start = stage, now
+        if stage is not None:
+            self.job.start_stage(stage)
+        return previous
+
+
+def _timed(iterator, clock, stage):
+    """逐条转发迭代器的输出，等待下一条的时间计入 stage，之后切换回原来的阶段"""
+    iterator = iter(iterator)
+    while True:
+        previous = clock.switch(stage)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            clock.switch(previous)
+        yield item
@@ -0,0 +1,83 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class ModelLoader:
+    """在后台线程中加载模型并记录进度，加载期间Web服务照常响应
+
+    load 接收一个 start_stage(stage) 回调，依次进入 stages 中的各个阶段，返回加载结果。
+    """
+
+    def __init__(self, load, stages):
+        self._load = load
+        self.status = 'pending'  # pending / loading / ready / failed
+        self.stage = None
+        self.stages = OrderedDict((stage, {'status': 'pending', 'seconds': None}) for stage in stages)
+        self.result = None
+        self.error = None
+        self._started = None
+        self._stage_start = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def start(self):
+        """启动后台加载，重复调用不会重复加载"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.status = 'loading'
+            self._started = time.perf_counter()
+            self._thread = threading.Thread(target=self._run, name="model-loader", daemon=True)
+            self._thread.start()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait(self, timeout=None):
+        """等待加载完成，返回是否就绪"""
+        return self._ready.wait(timeout)
+
+    def to_dict(self):
+        return {
+            'status': self.status,
+            'stage': self.stage,
+            'stages': {name: dict(stage) for name, stage in self.stages.items()},
+            'elapsed': round(time.perf_counter() - self._started, 3) if self._started is not None else None,
+            'error': self.error
+        }
+
+    def _start_stage(self, stage):
+        self._end_stage()
+        logger.info(f"模型加载阶段: {stage}")
+        self.stage = stage
+        self.stages[stage]['status'] = 'running'
+        self._stage_start = time.perf_counter()
+
+    def _end_stage(self):
+        if self.stage is not None and self.stages[self.stage]['status'] == 'running':
+            self.stages[self.stage]['status'] = 'done'
+            self.stages[self.stage]['seconds'] = round(time.perf_counter() - self._stage_start, 3)
+
+    def _run(self):
+        try:
+            self.result = self._load(self._start_stage)
+        except Exception as e:
+            logger.exception(f"模型加载失败: {str(e)}")
+            if self.stage is not None:
+                self.stages[self.stage]['status'] = 'failed'
+            self.error = str(e)
+            self.status = 'failed'
+            return
+        self._end_stage()
+        self.stage = None
+        self.status = 'ready'
+        self._ready.set()
+        logger.info(f"模型加载完成，耗时 {time.perf_counter() - self._started:.1f} 秒")
@@ -0,0 +1,315 @@
+import os
+import time
+import secrets
+import logging
+import threading
+from multiprocessing.connection import Client, Listener
+
+from transformers import AutoTokenizer
+
+from EmbeddingModel import configure_embedding_encoder, get_embedding_encoder, DEFAULT_MODEL_DIR
+from GenerationControl import CancellationToken
+from InferenceProfile import thread_split, configure_interop_threads
+from Metrics import REGISTRY
+from ModelLoader import ModelLoader
+from QwenThread import QwenThread
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = 'model_server.sock'
+# 流式生成时检查客户端断开或取消的间隔（秒）
+CANCEL_POLL_INTERVAL = 0.05
+
+
+class ModelServerError(RuntimeError):
+    """模型服务进程返回的错误（未就绪、生成出错等）"""
+
+
+def authkey_path(address):
+    """模型服务自动生成的认证密钥文件，与socket放在一起"""
+    return f"{address}.key"
+
+
+class ModelServer:
+    """独立的模型服务进程：加载一份Qwen和嵌入模型，通过Unix socket为多个Web进程提供生成和编码
+
+    每个连接由一个线程处理，请求为 (操作, 参数)。普通请求在同一连接上依次应答；
+    stream 请求独占一个连接，逐段发送 ('chunk', 文本)，最后发送 ('end', None)，
+    客户端关闭连接即视为取消，生成请求在下一个解码步之前移出批次。
+    authkey 为None时每次启动生成随机密钥，写入只有本用户可读的密钥文件（见 authkey_path）供Web进程读取。
+    """
+
+    def __init__(self, address=DEFAULT_SOCKET, authkey=None):
+        self.address = address
+        self.authkey = authkey
+        self.qwen_thread = None
+        self.encoder = None
+        self.model_loader = ModelLoader(self._load, ('embedding', 'download', 'load', 'warmup'))
+
+    def serve_forever(self):
+        for path in (self.address, authkey_path(self.address)):
+            if os.path.exists(path):
+                os.remove(path)
+        # 在创建之前收紧umask，socket和密钥文件从一开始就只有本用户可以访问（创建后再chmod会留下时间窗口）
+        umask = os.umask(0o177)
+        try:
+            if self.authkey is None:
+                self.authkey = secrets.token_hex(32).encode()
+                with open(authkey_path(self.address), 'wb') as f:
+                    f.write(self.authkey)
+            listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        self.model_loader.start()
+        logger.info(f"模型服务已启动: {self.address}")
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    # 认证失败等只影响这一个连接
+                    logger.warning(f"接受连接失败: {str(e)}")
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), name="model-server-conn", daemon=True).start()
+        finally:
+            listener.close()
+
+    def _load(self, start_stage):
+        start_stage('embedding')
+        self.encoder = get_embedding_encoder()
+        self.qwen_thread = QwenThread(on_stage=start_stage)
+
+    def _handle(self, conn):
+        try:
+            while True:
+                try:
+                    op, kwargs = conn.recv()
+                except EOFError:
+                    return
+                if op == 'stream':
+                    self._stream(conn, **kwargs)
+                    return
+                try:
+                    conn.send(('ok', self._call(op, kwargs)))
+                except (OSError, EOFError):
+                    raise
+                except Exception as e:
+                    logger.exception(f"处理请求 {op} 出错: {str(e)}")
+                    conn.send(('error', f"{type(e).__name__}: {str(e)}"))
+        except (OSError, EOFError):
+            pass  # 客户端已断开
+        finally:
+            conn.close()
+
+    def _call(self, op, kwargs):
+        if op == 'status':
+            return self.model_loader.to_dict()
+        if op == 'metrics':
+            return REGISTRY.render()
+        if not self.model_loader.ready:
+            raise ModelServerError('模型尚未就绪')
+        if op == 'encoder_info':
+            return {
+                'model_id': self.encoder.model_id,
+                'max_length': self.encoder.max_length,
+                'num_special_tokens': self.encoder.num_special_tokens,
+                'dimension': self.encoder.dimension,
+                'profile': self.encoder.profile
+            }
+        if op == 'encode_batch':
+            return self.encoder.encode_batch(kwargs['texts'], batch_size=kwargs.get('batch_size'))
+        if op == 'token_offsets':
+            return self.encoder.token_offsets(kwargs['texts'])
+        if op == 'generate':
+            return self.qwen_thread.chat(**kwargs)
+        if op == 'stats':
+            return self.qwen_thread.stats()
+        raise ModelServerError(f"不支持的操作: {op}")
+
+    def _stream(self, conn, **kwargs):
+        if not self.model_loader.ready:
+            conn.send(('error', 'ModelServerError: 模型尚未就绪'))
+            return
+        cancel_token = CancellationToken()
+        done = threading.Event()
+
+        def watch():
+            # stream 连接上客户端不再发送数据，可读即表示连接已关闭或客户端要求取消
+            while not done.is_set():
+                try:
+                    if conn.poll(CANCEL_POLL_INTERVAL):
+                        break
+                except (OSError, EOFError):
+                    break
+            if not done.is_set():
+                cancel_token.cancel()
+
+        threading.Thread(target=watch, name="model-server-watch", daemon=True).start()
+        generator = self.qwen_thread.stream_chat(cancel_token=cancel_token, **kwargs)
+        try:
+            for chunk in generator:
+                conn.send(('chunk', chunk))
+            conn.send(('end', None))
+        except (OSError, EOFError):
+            cancel_token.cancel()
+            raise
+        except Exception as e:
+            logger.exception(f"流式生成出错: {str(e)}")
+            conn.send(('error', f"{type(e).__name__}: {str(e)}"))
+        finally:
+            done.set()
+            generator.close()
+
+
+class ModelServerClient:
+    """Web进程中的模型服务客户端，普通请求复用连接池中的连接，线程安全
+
+    authkey 为None时每次建立连接都读取模型服务生成的密钥文件，模型服务重启换了密钥也能连上。
+    """
+
+    def __init__(self, address=DEFAULT_SOCKET, authkey=None, max_idle=8):
+        self.address = address
+        self.authkey = authkey
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def call(self, op, **kwargs):
+        conn = self._acquire()
+        try:
+            conn.send((op, kwargs))
+            status, result = conn.recv()
+        except BaseException:
+            conn.close()
+            raise
+        self._release(conn)
+        if status == 'error':
+            raise ModelServerError(result)
+        return result
+
+    def stream(self, cancel_token=None, **kwargs):
+        """流式生成，逐段产出文本；cancel_token 被取消或生成器被关闭时断开连接，服务端随即取消生成"""
+        conn = self._connect()
+        try:
+            conn.send(('stream', kwargs))
+            while True:
+                while not conn.poll(CANCEL_POLL_INTERVAL):
+                    if cancel_token is not None and cancel_token.cancelled:
+                        return
+                kind, value = conn.recv()
+                if kind == 'chunk':
+                    yield value
+                elif kind == 'end':
+                    return
+                else:
+                    raise ModelServerError(value)
+        finally:
+            conn.close()
+
+    def wait_ready(self, timeout=None, interval=0.5):
+        """等待模型服务启动并加载完成，加载失败时抛出 ModelServerError"""
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            try:
+                status = self.call('status')
+                if status['status'] == 'ready':
+                    return status
+                if status['status'] == 'failed':
+                    raise ModelServerError(f"模型服务加载失败: {status['error']}")
+            except (FileNotFoundError, ConnectionRefusedError):
+                pass  # 模型服务进程尚未启动
+            if deadline is not None and time.monotonic() >= deadline:
+                raise ModelServerError('等待模型服务就绪超时')
+            time.sleep(interval)
+
+    def _connect(self):
+        return Client(self.address, family='AF_UNIX', authkey=self.authkey or self._read_authkey())
+
+    def _read_authkey(self):
+        try:
+            with open(authkey_path(self.address), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            if os.path.exists(self.address):
+                raise ModelServerError(f"找不到模型服务的密钥文件 {authkey_path(self.address)}，"
+                                       f"模型服务使用 MODEL_SERVER_AUTHKEY 启动时Web进程需要设置相同的值")
+            raise  # 模型服务进程尚未启动
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+
+class RemoteQwenThread:
+    """与 QwenThread 接口相同，生成请求转发给模型服务进程；分词器在本进程加载，用于计算提示词长度"""
+
+    def __init__(self, client, tokenizer_path):
+        self.client = client
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+
+    def stream_chat(self, text, session_id=None, question=None, max_new_tokens=None, timeout=None, cancel_token=None):
+        for chunk in self.client.stream(text=text, session_id=session_id, question=question,
+                                        max_new_tokens=max_new_tokens, timeout=timeout, cancel_token=cancel_token):
+            if chunk:
+                yield chunk
+
+    def chat(self, text, session_id=None, question=None, max_new_tokens=None, timeout=None, cancel_token=None):
+        return "".join(self.stream_chat(text, session_id=session_id, question=question,
+                                        max_new_tokens=max_new_tokens, timeout=timeout,
+                                        cancel_token=cancel_token))
+
+    def stats(self):
+        return self.client.call('stats')
+
+
+class RemoteEmbeddingEncoder:
+    """与 EmbeddingEncoder 接口相同，编码和分词请求转发给模型服务进程"""
+
+    def __init__(self, client):
+        self.client = client
+        client.wait_ready()
+        info = client.call('encoder_info')
+        self.model_id = info['model_id']
+        self.max_length = info['max_length']
+        self.num_special_tokens = info['num_special_tokens']
+        self.dimension = info['dimension']
+        self.profile = info['profile']
+
+    def embedding_pipeline(self, text):
+        return {'sentence_embedding': self.encode_batch([text])[0]}
+
+    def encode_batch(self, texts, batch_size=None):
+        return self.client.call('encode_batch', texts=list(texts), batch_size=batch_size)
+
+    def token_offsets(self, texts):
+        return self.client.call('token_offsets', texts=list(texts))
+
+
+def main():
+    # 与Web进程使用相同的环境变量
+    model_dir = os.environ.get('MODEL_DIR', DEFAULT_MODEL_DIR)
+    profile = os.environ.get('EMBEDDING_INFERENCE_PROFILE', os.environ.get('INFERENCE_PROFILE', 'default'))
+    generation_threads = int(os.environ.get('GENERATION_THREADS', 0))
+    embedding_threads = int(os.environ.get('EMBEDDING_THREADS', 0))
+    configure_embedding_encoder(cache_dir=model_dir, profile=profile,
+                                num_threads=thread_split(generation_threads, embedding_threads)[1])
+    configure_interop_threads(int(os.environ.get('INTEROP_THREADS', 1)))
+    # 未设置 MODEL_SERVER_AUTHKEY 时生成随机密钥
+    authkey = os.environ.get('MODEL_SERVER_AUTHKEY')
+    server = ModelServer(os.environ.get('MODEL_SERVER_SOCKET', DEFAULT_SOCKET), authkey.encode() if authkey else None)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import logging
+import threading
+from collections import OrderedDict
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def kv_bytes_per_token(config, dtype):
+    """每个token在所有层的key和value占用的字节数（由模型配置和KV的数据类型决定）"""
+    num_kv_heads = getattr(config, 'num_key_value_heads', None) or config.num_attention_heads
+    head_dim = getattr(config, 'head_dim', None) or config.hidden_size // config.num_attention_heads
+    return 2 * config.num_hidden_layers * num_kv_heads * head_dim * dtype.itemsize
+
+
+class PrefixCache:
+    """提示词前缀的KV缓存，多轮对话中相同的历史部分无需重复预填充
+
+    每条缓存项保存一段token及其每层的 [key, value]；
+    以 block_size 为粒度对前缀计算链式哈希，查找时从最长的前缀开始匹配，命中后比对token防止哈希冲突，
+    再逐个token向后延伸到与缓存项不同的位置。
+    新缓存项包含某条旧缓存项的全部token时（同一会话的下一轮），旧缓存项被替换。按占用字节数做LRU淘汰。
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, block_size=16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self._entries = OrderedDict()  # 缓存项id -> (token列表, 每层[key, value], 字节数)
+        self._prefixes = {}            # 前缀哈希 -> 缓存项id
+        self._next_entry = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # 命中率统计
+        self.lookups = 0
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+
+    def lookup(self, token_ids):
+        """返回可复用的前缀长度及对应的KV（已截取到该长度）；至少留一个token用于计算下一个token的logits"""
+        with self._lock:
+            self.lookups += 1
+            self.prompt_tokens += len(token_ids)
+            limit = len(token_ids) - 1
+            hashes = self._block_hashes(token_ids, limit)
+            for block_count in range(len(hashes), 0, -1):
+                entry_id = self._prefixes.get(hashes[block_count - 1])
+                entry = self._entries.get(entry_id)
+                length = block_count * self.block_size
+                if entry is None or entry[0][:length] != token_ids[:length]:
+                    continue
+                cached_tokens = entry[0]
+                end = min(len(cached_tokens), limit)
+                while length < end and cached_tokens[length] == token_ids[length]:
+                    length += 1
+                self._entries.move_to_end(entry_id)
+                self.hits += 1
+                self.reused_tokens += length
+                return length, [[tensor[:, :, :length] for tensor in kv] for kv in entry[1]]
+            return 0, None
+
+    def put(self, token_ids, layers):
+        """缓存一段token的KV（batch维度为1，长度与 token_ids 相同）
+
+        超过内存上限的部分被截掉，只缓存放得下的最长前缀。
+        """
+        if not token_ids or not layers:
+            return
+        bytes_per_token = sum(tensor.numel() * tensor.element_size() for kv in layers for tensor in kv) \
+            // len(token_ids)
+        fit = min(len(token_ids), self.max_bytes // bytes_per_token) if bytes_per_token else len(token_ids)
+        if fit < self.block_size:
+            logger.info(f"前缀KV缓存上限（{self.max_bytes / 2 ** 20:.0f}MB）不足一个块，不缓存该提示词")
+            return
+        if fit < len(token_ids):
+            logger.info(f"前缀KV（{len(token_ids)} 个token）超过缓存上限，只缓存前 {fit} 个token")
+            token_ids = token_ids[:fit]
+            layers = [[tensor[:, :, :fit].clone() for tensor in kv] for kv in layers]
+        token_ids = list(token_ids)
+        hashes = self._block_hashes(token_ids, len(token_ids))
+        size = bytes_per_token * len(token_ids)
+        with self._lock:
+            # 被新缓存项完全包含的旧缓存项不再有用
+            superseded = set()
+            for prefix_hash in hashes:
+                entry_id = self._prefixes.get(prefix_hash)
+                entry = self._entries.get(entry_id)
+                if entry is not None and entry_id not in superseded and len(entry[0]) <= len(token_ids) \
+                        and token_ids[:len(entry[0])] == entry[0]:
+                    superseded.add(entry_id)
+            for entry_id in superseded:
+                self._remove(entry_id)
+
+            entry_id = self._next_entry
+            self._next_entry += 1
+            self._entries[entry_id] = (token_ids, layers, size)
+            self._bytes += size
+            for prefix_hash in hashes:
+                self._prefixes[prefix_hash] = entry_id
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+                'reused_token_ratio': self.reused_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+            }
+
+    def _remove(self, entry_id):
+        token_ids, _, size = self._entries.pop(entry_id)
+        self._bytes -= size
+        for prefix_hash in self._block_hashes(token_ids, len(token_ids)):
+            if self._prefixes.get(prefix_hash) == entry_id:
+                del self._prefixes[prefix_hash]
+
+    def _block_hashes(self, token_ids, limit):
+        """前 limit 个token中每个完整块边界处的前缀哈希（链式计算，总开销与长度成线性）"""
+        hashes = []
+        prefix_hash = 0
+        for end in range(self.block_size, limit + 1, self.block_size):
+            prefix_hash = hash((prefix_hash, tuple(token_ids[end - self.block_size:end])))
+            hashes.append(prefix_hash)
+        return hashes
@@ -0,0 +1,116 @@
+import logging
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+PROMPT_HEADER = "基于以下相关知识库内容回答问题：\n\n"
+# 相邻文档块之间重叠部分的查找长度范围（字符），过短的重合视为巧合
+MIN_OVERLAP_CHARS = 4
+MAX_OVERLAP_CHARS = 512
+
+
+class PromptAssembler:
+    """把检索结果按token预算拼成提示词
+
+    按相关度依次选入文档块，直到用Qwen分词器计算的token数达到 context_token_budget；
+    重复的块只保留一次，同一文档中相邻的块合并为一段并去掉重叠部分。
+    """
+
+    def __init__(self, tokenizer, context_token_budget=1536):
+        self.tokenizer = tokenizer
+        self.context_token_budget = context_token_budget
+
+    def assemble(self, question, results):
+        """返回发送给模型的提示词；没有可用的检索结果时直接返回问题"""
+        passages = self._select(results)
+        if not passages:
+            return question
+        relevant_content = ""
+        for i, passage in enumerate(passages):
+            relevant_content += f"{self._label(i, passage)}{passage['content']}\n\n"
+        return f"{PROMPT_HEADER}{relevant_content}\n\n问题：{question}"
+
+    def _select(self, results):
+        """在预算内按相关度选出文档块，再合并为段落（按最相关的块排序）"""
+        budget = self.context_token_budget - self._count([PROMPT_HEADER])[0]
+        seen_ids, seen_texts, candidates = set(), set(), []
+        for rank, result in enumerate(results):
+            chunk_id = result['metadata'].get('chunk_id')
+            if chunk_id in seen_ids or result['content'] in seen_texts:
+                continue
+            seen_ids.add(chunk_id)
+            seen_texts.add(result['content'])
+            candidates.append((rank, result))
+        if not candidates:
+            return []
+
+        # 每个块的token数只计算一次；段落标签按每块一个估算，合并后只会更少
+        label = self._count([self._label(0, candidates[0][1])])[0]
+        counts = self._count([result['content'] for _, result in candidates])
+        selected, used = [], 0
+        for (rank, result), count in zip(candidates, counts):
+            if used + count + label > budget:
+                if not selected and budget > label:
+                    # 最相关的块本身超出预算时截断
+                    selected.append((rank, dict(result, content=self._truncate(result['content'], budget - label))))
+                    used = budget
+                continue
+            selected.append((rank, result))
+            used += count + label
+
+        passages = self._merge(selected)
+        logger.info(f"提示词拼接：{len(results)} 个检索结果，选入 {len(selected)} 个块，合并为 {len(passages)} 段，"
+                    f"约 {used} 个token")
+        return passages
+
+    def _merge(self, selected):
+        """同一文档中chunk_id连续的块合并为一段"""
+        ordered = sorted(selected, key=lambda item: (item[1]['metadata']['filename'],
+                                                     item[1]['metadata'].get('chunk_id', -1)))
+        passages = []
+        for rank, result in ordered:
+            metadata = result['metadata']
+            previous = passages[-1] if passages else None
+            if (previous is not None and previous['filename'] == metadata['filename']
+                    and metadata.get('chunk_id') is not None
+                    and previous['last_chunk_id'] + 1 == metadata['chunk_id']):
+                previous['content'] = _join_overlapping(previous['content'], result['content'])
+                previous['last_chunk_id'] = metadata['chunk_id']
+                previous['page_end'] = metadata.get('page_end')
+                previous['rank'] = min(previous['rank'], rank)
+                continue
+            passages.append({
+                'content': result['content'],
+                'filename': metadata['filename'],
+                'last_chunk_id': metadata.get('chunk_id', -1),
+                'page': metadata.get('page'),
+                'page_end': metadata.get('page_end'),
+                'rank': rank
+            })
+        passages.sort(key=lambda passage: passage['rank'])
+        return passages
+
+    def _label(self, i, passage):
+        metadata = passage.get('metadata', passage)
+        source = metadata['filename']
+        if metadata.get('page'):
+            source += f" 第{metadata['page']}页"
+            if metadata.get('page_end') and metadata['page_end'] != metadata['page']:
+                source += f"至第{metadata['page_end']}页"
+        return f"文档片段 {i + 1}（来自 {source}）：\n"
+
+    def _count(self, texts):
+        return [len(ids) for ids in self.tokenizer(texts, add_special_tokens=False)['input_ids']]
+
+    def _truncate(self, text, max_tokens):
+        ids = self.tokenizer(text, add_special_tokens=False)['input_ids'][:max_tokens]
+        return self.tokenizer.decode(ids, skip_special_tokens=True)
+
+
+def _join_overlapping(first, second):
+    """拼接相邻的两个块，去掉 second 开头与 first 结尾重复的部分"""
+    for length in range(min(len(first), len(second), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:length]):
+            return first + second[length:]
+    return first + "\n" + second
@@ -1,8 +1,14 @@
 from modelscope import AutoModelForCausalLM, AutoTokenizer
 import torch
 import logging
+from transformers import StoppingCriteriaList
 
-from TextStreamer import TextStreamer
+from TextStreamer import TextStreamer, IncrementalDetokenizer
+from Conversation import ConversationManager
+from BatchScheduler import ContinuousBatchScheduler
+from PrefixCache import PrefixCache, kv_bytes_per_token
+from GenerationControl import CancellationToken, GenerationStopCriteria, deadline_after
+from InferenceProfile import optimize_model, use_threads
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -10,21 +16,48 @@ logger = logging.getLogger(__name__)
 
 
 class QwenChatbot:
-    def __init__(self, model_name="Qwen/Qwen3-0.6B"):
+    def __init__(self, model_name="Qwen/Qwen3-0.6B", history_token_budget=2048, max_sessions=256,
+                 max_batch_size=4, max_waiting=32, prefix_cache_bytes=None, prefix_cache_sessions=4,
+                 default_max_new_tokens=32768, default_timeout=None, profile='default', num_threads=None,
+                 speculative_tokens=0):
         logger.info(f"开始加载模型: {model_name}")
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(model_name)
-        self.history = []
+        # profile 为 int8/bf16 时量化或转换精度；num_threads 是生成使用的线程数，与嵌入模型的线程分开
+        self.model = optimize_model(AutoModelForCausalLM.from_pretrained(model_name), profile)
+        self.num_threads = num_threads
+        # 按会话保存对话历史，每次请求只带入不超过token预算的最近若干轮
+        self.conversations = ConversationManager(max_sessions=max_sessions)
+        self.history_token_budget = history_token_budget
+        # 单次生成的token上限与超时（秒）；请求可以设置更小的值，但不能超过 default_max_new_tokens
+        self.default_max_new_tokens = default_max_new_tokens
+        self.default_timeout = default_timeout
         self.streamer = TextStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        # 缓存对话历史部分的KV，下一轮对话无需重新预填充；预算为0时不启用，
+        # 为None时按模型每个token的KV大小，留出 prefix_cache_sessions 个会话的完整历史窗口
+        if prefix_cache_bytes is None:
+            token_bytes = kv_bytes_per_token(self.model.config, self.model.dtype)
+            prefix_cache_bytes = token_bytes * history_token_budget * prefix_cache_sessions
+            logger.info(f"前缀KV缓存上限: {prefix_cache_bytes / 2 ** 20:.0f}MB（每个token {token_bytes / 1024:.0f}KB，"
+                        f"{prefix_cache_sessions} 个会话×{history_token_budget} 个token）")
+        self.prefix_cache = PrefixCache(max_bytes=prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+        # 流式生成请求共享一个连续批处理的解码循环；speculative_tokens 大于0时单个请求解码使用提示词查找投机解码
+        self.scheduler = ContinuousBatchScheduler(self.model, self.tokenizer, max_batch_size=max_batch_size,
+                                                  max_waiting=max_waiting, prefix_cache=self.prefix_cache,
+                                                  num_threads=num_threads, speculative_tokens=speculative_tokens)
         logger.info("模型加载完成")
-        logger.debug(f"初始化后聊天上下文为空，历史记录长度: {len(self.history)}, 历史记录内容: {self.history}")
 
-    def generate_response(self, user_input):
+    def generate_response(self, user_input, session_id=None, question=None, max_new_tokens=None, timeout=None,
+                          cancel_token=None):
+        """生成完整回复
+
+        user_input 是本轮实际发送给模型的内容（可能包含检索到的知识库片段），
+        question 是写入对话历史的原始问题，未提供时使用 user_input；
+        session_id 为None时不读取也不记录对话历史。
+        max_new_tokens / timeout 为None时使用默认值；cancel_token 被取消后在下一个解码步停止，且不记录本轮对话。
+        """
         logger.info(f"接收用户输入，长度: {len(user_input)} 字符")
-        logger.debug(f"当前上下文历史记录长度: {len(self.history)} 条消息，历史记录内容: {self._format_history(self.history)}")
         
-        messages = self.history + [{"role": "user", "content": user_input}]
-        logger.debug(f"构建完整消息列表，总长度: {len(messages)} 条消息")
+        messages = self._build_messages(user_input, session_id)
 
         text = self.tokenizer.apply_chat_template(
             messages,
@@ -38,24 +71,30 @@ class QwenChatbot:
         logger.debug(f"Tokenize后输入形状: {inputs.input_ids.shape}")
         
         logger.info("开始生成响应")
-        response_ids = self.model.generate(**inputs, max_new_tokens=32768, streamer=self.streamer)[0][len(inputs.input_ids[0]):].tolist()
+        use_threads(self.num_threads)
+        stop_criteria = GenerationStopCriteria(cancel_token, self._deadline(timeout))
+        response_ids = self.model.generate(**inputs, max_new_tokens=self._max_new_tokens(max_new_tokens),
+                                           streamer=self.streamer,
+                                           stopping_criteria=StoppingCriteriaList([stop_criteria]))[0][len(inputs.input_ids[0]):].tolist()
         response = self.tokenizer.decode(response_ids, skip_special_tokens=True)
         
-        # 更新历史记录
-        self.history.append({"role": "user", "content": user_input})
-        self.history.append({"role": "assistant", "content": response})
+        # 更新历史记录（被取消的回复不完整，不写入历史）
+        if stop_criteria.reason != 'cancelled':
+            self._record_turn(session_id, question if question is not None else user_input, response)
         
         logger.info(f"响应生成完成，响应长度: {len(response)} 字符")
-        logger.debug(f"更新后上下文历史记录长度: {len(self.history)} 条消息，历史记录内容: {self._format_history(self.history)}")
         
         return response
         
-    def stream_generate_response(self, user_input):
+    def stream_generate_response(self, user_input, session_id=None, question=None, max_new_tokens=None,
+                                 timeout=None, cancel_token=None):
+        """流式生成回复，参数含义同 generate_response
+
+        调用方提前关闭生成器（例如客户端断开连接）时视为取消，请求在下一个解码步之前移出批次。
+        """
         logger.info(f"开始流式生成响应，用户输入长度: {len(user_input)} 字符")
-        logger.debug(f"当前上下文历史记录长度: {len(self.history)} 条消息，历史记录内容: {self._format_history(self.history)}")
         
-        messages = self.history + [{"role": "user", "content": user_input}]
-        logger.debug(f"构建完整消息列表，总长度: {len(messages)} 条消息")
+        messages = self._build_messages(user_input, session_id)
 
         text = self.tokenizer.apply_chat_template(
             messages,
@@ -67,14 +106,13 @@ class QwenChatbot:
 
         inputs = self.tokenizer(text, return_tensors="pt")
         logger.debug(f"Tokenize后输入形状: {inputs.input_ids.shape}")
+        input_ids = inputs.input_ids[0].tolist()
         
         # 创建自定义的流式输出收集器，确保移除多余格式和前缀
         class StreamingGenerator:
             def __init__(self, tokenizer):
-                self.tokenizer = tokenizer
-                self.token_cache = []
-                self.print_len = 0
-                self.final_text = ""
+                # 增量解码，每个token的开销与已生成长度无关
+                self.detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens=True)
                 self.new_text_callback = None
             
             def put(self, value):
@@ -84,28 +122,16 @@ class QwenChatbot:
                 elif len(value.shape) > 1:
                     value = value[0]
                 
-                # 添加新token到缓存
-                self.token_cache.extend(value.tolist())
-                text = self.tokenizer.decode(self.token_cache, skip_special_tokens=True)
-                
-                # 处理新生成的文本
-                if len(text) > self.print_len:
-                    new_text = text[self.print_len:]
-                    self.print_len = len(text)
-                    self.final_text = text
-                    # 通过回调函数返回新文本，确保移除任何多余的格式或前缀
-                    # 确保正确处理所有字符编码
-                    if self.new_text_callback:
-                        # 确保new_text是字符串类型
-                        if isinstance(new_text, bytes):
-                            try:
-                                new_text = new_text.decode('utf-8', errors='replace')
-                            except:
-                                pass
-                        self.new_text_callback(new_text)
+                # 通过回调函数返回新形成的文本（不完整的多字节字符会等待后续token）
+                new_text = self.detokenizer.add(value.tolist())
+                if new_text and self.new_text_callback:
+                    self.new_text_callback(new_text)
             
             def end(self):
-                pass
+                # 输出剩余的文本
+                new_text = self.detokenizer.flush()
+                if new_text and self.new_text_callback:
+                    self.new_text_callback(new_text)
         
         # 创建一个队列来收集流式输出
         from queue import Queue
@@ -115,54 +141,82 @@ class QwenChatbot:
         streamer = StreamingGenerator(self.tokenizer)
         streamer.new_text_callback = lambda text: output_queue.put(text)
         
-        # 在后台生成响应
-        import threading
-        def generate_task():
-            with torch.no_grad():
-                self.model.generate(**inputs, max_new_tokens=32768, streamer=streamer)
-            # 生成完成后放入None作为结束信号
-            output_queue.put(None)
-        
-        # 启动生成线程
-        thread = threading.Thread(target=generate_task)
-        thread.start()
+        # 提交到连续批处理调度器，生成完成后放入None作为结束信号
+        if cancel_token is None:
+            cancel_token = CancellationToken()
+        request = self.scheduler.submit(input_ids, streamer,
+                                        max_new_tokens=self._max_new_tokens(max_new_tokens),
+                                        on_finish=lambda: output_queue.put(None),
+                                        cancel_token=cancel_token, deadline=self._deadline(timeout),
+                                        cache_tokens=self._reusable_tokens(input_ids, messages, question))
         
         # 收集完整的响应文本
         full_response = ""
         
         # 从队列中获取流式输出并yield，确保不包含多余的格式和前缀
-        while True:
-            chunk = output_queue.get()
-            if chunk is None:  # 结束信号
-                break
-            full_response += chunk
-            yield chunk
-            output_queue.task_done()
-        
-        # 等待生成线程完成
-        thread.join()
-        
-        # 更新历史记录
-        self.history.append({"role": "user", "content": user_input})
-        self.history.append({"role": "assistant", "content": full_response})
-        
-        logger.info(f"流式响应生成完成，完整响应长度: {len(full_response)} 字符")
-        logger.info(f"更新后上下文历史记录长度: {len(self.history)} 条消息，历史记录内容: {self._format_history(self.history)}")
+        try:
+            while True:
+                chunk = output_queue.get()
+                if chunk is None:  # 结束信号
+                    break
+                full_response += chunk
+                yield chunk
+                output_queue.task_done()
+        finally:
+            # 生成器未读完就被关闭时通知调度器释放该请求
+            if not request.done.is_set():
+                cancel_token.cancel()
+        
+        if request.error is not None:
+            raise request.error
+        
+        # 更新历史记录（被取消的回复不完整，不写入历史）
+        if request.stop_reason != 'cancelled':
+            self._record_turn(session_id, question if question is not None else user_input, full_response)
+        
+        logger.info(f"流式响应生成完成（{request.stop_reason}），完整响应长度: {len(full_response)} 字符")
         
         return full_response
-        
-    def _format_history(self, history, max_content_length=100):
-        """格式化历史记录，避免日志过于冗长"""
-        if not history:
-            return "[]"
-        
-        formatted = []
-        for msg in history:
-            role = msg.get('role', 'unknown')
-            content = msg.get('content', '')
-            # 截断过长的内容
-            if len(content) > max_content_length:
-                content = content[:max_content_length] + "..."
-            formatted.append(f"{{'role': '{role}', 'content': '{content}'}}")
-        
-        return "[" + ", ".join(formatted) + "]"
+
+    def _max_new_tokens(self, max_new_tokens):
+        if max_new_tokens is None or max_new_tokens <= 0:
+            return self.default_max_new_tokens
+        return min(max_new_tokens, self.default_max_new_tokens)
+
+    def _deadline(self, timeout):
+        return deadline_after(timeout if timeout is not None else self.default_timeout)
+
+    def _reusable_tokens(self, input_ids, messages, question):
+        """提示词中下一轮对话可以复用的前缀长度
+
+        对话历史只记录原始问题，本轮输入拼接了知识库内容时，下一轮的提示词只在本轮问题之前的部分与本轮相同；
+        与按原始问题渲染的提示词逐个token比较得到相同前缀的长度。
+        """
+        if self.prefix_cache is None or question is None or question == messages[-1]['content']:
+            return len(input_ids)
+        text = self.tokenizer.apply_chat_template(messages[:-1] + [{"role": "user", "content": question}],
+                                                  tokenize=False, add_generation_prompt=True, enable_thinking=False)
+        plain_ids = self.tokenizer(text).input_ids
+        length = 0
+        for token, plain_token in zip(input_ids, plain_ids):
+            if token != plain_token:
+                break
+            length += 1
+        return length
+
+    def _build_messages(self, user_input, session_id):
+        """拼接会话历史窗口与本轮输入"""
+        history = []
+        if session_id is not None:
+            history = self.conversations.get(session_id).window(self.history_token_budget)
+        return history + [{"role": "user", "content": user_input}]
+
+    def _record_turn(self, session_id, question, response):
+        """记录一轮对话，历史中只保存原始问题而不是拼接了知识库内容的提示词"""
+        if session_id is None:
+            return
+        self.conversations.get(session_id).append_turn(
+            question, self._count_tokens(question), response, self._count_tokens(response))
+
+    def _count_tokens(self, text):
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
@@ -1,58 +1,91 @@
-from concurrent.futures import ThreadPoolExecutor
-import queue
 import os
 
 from Qwen import QwenChatbot
+from InferenceProfile import thread_split
+from Metrics import Gauge
 
+# 模型文件目录，不存在时从modelscope下载到该目录
+MODEL_DIR = os.environ.get('MODEL_DIR', '/model')
+QWEN_MODEL_PATH = os.path.join(MODEL_DIR, 'Qwen', 'Qwen3-0___6B')
+# 每次请求带入的对话历史token上限
+HISTORY_TOKEN_BUDGET = int(os.environ.get('QWEN_HISTORY_TOKENS', 2048))
+# 连续批处理：同时解码的最大请求数、排队等待的最大请求数
+MAX_BATCH_SIZE = int(os.environ.get('QWEN_MAX_BATCH_SIZE', 4))
+MAX_WAITING = int(os.environ.get('QWEN_MAX_WAITING', 32))
+# 对话历史前缀KV缓存的内存上限（MB），0表示不启用；未设置时按模型每个token的KV大小，
+# 为 QWEN_PREFIX_CACHE_SESSIONS 个会话各留出一个完整的历史窗口（QWEN_HISTORY_TOKENS）
+PREFIX_CACHE_MB = os.environ.get('QWEN_PREFIX_CACHE_MB')
+PREFIX_CACHE_SESSIONS = int(os.environ.get('QWEN_PREFIX_CACHE_SESSIONS', 4))
+# 单次生成的token上限（请求指定的值不能超过它）与默认超时秒数（0表示不限时）
+MAX_NEW_TOKENS = int(os.environ.get('QWEN_MAX_NEW_TOKENS', 32768))
+GENERATION_TIMEOUT = float(os.environ.get('QWEN_GENERATION_TIMEOUT', 0))
+# 投机解码每步的最大候选token数，0表示不启用；启用后改为贪心解码，只在批次中只有一个请求时生效
+SPECULATIVE_TOKENS = int(os.environ.get('QWEN_SPECULATIVE_TOKENS', 0))
+# 启动预热：生成的token数与超时秒数，只用于触发一次完整的前向计算
+WARMUP_TOKENS = int(os.environ.get('QWEN_WARMUP_TOKENS', 8))
+WARMUP_TIMEOUT = float(os.environ.get('QWEN_WARMUP_TIMEOUT', 30))
+# CPU推理配置（default/int8/bf16）与生成解码的线程数（0表示按可用核数自动分配）
+INFERENCE_PROFILE = os.environ.get('QWEN_INFERENCE_PROFILE', os.environ.get('INFERENCE_PROFILE', 'default'))
+GENERATION_THREADS = int(os.environ.get('GENERATION_THREADS', 0))
+EMBEDDING_THREADS = int(os.environ.get('EMBEDDING_THREADS', 0))
 
-class QwenThread(ThreadPoolExecutor):
+QUEUE_DEPTH = Gauge('qwen_queue_depth', '等待进入解码批次的生成请求数')
+ACTIVE_REQUESTS = Gauge('qwen_active_requests', '正在解码批次中的生成请求数')
 
-    def __init__(self, **kwargs):
-        super(QwenThread, self).__init__(max_workers= 1,thread_name_prefix="test_",**kwargs)
-        if not os.path.exists("/model/Qwen/Qwen3-0___6B/model.safetensors"):
+
+class QwenThread:
+    """模型推理入口；生成任务由 QwenChatbot 的连续批处理调度器执行，多个请求可同时解码
+
+    on_stage(stage) 在进入 download / load / warmup 各阶段时调用，用于报告加载进度。
+    """
+
+    def __init__(self, on_stage=None):
+        on_stage = on_stage or (lambda stage: None)
+        on_stage('download')
+        if not os.path.exists(os.path.join(QWEN_MODEL_PATH, "model.safetensors")):
             print("没有发现模型文件，自动下载文件")
             from modelscope.hub.snapshot_download import snapshot_download
-            snapshot_download('Qwen/Qwen3-0.6B', cache_dir='/model/')
-        self.qwen = QwenChatbot(model_name="/model/Qwen/Qwen3-0___6B/")
-       
-        
-        input_message = ["测试", "1+1等于几？"]
-        for e in input_message:
-            self.qwen.generate_response(e)
+            snapshot_download('Qwen/Qwen3-0.6B', cache_dir=MODEL_DIR)
+        on_stage('load')
+        self.qwen = QwenChatbot(model_name=QWEN_MODEL_PATH, history_token_budget=HISTORY_TOKEN_BUDGET,
+                                max_batch_size=MAX_BATCH_SIZE, max_waiting=MAX_WAITING,
+                                prefix_cache_bytes=int(PREFIX_CACHE_MB) * 1024 * 1024 if PREFIX_CACHE_MB else None,
+                                prefix_cache_sessions=PREFIX_CACHE_SESSIONS,
+                                default_max_new_tokens=MAX_NEW_TOKENS,
+                                default_timeout=GENERATION_TIMEOUT or None,
+                                profile=INFERENCE_PROFILE,
+                                num_threads=thread_split(GENERATION_THREADS, EMBEDDING_THREADS)[0],
+                                speculative_tokens=SPECULATIVE_TOKENS)
+        QUEUE_DEPTH.set_function(lambda: self.qwen.scheduler.stats()['waiting'])
+        ACTIVE_REQUESTS.set_function(lambda: self.qwen.scheduler.stats()['active'])
 
-    # 流式对话接口
-    def stream_chat(self, text):
-        # 创建一个队列来接收流式输出
-        result_queue = queue.Queue()
-        
-        # 提交任务到线程池
-        self.submit(self.stream_infer, text, result_queue)
-        
-        # 从队列中读取结果并yield
-        while True:
-            item = result_queue.get()
-            if item is None:  # None表示结束
-                break
-            yield item
-            result_queue.task_done()
+        # 预热只生成少量token并限制时间，避免拖慢启动
+        on_stage('warmup')
+        self.qwen.generate_response("测试", max_new_tokens=WARMUP_TOKENS, timeout=WARMUP_TIMEOUT)
 
-    # 外部对话接口（保持兼容性）
-    def chat(self,text):
-        result =self.submit(self.infer, text)
-        return result.result()
-
-    def infer(self, text):
-        result_str = self.qwen.generate_response(text)
-        return result_str
-        
-    # 流式推理方法
-    def stream_infer(self, text, result_queue):
+    # 流式对话接口
+    def stream_chat(self, text, session_id=None, question=None, max_new_tokens=None, timeout=None, cancel_token=None):
+        generator = self.qwen.stream_generate_response(text, session_id=session_id, question=question,
+                                                       max_new_tokens=max_new_tokens, timeout=timeout,
+                                                       cancel_token=cancel_token)
         try:
-            # 调用QwenChatbot的流式生成方法
-            for chunk in self.qwen.stream_generate_response(text):
+            for chunk in generator:
                 if chunk:
-                    result_queue.put(chunk)
+                    yield chunk
         finally:
-            # 发送结束信号
-            result_queue.put(None)
+            # 调用方提前关闭时同步关闭内层生成器，使取消立即生效
+            generator.close()
+
+    # 外部对话接口（保持兼容性）
+    def chat(self, text, session_id=None, question=None, max_new_tokens=None, timeout=None, cancel_token=None):
+        return "".join(self.stream_chat(text, session_id=session_id, question=question,
+                                        max_new_tokens=max_new_tokens, timeout=timeout,
+                                        cancel_token=cancel_token))
+
+    @property
+    def tokenizer(self):
+        return self.qwen.tokenizer
 
+    def stats(self):
+        """调度器的队列深度、准入上限与前缀缓存命中率"""
+        return self.qwen.scheduler.stats()
@@ -0,0 +1,170 @@
+import os
+import re
+import logging
+from collections import Counter
+
+import numpy as np
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+# 拉丁字母/数字组成的单词，或连续的中日韩字符
+TOKEN_PATTERN = re.compile(r'[0-9a-z\u00c0-\u024f]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+
+
+def tokenize(text):
+    """BM25的检索词：英文按单词，中日韩文本按单字加相邻二字组合（无需分词词典）"""
+    tokens = []
+    for run in TOKEN_PATTERN.findall(text.lower()):
+        if run[0] < '\u3040':
+            tokens.append(run)
+        else:
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class SegmentPostings:
+    """一个数据段的倒排表（CSR格式）：检索词 -> 段内行号及词频，数据段不可变，倒排表也只写一次"""
+
+    def __init__(self, terms, indptr, rows, tfs, lengths):
+        self.terms = terms
+        self.indptr = indptr
+        self.rows = rows
+        self.tfs = tfs
+        self.lengths = lengths
+        self._lookup = None
+
+    @classmethod
+    def build(cls, chunks):
+        postings = {}
+        lengths = []
+        for row, chunk in enumerate(chunks):
+            tokens = tokenize(chunk)
+            lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((row, tf))
+        terms = sorted(postings)
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(postings[term]) for term in terms])
+        pairs = np.array([pair for term in terms for pair in postings[term]], dtype=np.int32).reshape(-1, 2)
+        return cls(np.array(terms, dtype=str), indptr, pairs[:, 0].copy(), pairs[:, 1].copy(),
+                   np.array(lengths, dtype=np.int32))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['terms'], data['indptr'], data['rows'], data['tfs'], data['lengths'])
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, terms=self.terms, indptr=self.indptr, rows=self.rows, tfs=self.tfs, lengths=self.lengths)
+        os.replace(tmp_path, path)
+
+    def postings(self, term):
+        """返回 (行号, 词频)，不包含该词时返回None"""
+        if self._lookup is None:
+            self._lookup = {term: i for i, term in enumerate(self.terms.tolist())}
+        i = self._lookup.get(term)
+        if i is None:
+            return None
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.rows[start:end], self.tfs[start:end]
+
+
+class SparseIndex:
+    """与向量数据段一一对应的BM25倒排索引，随文档的添加和删除增量更新
+
+    文档频率在查询时对各数据段求和，只涉及查询中出现的检索词。
+    """
+
+    def __init__(self):
+        self._segments = []  # (数据段, 倒排表)，顺序与存储中的数据段一致
+        self._doc_count = 0
+        self._total_length = 0
+
+    def open(self, segments):
+        """加载各数据段的倒排表，缺失的（旧版本数据）从文档块文本重新构建"""
+        self._segments, self._doc_count, self._total_length = [], 0, 0
+        for segment in segments:
+            path = segment.path('bm25.npz')
+            if os.path.exists(path):
+                self._append(segment, SegmentPostings.load(path))
+            else:
+                self.add(segment, segment.chunks())
+
+    def add(self, segment, chunks=None):
+        """加入一个数据段：给出文档块文本时构建并保存倒排表，否则读取写入数据段时已保存的倒排表"""
+        if chunks is None:
+            postings = SegmentPostings.load(segment.path('bm25.npz'))
+        else:
+            postings = SparseIndex.write(segment, chunks)
+        self._append(segment, postings)
+
+    @staticmethod
+    def write(segment, chunks):
+        """构建并保存数据段的倒排表（数据段提交之前），返回该倒排表"""
+        postings = SegmentPostings.build(chunks)
+        postings.save(segment.path('bm25.npz'))
+        return postings
+
+    def remove(self, segments):
+        removed = set(id(segment) for segment in segments)
+        kept = []
+        for segment, postings in self._segments:
+            if id(segment) in removed:
+                self._doc_count -= len(postings.lengths)
+                self._total_length -= int(postings.lengths.sum())
+            else:
+                kept.append((segment, postings))
+        self._segments = kept
+
+    def search(self, query, k):
+        """返回BM25得分最高的k个 (文档块id, 得分)，只包含得分大于0的块"""
+        terms = set(tokenize(query))
+        if not terms or self._doc_count == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        average_length = self._total_length / self._doc_count
+
+        # 每个检索词在各数据段中的倒排表，以及全局文档频率
+        matches = {}
+        for term in terms:
+            for i, (_, segment_postings) in enumerate(self._segments):
+                postings = segment_postings.postings(term)
+                if postings is not None:
+                    matches.setdefault(term, []).append((i, postings))
+
+        all_ids, all_scores = [], []
+        segment_scores = {}
+        for term, found in matches.items():
+            df = sum(len(rows) for _, (rows, _) in found)
+            idf = np.log(1 + (self._doc_count - df + 0.5) / (df + 0.5))
+            for i, (rows, tfs) in found:
+                segment, segment_postings = self._segments[i]
+                if i not in segment_scores:
+                    segment_scores[i] = np.zeros(segment.count, dtype=np.float32)
+                lengths = segment_postings.lengths[rows]
+                tfs = tfs.astype(np.float32)
+                segment_scores[i][rows] += idf * tfs * (BM25_K1 + 1) / (
+                    tfs + BM25_K1 * (1 - BM25_B + BM25_B * lengths / average_length))
+        for i, scores in segment_scores.items():
+            rows = np.flatnonzero(scores > 0)
+            all_ids.append(self._segments[i][0].first_id + rows)
+            all_scores.append(scores[rows])
+        if not all_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        ids, scores = np.concatenate(all_ids), np.concatenate(all_scores)
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            ids, scores = ids[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return ids[order], scores[order]
+
+    def _append(self, segment, postings):
+        self._segments.append((segment, postings))
+        self._doc_count += len(postings.lengths)
+        self._total_length += int(postings.lengths.sum())
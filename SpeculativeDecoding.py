@@ -0,0 +1,47 @@
+import logging
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 查找时使用的n-gram长度范围，优先匹配较长的n-gram
+MAX_NGRAM = 3
+MIN_NGRAM = 1
+
+
+class NgramDrafter:
+    """提示词查找（prompt lookup）草稿：用已有序列的末尾n-gram在提示词和已生成内容中查找，
+    取上一次出现位置之后的若干token作为候选
+
+    RAG的回答经常原样引用提示词中的文档片段，候选token命中率较高；候选由模型在一次前向计算中验证，
+    只接受与贪心解码结果一致的部分，因此不改变输出。
+    索引记录每个n-gram最近一次出现后的下一个位置，追加token时增量更新，查找为O(1)。
+    """
+
+    def __init__(self, tokens, max_ngram=MAX_NGRAM, min_ngram=MIN_NGRAM):
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self.tokens = []
+        self._next = {}  # n-gram -> 该n-gram最近一次出现后下一个token的位置
+        self.extend(tokens)
+
+    def extend(self, tokens):
+        for token in tokens:
+            position = len(self.tokens)
+            # 以新token之前为结尾的各个n-gram，下一个token就是新token
+            for n in range(self.min_ngram, self.max_ngram + 1):
+                if position >= n:
+                    self._next[tuple(self.tokens[position - n:position])] = position
+            self.tokens.append(token)
+
+    def draft(self, num_tokens):
+        """返回最多 num_tokens 个候选token，找不到匹配时返回空列表"""
+        if num_tokens <= 0:
+            return []
+        for n in range(self.max_ngram, self.min_ngram - 1, -1):
+            if len(self.tokens) < n:
+                continue
+            position = self._next.get(tuple(self.tokens[-n:]))
+            if position is not None:
+                return self.tokens[position:position + num_tokens]
+        return []
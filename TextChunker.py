@@ -0,0 +1,107 @@
+import re
+import logging
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 句子结尾：中英文句末标点（小数点除外）及其后的引号、括号和空白，或连续换行
+SENTENCE_END = re.compile(r'(?:[。！？!?]+|\.(?!\d))[”’"\'」』）)]*\s*|\n+')
+# 没有句末标点的文本累积到该长度时强制断开，避免缓冲区无限增长
+MAX_PENDING_CHARS = 4096
+DEFAULT_OVERLAP_TOKENS = 16
+
+
+class TokenChunker:
+    """按编码模型的token数分块：先按句子切分，再把句子贪心地装入不超过 max_tokens 的块
+
+    每个句子只分词一次，整个过程对文本单遍扫描；超过 max_tokens 的长句按token边界切开。
+    相邻块之间重叠 overlap_tokens 个token。
+    """
+
+    def __init__(self, encoder, max_tokens=None, overlap_tokens=DEFAULT_OVERLAP_TOKENS):
+        self.encoder = encoder
+        # 默认与编码模型的截断长度一致（扣除[CLS]/[SEP]等特殊token），保证块内文本全部参与编码
+        self.max_tokens = max_tokens or encoder.max_length - encoder.num_special_tokens
+        self.overlap_tokens = min(overlap_tokens, self.max_tokens // 2)
+
+    def split(self, records):
+        """对逐条到达的 (文本, 页码) 记录分块，产出 (文本块, 起始页, 结束页)"""
+        chunk = []      # 当前块中的片段：(文本, 每个token的起始字符位置, 页码)
+        chunk_tokens = 0
+        fresh = False   # 当前块是否含有重叠部分以外的新内容
+        chunk_count = 0
+
+        for piece in self._pieces(records):
+            tokens = len(piece[1])
+            if chunk_tokens + tokens > self.max_tokens and fresh:
+                text = "".join(text for text, _, _ in chunk).strip()
+                if text:
+                    chunk_count += 1
+                    yield text, chunk[0][2], chunk[-1][2]
+                chunk, chunk_tokens = self._overlap(chunk, min(self.overlap_tokens, self.max_tokens - tokens))
+                fresh = False
+            chunk.append(piece)
+            chunk_tokens += tokens
+            fresh = fresh or bool(piece[0].strip())
+
+        if fresh:
+            text = "".join(text for text, _, _ in chunk).strip()
+            if text:
+                chunk_count += 1
+                yield text, chunk[0][2], chunk[-1][2]
+        logger.info(f"文本分块完成，共生成 {chunk_count} 个块")
+
+    def _pieces(self, records):
+        """把记录切成句子，分词后产出不超过 max_tokens 的片段"""
+        pending, pending_page = "", None
+        for text, page in records:
+            if not text:
+                continue
+            # 上一条记录末尾未结束的句子与本条记录拼接，句子的页码取其起始位置所在的页
+            carried = len(pending)
+            if not carried:
+                pending_page = page
+            text = pending + text
+            sentences, pages, position = [], [], 0
+            for match in SENTENCE_END.finditer(text):
+                sentences.append(text[position:match.end()])
+                pages.append(pending_page if position < carried else page)
+                position = match.end()
+            pending = text[position:]
+            pending_page = pending_page if position < carried else page
+            if len(pending) > MAX_PENDING_CHARS:
+                sentences.append(pending)
+                pages.append(pending_page)
+                pending = ""
+            yield from self._tokenize(sentences, pages)
+        if pending:
+            yield from self._tokenize([pending], [pending_page])
+
+    def _tokenize(self, sentences, pages):
+        if not sentences:
+            return
+        for sentence, starts, page in zip(sentences, self.encoder.token_offsets(sentences), pages):
+            # 长句按token边界切成多个片段
+            for begin in range(0, max(len(starts), 1), self.max_tokens):
+                piece_starts = starts[begin:begin + self.max_tokens]
+                start = piece_starts[0] if begin else 0
+                end = starts[begin + self.max_tokens] if begin + self.max_tokens < len(starts) else len(sentence)
+                yield sentence[start:end], [offset - start for offset in piece_starts], page
+
+    def _overlap(self, chunk, overlap_tokens):
+        """取上一个块末尾的 overlap_tokens 个token作为下一个块的开头"""
+        if overlap_tokens <= 0:
+            return [], 0
+        overlap, tokens = [], 0
+        for text, starts, page in reversed(chunk):
+            need = overlap_tokens - tokens
+            if len(starts) >= need:
+                cut = starts[len(starts) - need]
+                overlap.append((text[cut:], [offset - cut for offset in starts[len(starts) - need:]], page))
+                tokens += need
+                break
+            overlap.append((text, starts, page))
+            tokens += len(starts)
+        overlap.reverse()
+        return overlap, tokens
@@ -0,0 +1,239 @@
+import logging
+
+import numpy as np
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 数据段中向量的存储编码：float32（原始精度）、float16、int8（按维度缩放的标量量化）、pq（乘积量化）
+ENCODINGS = ('float32', 'float16', 'int8', 'pq')
+# 检索时每次解码的行数，限制临时float32矩阵的大小
+DECODE_BLOCK_ROWS = 8192
+# 乘积量化：每个子空间的维数、每个子空间的聚类中心数上限，以及每个聚类中心至少对应的训练向量数
+PQ_SUBVECTOR_DIM = 4
+PQ_MAX_CENTROIDS = 256
+PQ_POINTS_PER_CENTROID = 8
+PQ_TRAIN_ITERATIONS = 10
+PQ_MAX_TRAIN_VECTORS = 4096
+
+
+class Codec:
+    """向量编码器：训练参数保存在数据段的codec.npz中，编码后的数据段只读"""
+    encoding = None
+
+    @classmethod
+    def train(cls, vectors):
+        return cls()
+
+    def encode(self, vectors):
+        raise NotImplementedError
+
+    def decode(self, codes):
+        raise NotImplementedError
+
+    def params(self):
+        """需要持久化的参数（numpy数组）"""
+        return {}
+
+    @property
+    def nbytes(self):
+        return sum(value.nbytes for value in self.params().values())
+
+    def scores(self, codes, queries, norms):
+        """返回 ||x||² - 2x·q（与精确检索相同，不含查询向量自身的范数），x为解码后的向量
+
+        默认逐块解码后做矩阵乘法，临时矩阵不超过 DECODE_BLOCK_ROWS 行。
+        """
+        scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), DECODE_BLOCK_ROWS):
+            vectors = self.decode(codes[start:start + DECODE_BLOCK_ROWS])
+            scores[:, start:start + len(vectors)] = norms[start:start + len(vectors)] - 2.0 * (queries @ vectors.T)
+        return scores
+
+    def squared_norms(self, codes):
+        norms = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), DECODE_BLOCK_ROWS):
+            vectors = self.decode(codes[start:start + DECODE_BLOCK_ROWS])
+            norms[start:start + len(vectors)] = np.einsum('ij,ij->i', vectors, vectors)
+        return norms
+
+
+class Float16Codec(Codec):
+    encoding = 'float16'
+
+    def encode(self, vectors):
+        return np.asarray(vectors, dtype=np.float16)
+
+    def decode(self, codes):
+        return np.asarray(codes, dtype=np.float32)
+
+
+class Int8Codec(Codec):
+    """每个维度按数据段内的最小值和取值范围线性映射到0~255"""
+    encoding = 'int8'
+
+    def __init__(self, offset, scale):
+        self.offset = np.asarray(offset, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+
+    @classmethod
+    def train(cls, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return cls(np.zeros(vectors.shape[1]), np.ones(vectors.shape[1]))
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        scale = (high - low) / 255.0
+        # 取值恒定的维度只需要offset
+        scale[scale == 0] = 1.0
+        return cls(low, scale)
+
+    def encode(self, vectors):
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - self.offset) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        return self.offset + np.asarray(codes, dtype=np.float32) * self.scale
+
+    def params(self):
+        return {'offset': self.offset, 'scale': self.scale}
+
+
+class PQCodec(Codec):
+    """乘积量化：向量按维度切分为若干子空间，每个子空间用最近的聚类中心编号（1字节）表示
+
+    聚类中心按 (中心数, 维数) 存放，第j个子空间的码本是 centroids[:, bounds[j]:bounds[j+1]]。
+    检索时对每个查询先算出各子空间到全部中心的距离表，再按编号查表求和，不需要解码。
+    """
+    encoding = 'pq'
+
+    def __init__(self, centroids, bounds):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.bounds = np.asarray(bounds, dtype=np.int64)
+
+    @classmethod
+    def train(cls, vectors, subvector_dim=PQ_SUBVECTOR_DIM, seed=0):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        dimension = vectors.shape[1]
+        bounds = np.linspace(0, dimension, max(1, dimension // subvector_dim) + 1).round().astype(np.int64)
+        # 向量较少时减少中心数，码本不至于比数据本身还大
+        num_centroids = min(PQ_MAX_CENTROIDS, len(vectors), max(len(vectors) // PQ_POINTS_PER_CENTROID, 16))
+        if num_centroids == 0:
+            return cls(np.zeros((1, dimension)), bounds)
+
+        rng = np.random.default_rng(seed)
+        sample = vectors
+        if len(vectors) > PQ_MAX_TRAIN_VECTORS:
+            sample = vectors[np.sort(rng.choice(len(vectors), PQ_MAX_TRAIN_VECTORS, replace=False))]
+        centroids = np.empty((num_centroids, dimension), dtype=np.float32)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            centroids[:, start:end] = _kmeans(np.ascontiguousarray(sample[:, start:end]), num_centroids, rng)
+        return cls(centroids, bounds)
+
+    def _subspaces(self):
+        return zip(self.bounds[:-1], self.bounds[1:])
+
+    def encode(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        # 按列存放，检索时逐个子空间查表读取的是连续内存
+        codes = np.empty((len(vectors), len(self.bounds) - 1), dtype=np.uint8, order='F')
+        for j, (start, end) in enumerate(self._subspaces()):
+            for row in range(0, len(vectors), DECODE_BLOCK_ROWS):
+                codes[row:row + DECODE_BLOCK_ROWS, j] = _nearest(vectors[row:row + DECODE_BLOCK_ROWS, start:end],
+                                                                 self.centroids[:, start:end])
+        return codes
+
+    def decode(self, codes):
+        codes = np.asarray(codes)
+        vectors = np.empty((len(codes), self.centroids.shape[1]), dtype=np.float32)
+        for j, (start, end) in enumerate(self._subspaces()):
+            vectors[:, start:end] = self.centroids[codes[:, j], start:end]
+        return vectors
+
+    def params(self):
+        return {'centroids': self.centroids, 'bounds': self.bounds}
+
+    def scores(self, codes, queries, norms=None):
+        # 各子空间的 ||c||² - 2q·c 查表求和，即 ||x||² - 2x·q
+        scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for j, (start, end) in enumerate(self._subspaces()):
+            centroids = self.centroids[:, start:end]
+            table = np.einsum('ij,ij->i', centroids, centroids) - 2.0 * (queries[:, start:end] @ centroids.T)
+            scores += table[:, np.asarray(codes[:, j])]
+        return scores
+
+    def squared_norms(self, codes):
+        return None  # 查表得分已包含范数
+
+
+CODECS = {'float16': Float16Codec, 'int8': Int8Codec, 'pq': PQCodec}
+
+
+class EncodedVectors:
+    """一个数据段编码后的向量（通常是内存映射的编码数组），可直接在编码上计算检索得分"""
+
+    def __init__(self, codec, codes):
+        self.codec = codec
+        self.codes = codes
+        self._norms = None
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows):
+        return EncodedVectors(self.codec, np.asarray(self.codes[rows]))
+
+    def __array__(self, dtype=None, copy=None):
+        vectors = self.codec.decode(self.codes)
+        return vectors if dtype is None else vectors.astype(dtype, copy=False)
+
+    @property
+    def encoding(self):
+        return self.codec.encoding
+
+    @property
+    def nbytes(self):
+        """编码和码本占用的字节数"""
+        return self.codes.nbytes + self.codec.nbytes
+
+    def scores(self, queries):
+        if self._norms is None:
+            self._norms = self.codec.squared_norms(self.codes)
+        return self.codec.scores(self.codes, queries, self._norms)
+
+
+def train_codec(encoding, vectors):
+    """用一个数据段的向量训练编码器；float32 不需要编码器，返回None"""
+    if encoding == 'float32':
+        return None
+    if encoding not in CODECS:
+        raise ValueError(f"不支持的向量编码: {encoding}")
+    return CODECS[encoding].train(vectors)
+
+
+def load_codec(encoding, params):
+    """根据编码类型和codec.npz中的参数恢复编码器"""
+    if encoding not in CODECS:
+        raise ValueError(f"不支持的向量编码: {encoding}")
+    return CODECS[encoding](**{name: params[name] for name in params.files})
+
+
+def _nearest(data, centroids):
+    """每一行最近的聚类中心编号"""
+    return (np.einsum('ij,ij->i', centroids, centroids) - 2.0 * (data @ centroids.T)).argmin(axis=1)
+
+
+def _kmeans(data, k, rng, iterations=PQ_TRAIN_ITERATIONS):
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest(data, centroids)
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        for d in range(data.shape[1]):
+            sums = np.bincount(assign, weights=data[:, d], minlength=k)
+            centroids[filled, d] = sums[filled] / counts[filled]
+        # 空簇重新取一个随机样本作为中心
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), len(empty))]
+    return centroids
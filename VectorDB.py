@@ -1,22 +1,45 @@
-
-
-import json
 import numpy as np
-from modelscope.hub.snapshot_download import snapshot_download
 from datetime import datetime
-from safetensors.torch import save_file
-import torch
 import os
+import time
 import logging
-from transformers import AutoTokenizer, AutoModel
+import threading
+
+from EmbeddingModel import get_embedding_encoder
+from VectorIndex import build_index, choose_backend, load_index
+from VectorStorage import SegmentStorage
+from TextChunker import TokenChunker, DEFAULT_OVERLAP_TOKENS
+from SparseIndex import SparseIndex
+from QueryCache import LRUCache, normalize_query
+from Metrics import Histogram
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 检索方式：dense（向量）、sparse（BM25关键词）、hybrid（两者按倒数排名融合）
+RETRIEVAL_MODES = ('dense', 'sparse', 'hybrid')
+# 倒数排名融合的平滑常数，以及融合时每一路多取的候选倍数
+RRF_K = 60
+HYBRID_CANDIDATE_FACTOR = 4
+
+EMBEDDING_BATCH_SECONDS = Histogram('embedding_batch_seconds', '文档块批量编码耗时（只统计未命中缓存、实际编码的块）')
+EMBEDDING_RATE = Histogram('embedding_chunks_per_second', '文档块批量编码速度',
+                           buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+SEARCH_SECONDS = Histogram('vector_search_seconds', '检索耗时，按检索方式、文档块总数量级和是否命中结果缓存统计',
+                           labelnames=('mode', 'corpus', 'cached'))
+# 检索耗时按文档块总数分组的上界
+SEARCH_CORPUS_BUCKETS = (1000, 10000, 100000, 1000000)
+
 class VectorDatabase:
-    def __init__(self, session_id):
-        """初始化向量数据库"""
+    def __init__(self, session_id, encoder=None, index_backend='auto', embedding_cache=None, query_cache=None,
+                 result_cache_size=256, vector_encoding='float32', rescore_factor=0):
+        """初始化向量数据库
+
+        vector_encoding 是新数据段的向量编码（float32/float16/int8/pq）；
+        rescore_factor 大于0时压缩编码的数据段同时保存float32原始向量，精确检索先按编码取
+        top_k×rescore_factor 个候选，再用原始向量重新计算距离。
+        """
         self.session_id = session_id
     
         self.db_path = os.path.join('vector_db', session_id)
@@ -24,295 +47,322 @@ class VectorDatabase:
         os.makedirs(self.db_path, exist_ok=True)
         
 
-        # 初始化嵌入模型 - 使用modelscope的文本嵌入模型
-        # 首先尝试从本地加载模型，如果不存在则下载
-        local_model_path = '/model/damo/nlp_corom_sentence-embedding_english-base'
-        
-        if not os.path.exists(local_model_path):
-            logger.info(f"本地模型不存在，正在下载到 {local_model_path}")
-            from modelscope.hub.snapshot_download import snapshot_download
-            local_model_path = snapshot_download('damo/nlp_corom_sentence-embedding_english-base', cache_dir='/model')
-            state_dict = torch.load(os.path.join(local_model_path, 'pytorch_model.bin'), map_location='cpu')
-            save_file(state_dict, os.path.join(local_model_path, 'model.safetensors'))
-        else:
-            logger.info(f"使用本地模型: {local_model_path}")
-        
-        # 使用AutoTokenizer.from_pretrained和AutoModel.from_pretrained加载模型
-        
-        # 加载tokenizer和模型
-        logger.info(f"开始读取: {local_model_path}")
-        self.tokenizer = AutoTokenizer.from_pretrained(local_model_path)
-        self.model = AutoModel.from_pretrained(local_model_path)
-        self.model.to('cpu')
-        self.model.eval()
-        logger.info(f"读取完成: {local_model_path}")
-        # 创建自定义的嵌入pipeline函数
-        def embedding_pipeline(text):
-            # 使用tokenizer编码文本
-            inputs = self.tokenizer(
-                text,
-                padding=True,
-                truncation=True,
-                max_length=128,
-                return_tensors='pt'
-            )
-            
-            # 将输入移至CPU
-            inputs = {k: v.to('cpu') for k, v in inputs.items()}
-            
-            # 模型推理
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-            
-            # 提取嵌入向量（通常使用最后一层隐藏状态的平均值）
-            # 不同模型可能有不同的提取方式，这里尝试几种常见方式
-            if hasattr(outputs, 'sentence_embedding'):
-                embedding = outputs.sentence_embedding
-            elif hasattr(outputs, 'pooler_output'):
-                embedding = outputs.pooler_output
-            elif hasattr(outputs, 'last_hidden_state'):
-                # 取最后一层隐藏状态的平均值作为句子嵌入
-                embedding = outputs.last_hidden_state.mean(dim=1)
-            else:
-                # 如果以上都没有，使用模型输出的第一个元素（兜底方案）
-                embedding = list(outputs.values())[0].mean(dim=1)
-            
-            # 转换为numpy数组
-            embedding = embedding.cpu().numpy().squeeze()
-            
-            # 返回与原pipeline相同的格式
-            return {'sentence_embedding': embedding}
-        
-        # 设置自定义的embedding_pipeline
-        self.embedding_pipeline = embedding_pipeline
-        logger.info(f"成功使用AutoTokenizer和AutoModel加载模型并创建嵌入pipeline")
-       
-        # 初始化向量存储
-        self.dimension = 768  # modelscope模型的输出维度
-        self.vectors = np.array([])  # 存储所有向量
-        
-        # 存储文档块和元数据
-        self.document_chunks = []
-        self.document_metadata = []
+        # 使用进程内共享的嵌入模型，避免每次请求重复加载
+        self.encoder = encoder if encoder is not None else get_embedding_encoder()
+        self.embedding_pipeline = self.encoder.embedding_pipeline
+        # 跨会话共享的文档块嵌入向量缓存（可选）
+        self.embedding_cache = embedding_cache
+        # 查询向量缓存（可跨会话共享）与本会话的检索结果缓存；数据库每次变更时版本号加一并清空结果缓存
+        self.query_cache = query_cache if query_cache is not None else LRUCache(0)
+        self.result_cache = LRUCache(result_cache_size)
+        self.version = 0
+
+        # 同一会话的数据库可能被多个请求并发访问
+        self.lock = threading.RLock()
+
+        # 追加式磁盘存储：每个文档一个内存映射的数据段
+        self.dimension = self.encoder.dimension
+        self.vector_encoding = vector_encoding
+        self.rescore_factor = rescore_factor
+        self.storage = self._open_storage()
+
+        # 检索索引（flat/ivf/hnsw），以稳定的文档块id标识向量
+        self.index_backend = index_backend
+        self.index = None
+        # 与数据段一一对应的BM25倒排索引
+        self.sparse_index = SparseIndex()
         
         # 尝试加载已有的向量数据库
         self.load()
     
     def load(self):
-        """从文件加载向量数据库，如果文件不存在则创建空数据库"""
-        vectors_path = os.path.join(self.db_path, 'vectors.npy')
-        chunks_path = os.path.join(self.db_path, 'document_chunks.json')
-        metadata_path = os.path.join(self.db_path, 'document_metadata.json')
-        
-        if os.path.exists(vectors_path) and os.path.exists(chunks_path) and os.path.exists(metadata_path):
-            try:
-                self.vectors = np.load(vectors_path)
-                with open(chunks_path, 'r', encoding='utf-8') as f:
-                    self.document_chunks = json.load(f)
-                with open(metadata_path, 'r', encoding='utf-8') as f:
-                    self.document_metadata = json.load(f)
-                logger.info(f"成功加载向量数据库，包含 {len(self.document_chunks)} 个文档块")
-            except Exception as e:
-                logger.error(f"加载向量数据库失败: {str(e)}")
-                # 加载失败时创建空数据库
-                self._create_empty_database(vectors_path, chunks_path, metadata_path)
-        else:
-            logger.info(f"向量数据库文件不存在，正在创建新的空数据库: {self.db_path}")
-            # 创建空数据库文件
-            self._create_empty_database(vectors_path, chunks_path, metadata_path)
-    
-    def _create_empty_database(self, vectors_path, chunks_path, metadata_path):
-        """创建空的向量数据库文件"""
+        """打开磁盘上的向量数据库（不存在则创建空数据库），并加载或重建索引"""
         try:
-            # 保存空的向量数组
-            np.save(vectors_path, np.array([]))
-            
-            # 保存空的文档块列表
-            with open(chunks_path, 'w', encoding='utf-8') as f:
-                json.dump([], f, ensure_ascii=False, indent=2)
-            
-            # 保存空的文档元数据列表
-            with open(metadata_path, 'w', encoding='utf-8') as f:
-                json.dump([], f, ensure_ascii=False, indent=2)
-            
-            logger.info(f"成功创建空的向量数据库文件")
-            
-            # 从新创建的文件中加载数据
-            logger.info(f"正在从新创建的文件中加载向量数据库")
-            self.vectors = np.load(vectors_path)
-            with open(chunks_path, 'r', encoding='utf-8') as f:
-                self.document_chunks = json.load(f)
-            with open(metadata_path, 'r', encoding='utf-8') as f:
-                self.document_metadata = json.load(f)
-            logger.info(f"成功从新创建的文件中加载向量数据库")
+            self.storage.open()
         except Exception as e:
-            logger.error(f"创建或加载空向量数据库文件失败: {str(e)}")
-            # 加载失败时初始化内存中的数据结构作为后备方案
-            self.vectors = np.array([])
-            self.document_chunks = []
-            self.document_metadata = []
+            logger.error(f"加载向量数据库失败: {str(e)}")
+            # 加载失败时使用空的数据库
+            self.storage = self._open_storage()
+            os.makedirs(self.storage.segment_dir, exist_ok=True)
+        self.sparse_index.open(self.storage.segments)
+
+        backend = choose_backend(len(self.storage), self.index_backend)
+        # 旧版本数据迁移后文档块id重新分配，原有索引文件不再可用
+        if not self.storage.migrated:
+            self.index = load_index(self.db_path, self.dimension, backend, len(self.storage))
+        if self.index is None:
+            self._rebuild_index(backend)
+
+    def _open_storage(self):
+        return SegmentStorage(self.db_path, self.dimension, encoding=self.vector_encoding,
+                              keep_full_precision=self.rescore_factor > 0)
+
+    def _sync_storage(self):
+        """写入前重新读取manifest；数据段被其他实例或进程修改过时，重建BM25和检索索引"""
+        if self.storage.reload():
+            self.sparse_index.open(self.storage.segments)
+            self._rebuild_index(choose_backend(len(self.storage), self.index_backend))
+            self._store_changed()
+
+    def _rebuild_index(self, backend):
+        """用全部数据段的向量重建索引"""
+        blocks = [(segment.vectors, segment.ids, segment.full_vectors) for segment in self.storage.segments]
+        self.index = build_index(backend, self.dimension, blocks, rescore_factor=self.rescore_factor)
+        logger.info(f"已构建 {backend} 索引，包含 {len(self.index)} 个向量")
+
+    def _maybe_rebuild_index(self):
+        """文档块数量跨过阈值或墓碑过多时切换/重建索引"""
+        backend = choose_backend(len(self.storage), self.index_backend)
+        if backend != self.index.backend or self.index.needs_rebuild():
+            self._rebuild_index(backend)
             
     def save(self):
-        """保存向量数据库到文件"""
-        vectors_path = os.path.join(self.db_path, 'vectors.npy')
-        chunks_path = os.path.join(self.db_path, 'document_chunks.json')
-        metadata_path = os.path.join(self.db_path, 'document_metadata.json')
-        
+        """保存检索索引；文档数据在写入数据段时已经持久化"""
         try:
-            if len(self.vectors) > 0:
-                np.save(vectors_path, self.vectors)
-            with open(chunks_path, 'w', encoding='utf-8') as f:
-                json.dump(self.document_chunks, f, ensure_ascii=False, indent=2)
-            with open(metadata_path, 'w', encoding='utf-8') as f:
-                json.dump(self.document_metadata, f, ensure_ascii=False, indent=2)
-            logger.info(f"成功保存向量数据库，包含 {len(self.document_chunks)} 个文档块")
+            self.index.save(self.db_path)
+            logger.info(f"成功保存向量数据库索引，包含 {len(self.storage)} 个文档块")
         except Exception as e:
-            logger.error(f"保存向量数据库失败: {str(e)}")
+            logger.error(f"保存向量数据库索引失败: {str(e)}")
     
-    def split_text(self, text, chunk_size=500, chunk_overlap=50):
-        """将文本分块"""
-        logger.info(f"开始文本分块，文本长度: {len(text)}, 块大小: {chunk_size}, 重叠大小: {chunk_overlap}")
-        
-        chunks = []
-        start = 0
-        text_length = len(text)
-        
-        while start < text_length:
-            end = min(start + chunk_size, text_length)
-            # 尝试在句子边界处分割
-            if end < text_length:
-                # 寻找最近的句号、问号、感叹号或换行符
-                punctuation_positions = [text.rfind(p, start, end) for p in ['.', '?', '!', '\n']]
-                punctuation_positions = [pos for pos in punctuation_positions if pos > start + chunk_size * 0.5]  # 确保至少分割了一半
-                
-                if punctuation_positions:
-                    end = max(punctuation_positions) + 1  # +1 包含标点符号
-                    logger.debug(f"在句子边界处分割，调整结束位置: {end}")
-            
-            chunk = text[start:end].strip()
-            chunks.append(chunk)
-            logger.debug(f"生成文本块，起始位置: {start}, 结束位置: {end}, 块长度: {len(chunk)}")
-            
-            # 确保start向前移动至少一个字符，避免无限循环
-            start = max(start + 1, end - chunk_overlap)  # 设置下一个块的起始位置，包含重叠
-            logger.debug(f"更新下一个块的起始位置: {start}")
-        
-        logger.info(f"文本分块完成，共生成 {len(chunks)} 个块")
-        return chunks
+    def split_text(self, text, chunk_tokens=None, overlap_tokens=DEFAULT_OVERLAP_TOKENS):
+        """将文本分块，块长度以编码模型的token计，默认等于模型的截断长度"""
+        logger.info(f"开始文本分块，文本长度: {len(text)}")
+        return [chunk for chunk, _, _ in self.split_records([(text, None)], chunk_tokens, overlap_tokens)]
+
+    def split_records(self, records, chunk_tokens=None, overlap_tokens=DEFAULT_OVERLAP_TOKENS):
+        """对逐条到达的 (文本, 页码) 记录增量分块，产出 (文本块, 起始页, 结束页)"""
+        return TokenChunker(self.encoder, chunk_tokens, overlap_tokens).split(records)
     
     def add_document(self, filename, content):
         """添加文档到向量数据库"""
         logger.info(f"开始添加文档: {filename}")
-        # 检查文件是否已经存在
-        existing_indices = [i for i, meta in enumerate(self.document_metadata) if meta['filename'] == filename]
-        if existing_indices:
-            logger.info(f"检测到文档已存在，将替换旧版本: {filename}")
-            # 删除已存在的文档块
-            for i in sorted(existing_indices, reverse=True):
-                del self.document_chunks[i]
-                del self.document_metadata[i]
-            
-            # 重新构建向量存储
-            if self.document_chunks:
-                embeddings = [self.embedding_pipeline(chunk)['sentence_embedding'] for chunk in self.document_chunks]
-                self.vectors = np.array(embeddings)
-            else:
-                self.vectors = np.array([])
-        
         # 分块处理文档内容
         chunks = self.split_text(content)
         logger.info(f"文档分块完成，共分成 {len(chunks)} 个块")
         if not chunks:
             logger.warning(f"文档分块失败: {filename}")
             return False
-        
-        # 为每个文档块生成嵌入向量
-        embeddings = [self.embedding_pipeline(chunk)['sentence_embedding'] for chunk in chunks]
-        
-        # 添加到向量存储
-        if len(self.vectors) == 0:
-            self.vectors = np.array(embeddings)
+
+        # 批量生成文档块的嵌入向量（编码期间不占用数据库锁，检索请求不受影响）
+        embeddings, reused = self.embed_chunks(chunks)
+        logger.info(f"文档块嵌入缓存命中率: {reused / len(chunks):.1%}（{reused}/{len(chunks)}）")
+        return self.add_chunks(filename, chunks, embeddings)
+
+    def embed_chunks(self, chunks):
+        """生成文档块的嵌入向量，返回 (向量矩阵, 无需重新编码的块数)
+
+        相同文本的块只编码一次；配置了嵌入缓存时先查缓存，新编码的向量写回缓存。
+        """
+        if self.embedding_cache is None:
+            keys = chunks
+            cached = {}
         else:
-            self.vectors = np.vstack([self.vectors, np.array(embeddings)])
-        
-        # 保存文档块和元数据
-        current_time = datetime.now().isoformat()
-        for i, chunk in enumerate(chunks):
-            self.document_chunks.append(chunk)
-            self.document_metadata.append({
-                'filename': filename,
-                'chunk_index': i,
-                'total_chunks': len(chunks),
-                'timestamp': current_time
-            })
+            keys = [self.embedding_cache.key(self.encoder, chunk) for chunk in chunks]
+            cached = self.embedding_cache.get_many(keys)
+
+        # 未命中的键去重后批量编码
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in cached and key not in missing:
+                missing[key] = i
+        if missing:
+            start = time.perf_counter()
+            vectors = self.encoder.encode_batch([chunks[i] for i in missing.values()])
+            seconds = time.perf_counter() - start
+            EMBEDDING_BATCH_SECONDS.observe(seconds)
+            if seconds > 0:
+                EMBEDDING_RATE.observe(len(missing) / seconds)
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many(list(missing), vectors)
+            cached.update(zip(missing, vectors))
+
+        embeddings = np.zeros((len(chunks), self.dimension), dtype=np.float32)
+        for i, key in enumerate(keys):
+            embeddings[i] = cached[key]
+        return embeddings, len(chunks) - len(missing)
+
+    def add_chunks(self, filename, chunks, embeddings, pages=None):
+        """写入已编码好的文档块，同名文档的旧版本会被替换；pages 为每个块的 (起始页, 结束页)"""
+        return self.add_segments(filename, [self.write_segment(filename, chunks, embeddings, pages=pages)])
+
+    def write_segment(self, filename, chunks, embeddings, pages=None):
+        """把一批已编码的文档块写成一个未提交的数据段（含BM25倒排表），不占用数据库锁
+
+        大文档分批写入多个数据段，全部写完后用 add_segments 一次提交；入库失败时用 discard_segments 删除。
+        """
+        segment = self.storage.write_segment(filename, embeddings, chunks, datetime.now().isoformat(), pages=pages)
+        SparseIndex.write(segment, chunks)
+        return segment
+
+    def add_segments(self, filename, segments):
+        """提交同一文档已写入的数据段；同名文档的旧版本在同一次manifest写入中被替换，检索不会看到只写了一部分的文档"""
+        with self.lock:
+            self._sync_storage()
+            # 检查文件是否已经存在，只移除旧版本的数据段，保留其他文档已有的嵌入向量
+            existing_segments = self.storage.segments_for(filename)
+            if existing_segments:
+                logger.info(f"检测到文档已存在，将替换旧版本: {filename}")
+                self.index.remove(np.concatenate([segment.ids for segment in existing_segments]))
+                self.sparse_index.remove(existing_segments)
+
+            # 提交新的数据段，并把内存映射的向量增量加入索引
+            self.storage.commit(segments, replaced=existing_segments)
+            self._store_changed()
+            for segment in segments:
+                self.index.add(segment.vectors, segment.ids, segment.full_vectors)
+                self.sparse_index.add(segment)
+            self._maybe_rebuild_index()
         
-        # 保存数据库
-        self.save()
+            # 保存索引
+            self.save()
         
-        logger.info(f"文档添加成功: {filename}")
-        return True
+            logger.info(f"文档添加成功: {filename}，共 {sum(segment.count for segment in segments)} 个文档块、"
+                        f"{len(segments)} 个数据段")
+            return True
+
+    def discard_segments(self, segments):
+        """删除写入后未提交的数据段"""
+        self.storage.discard(segments)
     
-    def search(self, query, top_k=5):
+    def search(self, query, top_k=5, mode='dense'):
         """搜索与查询最相关的文档块"""
-        if len(self.document_chunks) == 0:
-            return []
-        
-        # 生成查询向量
-        query_embedding = self.embedding_pipeline(query)['sentence_embedding']
-        
-        # 计算查询向量与所有存储向量的L2距离
-        distances = np.linalg.norm(self.vectors - query_embedding, axis=1)
-        
-        # 获取距离最小的top_k个索引
-        k = min(top_k, len(self.document_chunks))
-        indices = np.argsort(distances)[:k]
-        
-        # 构建结果列表
-        results = []
-        for idx in indices:
-            results.append({
-                'content': self.document_chunks[idx],
-                'metadata': self.document_metadata[idx],
-                'distance': float(distances[idx])
-            })
-        
-        return results
+        return self.search_many([query], top_k=top_k, mode=mode)[0]
+
+    def search_many(self, queries, top_k=5, mode='dense'):
+        """批量搜索，查询向量一次性批量编码，检索也在一次矩阵运算中完成
+
+        mode 见 RETRIEVAL_MODES；结果中的 distance 为向量距离（未被向量检索召回时为None），
+        score 为BM25得分（sparse）或融合得分（hybrid）。
+        """
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"不支持的检索方式: {mode}")
+        start = time.perf_counter()
+        with self.lock:
+            total = len(self.storage)
+            if total == 0:
+                return [[] for _ in queries]
+
+            # 重复或仅有空白差异的问题直接返回缓存的检索结果
+            queries = [normalize_query(query) for query in queries]
+            keys = [(self.version, query, top_k, mode) for query in queries]
+            all_results = [self.result_cache.get(key) for key in keys]
+            pending = [i for i, results in enumerate(all_results) if results is None]
+            if pending:
+                computed = self._search([queries[i] for i in pending], top_k, mode, total)
+                for i, results in zip(pending, computed):
+                    self.result_cache.put(keys[i], results)
+                    all_results[i] = results
+            SEARCH_SECONDS.observe(time.perf_counter() - start, mode=mode, corpus=_corpus_label(total),
+                                   cached=str(not pending).lower())
+            # 返回副本，调用方修改结果不会影响缓存
+            return [[dict(result) for result in results] for results in all_results]
+
+    def _search(self, queries, top_k, mode, total):
+        """在已加锁的情况下检索，返回每个查询的结果列表"""
+        # 融合时每一路多取一些候选
+        k = min(top_k * HYBRID_CANDIDATE_FACTOR if mode == 'hybrid' else top_k, total)
+        dense = [{} for _ in queries]
+        sparse = [{} for _ in queries]
+        if mode != 'sparse':
+            # 批量生成查询向量，通过索引检索距离最小的k个文档块
+            query_embeddings = self._encode_queries(queries)
+            all_distances, all_ids = self.index.search(query_embeddings, k)
+            dense = [{int(chunk_id): float(distance) for chunk_id, distance in zip(ids, distances) if chunk_id >= 0}
+                     for distances, ids in zip(all_distances, all_ids)]
+        if mode != 'dense':
+            sparse = [dict(zip(*self.sparse_index.search(query, k))) for query in queries]
+    
+        # 构建结果列表，文档块id映射回所在数据段
+        all_results = []
+        for dense_hits, sparse_hits in zip(dense, sparse):
+            if mode == 'dense':
+                ranked = [(chunk_id, None) for chunk_id in dense_hits]
+            elif mode == 'sparse':
+                ranked = list(sparse_hits.items())
+            else:
+                ranked = _reciprocal_rank_fusion([list(dense_hits), list(sparse_hits)])[:top_k]
+            results = []
+            for chunk_id, score in ranked:
+                segment, local_index = self.storage.locate(int(chunk_id))
+                results.append({
+                    'content': segment.chunk(local_index),
+                    'metadata': segment.metadata(local_index),
+                    'distance': dense_hits.get(chunk_id),
+                    'score': None if score is None else float(score)
+                })
+            all_results.append(results)
+    
+        return all_results
+    
+    def _encode_queries(self, queries):
+        """生成查询向量，命中查询向量缓存的不再重新编码"""
+        query_embeddings = [self.query_cache.get((self.encoder.model_id, query)) for query in queries]
+        missing = [i for i, embedding in enumerate(query_embeddings) if embedding is None]
+        if missing:
+            encoded = self.encoder.encode_batch([queries[i] for i in missing])
+            for i, embedding in zip(missing, encoded):
+                self.query_cache.put((self.encoder.model_id, queries[i]), embedding)
+                query_embeddings[i] = embedding
+        return np.stack(query_embeddings)
     
     def get_all_documents(self):
         """获取所有文档的元数据"""
-        documents = {}
-        for i, meta in enumerate(self.document_metadata):
-            filename = meta['filename']
-            if filename not in documents:
-                documents[filename] = {
-                    'filename': filename,
-                    'chunk_count': sum(1 for m in self.document_metadata if m['filename'] == filename),
-                    'upload_time': meta['timestamp']
-                }
-        
-        return list(documents.values())
+        with self.lock:
+            # 大文档由多个数据段组成，只列出其第一个数据段
+            return [{
+                'filename': segment.filename,
+                'chunk_count': segment.total_chunks,
+                'upload_time': segment.timestamp
+            } for segment in self.storage.segments if segment.chunk_offset == 0]
     
     def delete_document(self, filename):
         """删除指定文档"""
-        # 找出所有属于该文档的块
-        indices_to_remove = [i for i, meta in enumerate(self.document_metadata) if meta['filename'] == filename]
+        with self.lock:
+            self._sync_storage()
+            # 找出属于该文档的数据段
+            segments = self.storage.segments_for(filename)
         
-        if not indices_to_remove:
-            return False
+            if not segments:
+                return False
         
-        # 删除文档块和元数据
-        for i in sorted(indices_to_remove, reverse=True):
-            del self.document_chunks[i]
-            del self.document_metadata[i]
+            # 移除数据段及其在索引中的向量
+            self._remove_segments(segments)
         
-        # 重新构建向量存储
-        if self.document_chunks:
-            embeddings = [self.embedding_pipeline(chunk)['sentence_embedding'] for chunk in self.document_chunks]
-            self.vectors = np.array(embeddings)
-        else:
-            self.vectors = np.array([])
+            # 保存索引
+            self.save()
         
-        # 保存数据库
-        self.save()
-        
-        return True
\ No newline at end of file
+            return True
+
+    def _store_changed(self):
+        """文档增删后旧的检索结果不再有效"""
+        self.version += 1
+        self.result_cache.clear()
+
+    def _remove_segments(self, segments):
+        """移除数据段，其余文档的嵌入向量原样保留，无需重新编码"""
+        removed_ids = np.concatenate([segment.ids for segment in segments])
+        self.index.remove(removed_ids)
+        self.sparse_index.remove(segments)
+        self.storage.remove(segments)
+        self._store_changed()
+        self._maybe_rebuild_index()
+        logger.info(f"已删除 {len(removed_ids)} 个文档块，剩余 {len(self.storage)} 个")
+
+
+def _corpus_label(total):
+    """文档块总数所在的量级，作为检索耗时指标的标签"""
+    lower = 0
+    for upper in SEARCH_CORPUS_BUCKETS:
+        if total < upper:
+            return f"{lower}-{upper}"
+        lower = upper
+    return f"{lower}+"
+
+
+def _reciprocal_rank_fusion(rankings):
+    """倒数排名融合：每个文档块的得分为其在各路结果中 1/(RRF_K+排名) 之和"""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,132 @@
+import time
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+
+from VectorDB import VectorDatabase
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class VectorDatabaseCache:
+    """已打开的会话向量数据库的LRU缓存，按数量上限和空闲时间淘汰
+
+    同一会话在进程内只打开一个 VectorDatabase：被淘汰但仍被其他线程引用的实例记录在弱引用表中，
+    再次获取时直接复用，不会有两个实例同时写同一个目录；pin() 的数据库在 unpin() 之前不会被淘汰。
+    从磁盘打开数据库不占用全局锁，只用该会话自己的锁，其他会话的查找不受影响。
+    """
+
+    def __init__(self, max_size=32, idle_timeout=1800, index_backend='auto', embedding_cache=None, query_cache=None,
+                 result_cache_size=256, vector_encoding='float32', rescore_factor=0):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.index_backend = index_backend
+        self.embedding_cache = embedding_cache
+        self.query_cache = query_cache
+        self.result_cache_size = result_cache_size
+        self.vector_encoding = vector_encoding
+        self.rescore_factor = rescore_factor
+        self._stores = OrderedDict()  # session_id -> (VectorDatabase, 最近访问时间)
+        self._live = weakref.WeakValueDictionary()  # session_id -> 仍被引用的 VectorDatabase（含已淘汰的）
+        self._pins = {}  # session_id -> pin次数
+        self._opening = {}  # session_id -> 正在从磁盘打开该会话时使用的锁
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """获取会话的向量数据库，不存在时从磁盘打开并放入缓存"""
+        with self._lock:
+            vector_db = self._lookup(session_id)
+            if vector_db is not None:
+                return vector_db
+            open_lock = self._opening.setdefault(session_id, threading.Lock())
+
+        with open_lock:
+            # 等待期间可能已被其他线程打开
+            with self._lock:
+                vector_db = self._lookup(session_id)
+                if vector_db is not None:
+                    return vector_db
+            try:
+                logger.info(f"缓存未命中，从磁盘打开向量数据库: {session_id}")
+                vector_db = VectorDatabase(session_id, index_backend=self.index_backend,
+                                           embedding_cache=self.embedding_cache, query_cache=self.query_cache,
+                                           result_cache_size=self.result_cache_size,
+                                           vector_encoding=self.vector_encoding, rescore_factor=self.rescore_factor)
+                with self._lock:
+                    self._live[session_id] = vector_db
+                    self._touch(session_id, vector_db)
+                return vector_db
+            finally:
+                with self._lock:
+                    if self._opening.get(session_id) is open_lock:
+                        del self._opening[session_id]
+
+    def pin(self, session_id):
+        """获取会话的数据库并禁止淘汰，直到对应次数的 unpin()，用于跨越多个阶段的入库任务"""
+        vector_db = self.get(session_id)
+        with self._lock:
+            self._pins[session_id] = self._pins.get(session_id, 0) + 1
+            # get 之后可能已被其他线程淘汰，重新放回缓存
+            self._touch(session_id, vector_db)
+        return vector_db
+
+    def unpin(self, session_id):
+        with self._lock:
+            count = self._pins.get(session_id, 0) - 1
+            if count > 0:
+                self._pins[session_id] = count
+            else:
+                self._pins.pop(session_id, None)
+
+    def invalidate(self, session_id):
+        """从缓存中移除指定会话"""
+        with self._lock:
+            self._stores.pop(session_id, None)
+            self._live.pop(session_id, None)
+
+    def __len__(self):
+        return len(self._stores)
+
+    def result_cache_stats(self):
+        """当前打开的各会话检索结果缓存的命中统计之和"""
+        with self._lock:
+            stores = [vector_db for vector_db, _ in self._stores.values()]
+        hits = sum(vector_db.result_cache.hits for vector_db in stores)
+        misses = sum(vector_db.result_cache.misses for vector_db in stores)
+        return {
+            'stores': len(stores),
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / (hits + misses) if hits + misses else 0.0
+        }
+
+    def _lookup(self, session_id):
+        """在已加锁的情况下查找缓存中或仍然存活的数据库，找到时更新访问时间"""
+        self._evict_idle(time.monotonic())
+        entry = self._stores.get(session_id)
+        vector_db = entry[0] if entry is not None else self._live.get(session_id)
+        if vector_db is not None:
+            self._touch(session_id, vector_db)
+        return vector_db
+
+    def _touch(self, session_id, vector_db):
+        """放到LRU末尾；超过数量上限时淘汰最久未使用且未被pin的会话"""
+        self._stores.pop(session_id, None)
+        self._stores[session_id] = (vector_db, time.monotonic())
+        excess = len(self._stores) - self.max_size
+        for evicted_id in [evicted_id for evicted_id in self._stores if evicted_id not in self._pins][:max(excess, 0)]:
+            del self._stores[evicted_id]
+            logger.info(f"向量数据库缓存已满，淘汰会话: {evicted_id}")
+
+    def _evict_idle(self, now):
+        """淘汰空闲超时且未被pin的会话（OrderedDict按访问时间排序，遇到未超时的即可停止）"""
+        for session_id, (_, last_access) in list(self._stores.items()):
+            if now - last_access <= self.idle_timeout:
+                break
+            if session_id in self._pins:
+                continue
+            del self._stores[session_id]
+            logger.info(f"向量数据库空闲超时，淘汰会话: {session_id}")
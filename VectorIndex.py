@@ -0,0 +1,291 @@
+import os
+import json
+import math
+import logging
+
+import numpy as np
+
+from VectorCodec import EncodedVectors
+
+try:
+    import faiss
+except ImportError:  # faiss-cpu 未安装时只能使用精确检索
+    faiss = None
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 自动选择索引类型时的阈值：文档块数量达到该值后改用IVF近似检索
+ANN_MIN_VECTORS = 20000
+IVF_MIN_TRAIN_VECTORS = 1024
+# IVF的聚类中心数按训练时的向量数确定，向量数增长到训练时的该倍数后重新训练
+IVF_RETRAIN_FACTOR = 4
+INDEX_FILE = 'index.faiss'
+INDEX_META_FILE = 'index.json'
+
+
+class FlatIndex:
+    """精确检索（暴力计算L2距离），适用于小规模会话
+
+    缓存每个向量的平方范数，利用 ||x-q||² = ||x||² - 2x·q + ||q||²，
+    一次矩阵乘法即可得到全部距离，无需构造 N×dim 的差值矩阵；
+    再用argpartition只对前k个候选排序。
+    向量按块存放（通常是内存映射的数据段），追加时不复制已有数据。
+    压缩编码的块（EncodedVectors）直接在编码上计算得分；rescore_factor 大于0时，
+    先按编码得分取 k×rescore_factor 个候选，再用块中保留的float32原始向量重新计算距离。
+    """
+    backend = 'flat'
+    query_block_size = 64  # 批量检索时每次参与矩阵乘法的查询数，限制临时距离矩阵大小
+
+    def __init__(self, dimension, rescore_factor=0):
+        self.dimension = dimension
+        self.rescore_factor = rescore_factor
+        self.blocks = []  # [向量矩阵或EncodedVectors, id数组, 平方范数（首次检索时计算）, float32原始向量或None]
+
+    def __len__(self):
+        return sum(len(ids) for _, ids, _, _ in self.blocks)
+
+    def add(self, vectors, ids, full_vectors=None):
+        if len(ids) > 0:
+            self.blocks.append([vectors, np.asarray(ids, dtype=np.int64), None, full_vectors])
+
+    def remove(self, ids):
+        blocks = []
+        for vectors, block_ids, norms, full_vectors in self.blocks:
+            keep = ~np.isin(block_ids, ids)
+            if keep.all():
+                blocks.append([vectors, block_ids, norms, full_vectors])
+            elif keep.any():
+                if not isinstance(vectors, EncodedVectors):
+                    vectors = np.asarray(vectors)
+                blocks.append([vectors[keep], block_ids[keep], None if norms is None else norms[keep],
+                               None if full_vectors is None else np.asarray(full_vectors)[keep]])
+        self.blocks = blocks
+
+    def search(self, queries, k):
+        """返回 (距离, id)，形状均为 (查询数, k)，不足k个时用-1填充id"""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        result_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        n = min(k, len(self))
+        if n == 0:
+            return distances, result_ids
+
+        rescore = self.rescore_factor > 0 and any(block[3] is not None for block in self.blocks)
+        fetch = min(n * self.rescore_factor, len(self)) if rescore else n
+        # 各块在全部候选中的起始位置，候选用该位置标识，最后再映射回id
+        offsets = np.cumsum([0] + [len(ids) for _, ids, _, _ in self.blocks])
+        all_ids = np.concatenate([ids for _, ids, _, _ in self.blocks])
+        for start in range(0, len(queries), self.query_block_size):
+            block_queries = queries[start:start + self.query_block_size]
+            # 每个向量块各取前fetch个候选，再在候选中合并排序
+            candidate_scores, candidate_positions = [], []
+            for offset, block in zip(offsets, self.blocks):
+                scores, rows = self._search_block(block, block_queries, fetch)
+                candidate_scores.append(scores)
+                candidate_positions.append(rows + offset)
+            scores = np.concatenate(candidate_scores, axis=1)
+            positions = np.concatenate(candidate_positions, axis=1)
+            order = np.argsort(scores, axis=1)[:, :fetch]
+            scores, positions = np.take_along_axis(scores, order, axis=1), np.take_along_axis(positions, order, axis=1)
+            if rescore:
+                scores = self._rescore(block_queries, scores, positions, offsets)
+                order = np.argsort(scores, axis=1)[:, :n]
+                scores = np.take_along_axis(scores, order, axis=1)
+                positions = np.take_along_axis(positions, order, axis=1)
+            # 查询向量自身的范数对排序没有影响，最后再加上
+            squared = scores + np.einsum('ij,ij->i', block_queries, block_queries)[:, None]
+
+            distances[start:start + len(block_queries), :n] = np.sqrt(np.maximum(squared, 0))
+            result_ids[start:start + len(block_queries), :n] = all_ids[positions]
+        return distances, result_ids
+
+    def _search_block(self, block, queries, n):
+        """返回该块中得分最小的n个候选的 (得分, 块内行号)"""
+        vectors, ids, norms, _ = block
+        if isinstance(vectors, EncodedVectors):
+            scores = vectors.scores(queries)
+        else:
+            if norms is None:
+                norms = block[2] = np.einsum('ij,ij->i', vectors, vectors)
+            scores = norms - 2.0 * (queries @ vectors.T)
+        if n < len(ids):
+            candidates = np.argpartition(scores, n - 1, axis=1)[:, :n]
+            return np.take_along_axis(scores, candidates, axis=1), candidates
+        return scores, np.broadcast_to(np.arange(len(ids)), scores.shape)
+
+    def _rescore(self, queries, scores, positions, offsets):
+        """用float32原始向量重新计算候选的得分，只读取候选所在的行"""
+        scores = scores.copy()
+        for b, (_, _, _, full_vectors) in enumerate(self.blocks):
+            if full_vectors is None:
+                continue
+            mask = (positions >= offsets[b]) & (positions < offsets[b + 1])
+            if not mask.any():
+                continue
+            query_rows = np.nonzero(mask)[0]
+            vectors = np.asarray(full_vectors[positions[mask] - offsets[b]], dtype=np.float32)
+            scores[mask] = (np.einsum('ij,ij->i', vectors, vectors)
+                            - 2.0 * np.einsum('ij,ij->i', vectors, queries[query_rows]))
+        return scores
+
+    def needs_rebuild(self):
+        return False
+
+    def save(self, db_path):
+        # 精确索引直接引用数据段中的向量，无需单独持久化
+        _write_meta(db_path, {'backend': self.backend, 'count': len(self)})
+
+
+class FaissIndex:
+    """基于faiss的近似检索索引（IVF或HNSW），向量以稳定的文档块id存储"""
+
+    def __init__(self, backend, dimension, index=None, deleted=None, nprobe=16, ef_search=64, trained_count=None):
+        if faiss is None:
+            raise RuntimeError("未安装faiss-cpu，无法使用近似检索索引")
+        self.backend = backend
+        self.dimension = dimension
+        self.index = index
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        # HNSW不支持物理删除，被删除的id记录在此处并在检索时过滤
+        self.deleted = set(deleted or [])
+        # IVF训练时的向量数；旧版本的索引文件没有记录，按 nlist≈sqrt(训练向量数) 估算
+        if trained_count is None and backend == 'ivf' and index is not None:
+            trained_count = faiss.extract_index_ivf(index).nlist ** 2
+        self.trained_count = trained_count
+
+    def __len__(self):
+        return 0 if self.index is None else self.index.ntotal - len(self.deleted)
+
+    def train(self, vectors):
+        """根据已有向量创建并训练索引"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.backend == 'ivf':
+            nlist = max(1, min(int(math.sqrt(len(vectors))), len(vectors) // 39))
+            quantizer = faiss.IndexFlatL2(self.dimension)
+            self.index = faiss.IndexIVFFlat(quantizer, self.dimension, nlist, faiss.METRIC_L2)
+            self.index.train(vectors)
+            self._quantizer = quantizer  # 保持引用，防止被垃圾回收
+            self.trained_count = len(vectors)
+        elif self.backend == 'hnsw':
+            self.index = faiss.IndexIDMap2(faiss.IndexHNSWFlat(self.dimension, 32))
+        else:
+            raise ValueError(f"未知的索引类型: {self.backend}")
+        logger.info(f"{self.backend} 索引训练完成，训练向量数: {len(vectors)}")
+
+    def add(self, vectors, ids, full_vectors=None):
+        # faiss索引保存float32向量；压缩编码的数据段优先使用保留的原始向量，否则解码
+        vectors = np.ascontiguousarray(vectors if full_vectors is None else full_vectors, dtype=np.float32)
+        self.index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+
+    def remove(self, ids):
+        if self.backend == 'ivf':
+            self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+        else:
+            self.deleted.update(int(i) for i in ids)
+
+    def search(self, queries, k):
+        queries = np.ascontiguousarray(np.atleast_2d(queries), dtype=np.float32)
+        if self.backend == 'ivf':
+            self.index.nprobe = self.nprobe
+        else:
+            faiss.downcast_index(self.index.index).hnsw.efSearch = max(self.ef_search, k)
+
+        # 有墓碑记录时多取一些候选，过滤后仍能凑满k个
+        fetch = min(k + len(self.deleted), self.index.ntotal)
+        if fetch == 0:
+            return (np.full((len(queries), k), np.inf, dtype=np.float32),
+                    np.full((len(queries), k), -1, dtype=np.int64))
+        squared, result_ids = self.index.search(queries, fetch)
+        if self.deleted:
+            squared, result_ids = _filter_deleted(squared, result_ids, self.deleted, k)
+        # faiss返回的是L2距离的平方，与精确检索保持一致
+        distances = np.sqrt(np.maximum(squared[:, :k], 0))
+        distances[result_ids[:, :k] < 0] = np.inf
+        return distances, result_ids[:, :k]
+
+    def needs_rebuild(self):
+        """墓碑过多时检索效率下降，需要用剩余向量重建；IVF的向量数远超训练时的规模后，
+        每个聚类的向量过多，召回率和检索速度都会下降，需要按当前规模重新训练"""
+        if self.index is None:
+            return False
+        if self.backend == 'ivf' and self.trained_count and self.index.ntotal > IVF_RETRAIN_FACTOR * self.trained_count:
+            return True
+        return len(self.deleted) > 0.2 * self.index.ntotal
+
+    def save(self, db_path):
+        index_path = os.path.join(db_path, INDEX_FILE)
+        faiss.write_index(self.index, index_path + '.tmp')
+        os.replace(index_path + '.tmp', index_path)
+        _write_meta(db_path, {'backend': self.backend, 'count': len(self), 'deleted': sorted(self.deleted),
+                              'trained_count': self.trained_count})
+
+
+def choose_backend(count, backend='auto'):
+    """根据文档块数量自动选择索引类型"""
+    if backend == 'auto':
+        backend = 'ivf' if count >= ANN_MIN_VECTORS else 'flat'
+    if backend != 'flat' and faiss is None:
+        return 'flat'
+    # IVF需要足够的样本训练聚类中心
+    if backend == 'ivf' and count < IVF_MIN_TRAIN_VECTORS:
+        return 'flat'
+    return backend
+
+
+def build_index(backend, dimension, blocks, rescore_factor=0):
+    """用给定的 (向量, id, float32原始向量或None) 块从头构建索引"""
+    if backend == 'flat':
+        index = FlatIndex(dimension, rescore_factor=rescore_factor)
+    else:
+        index = FaissIndex(backend, dimension)
+        index.train(np.concatenate([np.asarray(vectors if full_vectors is None else full_vectors, dtype=np.float32)
+                                    for vectors, _, full_vectors in blocks]) if blocks
+                    else np.zeros((0, dimension), dtype=np.float32))
+    for vectors, ids, full_vectors in blocks:
+        index.add(vectors, ids, full_vectors)
+    return index
+
+
+def load_index(db_path, dimension, expected_backend, expected_count):
+    """加载持久化的索引（与数据段放在同一目录），类型或数量与当前数据不一致时返回None，由调用方重建"""
+    meta_path = os.path.join(db_path, INDEX_META_FILE)
+    index_path = os.path.join(db_path, INDEX_FILE)
+    if expected_backend == 'flat' or not os.path.exists(meta_path) or not os.path.exists(index_path):
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('backend') != expected_backend or meta.get('count') != expected_count:
+            logger.info(f"索引文件与向量数据不一致，需要重建: {meta}")
+            return None
+        index = FaissIndex(meta['backend'], dimension, index=faiss.read_index(index_path),
+                           deleted=meta.get('deleted'), trained_count=meta.get('trained_count'))
+        if index.needs_rebuild():
+            logger.info(f"{index.backend} 索引需要按当前规模重建")
+            return None
+        logger.info(f"成功加载 {index.backend} 索引，包含 {len(index)} 个向量")
+        return index
+    except Exception as e:
+        logger.error(f"加载索引失败: {str(e)}")
+        return None
+
+
+def _write_meta(db_path, meta):
+    meta_path = os.path.join(db_path, INDEX_META_FILE)
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def _filter_deleted(squared, result_ids, deleted, k):
+    """把已删除的id从检索结果中剔除，并向前补齐"""
+    filtered_distances = np.full((len(result_ids), k), np.inf, dtype=np.float32)
+    filtered_ids = np.full((len(result_ids), k), -1, dtype=np.int64)
+    for i in range(len(result_ids)):
+        kept = [j for j, idx in enumerate(result_ids[i]) if idx >= 0 and int(idx) not in deleted][:k]
+        filtered_distances[i, :len(kept)] = squared[i, kept]
+        filtered_ids[i, :len(kept)] = result_ids[i, kept]
+    return filtered_distances, filtered_ids
@@ -0,0 +1,354 @@
+import os
+import json
+import mmap
+import uuid
+import bisect
+import logging
+
+import numpy as np
+
+from VectorCodec import ENCODINGS, EncodedVectors, load_codec, train_codec
+
+# 配置日志
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'manifest.json'
+SEGMENT_DIR = 'segments'
+STORAGE_VERSION = 1
+# 一个数据段的全部文件（按后缀），bm25.npz 由 SparseIndex 写入
+SEGMENT_FILES = ('vectors.npy', 'codes.npy', 'codec.npz', 'offsets.npy', 'chunks.bin', 'pages.npy', 'bm25.npz')
+
+# 旧版本（整体重写）的文件名，首次打开时自动迁移
+LEGACY_VECTORS_FILE = 'vectors.npy'
+LEGACY_CHUNKS_FILE = 'document_chunks.json'
+LEGACY_METADATA_FILE = 'document_metadata.json'
+
+
+def atomic_write(path, data):
+    """先写临时文件再原子替换，进程崩溃时不会留下写了一半的文件"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_save_npy(path, array):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_save_npz(path, arrays):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Segment:
+    """一个文档（大文档为其中连续的一部分文档块）对应的只读数据段：向量、文档块文本及偏移索引，写入后不再修改
+
+    文件按需以内存映射方式打开，打开会话时不读取向量和文本内容。
+    encoding 不是float32时，向量以编码形式存放在codes.npy（编码器参数在codec.npz）；
+    vectors.npy 始终是float32原始向量，压缩编码的数据段只在需要重新打分时才保留它。
+    """
+
+    def __init__(self, segment_dir, info):
+        self.segment_dir = segment_dir
+        self.name = info['name']
+        self.filename = info['filename']
+        self.count = info['count']
+        self.first_id = info['first_id']
+        self.timestamp = info['timestamp']
+        # 大文档分成多个数据段时，本段第一个文档块在文档中的序号，以及整个文档的文档块数
+        self.chunk_offset = info.get('chunk_offset', 0)
+        self.total_chunks = info.get('total_chunks', self.count)
+        # 是否保存了每个文档块的起止页码（PDF）
+        self.paged = info.get('paged', False)
+        self.encoding = info.get('encoding', 'float32')
+        self._vectors = None
+        self._full_vectors = None
+        self._offsets = None
+        self._blob = None
+        self._pages = None
+
+    def info(self):
+        info = {
+            'name': self.name,
+            'filename': self.filename,
+            'count': self.count,
+            'first_id': self.first_id,
+            'timestamp': self.timestamp
+        }
+        if self.total_chunks != self.count:
+            info['chunk_offset'] = self.chunk_offset
+            info['total_chunks'] = self.total_chunks
+        if self.paged:
+            info['paged'] = True
+        if self.encoding != 'float32':
+            info['encoding'] = self.encoding
+        return info
+
+    def path(self, suffix):
+        return os.path.join(self.segment_dir, f"{self.name}.{suffix}")
+
+    @property
+    def ids(self):
+        """段内文档块id连续分配"""
+        return np.arange(self.first_id, self.first_id + self.count, dtype=np.int64)
+
+    @property
+    def vectors(self):
+        """float32数据段返回内存映射的向量矩阵，压缩编码的数据段返回 EncodedVectors"""
+        if self._vectors is None:
+            if self.encoding == 'float32':
+                self._vectors = np.load(self.path('vectors.npy'), mmap_mode='r')
+            else:
+                with np.load(self.path('codec.npz')) as params:
+                    codec = load_codec(self.encoding, params)
+                self._vectors = EncodedVectors(codec, np.load(self.path('codes.npy'), mmap_mode='r'))
+        return self._vectors
+
+    @property
+    def full_vectors(self):
+        """压缩编码的数据段保留的float32原始向量，用于重新打分；没有保留或本身就是float32时为None"""
+        if self._full_vectors is None and self.encoding != 'float32' and os.path.exists(self.path('vectors.npy')):
+            self._full_vectors = np.load(self.path('vectors.npy'), mmap_mode='r')
+        return self._full_vectors
+
+    def chunk(self, local_index):
+        """按段内行号读取文档块文本"""
+        if self._offsets is None:
+            self._offsets = np.load(self.path('offsets.npy'), mmap_mode='r')
+            with open(self.path('chunks.bin'), 'rb') as f:
+                # 空文件无法映射
+                self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        start, end = int(self._offsets[local_index]), int(self._offsets[local_index + 1])
+        return self._blob[start:end].decode('utf-8')
+
+    def chunks(self):
+        for i in range(self.count):
+            yield self.chunk(i)
+
+    def metadata(self, local_index):
+        metadata = {
+            'filename': self.filename,
+            'chunk_id': self.first_id + local_index,
+            'chunk_index': self.chunk_offset + local_index,
+            'total_chunks': self.total_chunks,
+            'timestamp': self.timestamp
+        }
+        if self.paged:
+            if self._pages is None:
+                self._pages = np.load(self.path('pages.npy'), mmap_mode='r')
+            metadata['page'], metadata['page_end'] = (int(page) for page in self._pages[local_index])
+        return metadata
+
+    def close(self):
+        if isinstance(self._blob, mmap.mmap):
+            self._blob.close()
+        self._vectors = self._full_vectors = self._offsets = self._blob = self._pages = None
+
+    def rename(self, name):
+        """提交前把临时名称的文件改为正式名称"""
+        for suffix in SEGMENT_FILES:
+            if os.path.exists(self.path(suffix)):
+                os.replace(self.path(suffix), os.path.join(self.segment_dir, f"{name}.{suffix}"))
+        self.close()
+        self.name = name
+
+    def remove_files(self):
+        self.close()
+        for suffix in SEGMENT_FILES:
+            try:
+                os.remove(self.path(suffix))
+            except FileNotFoundError:
+                pass
+
+
+class SegmentStorage:
+    """会话向量数据库的追加式磁盘存储
+
+    上传文档时写入新的数据段（大文档分成多个），再原子地重写很小的manifest.json提交，上传开销与新数据量成正比；
+    删除或替换文档只需从manifest中移除对应的数据段。
+    新数据段按 encoding 编码向量（见 VectorCodec.ENCODINGS），已有数据段保持写入时的编码；
+    keep_full_precision 为True时压缩编码的数据段同时保存float32原始向量，供检索时重新打分。
+    """
+
+    def __init__(self, db_path, dimension, encoding='float32', keep_full_precision=False):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"不支持的向量编码: {encoding}，可选 {ENCODINGS}")
+        self.db_path = db_path
+        self.dimension = dimension
+        self.encoding = encoding
+        self.keep_full_precision = keep_full_precision
+        self.segment_dir = os.path.join(db_path, SEGMENT_DIR)
+        self.segments = []
+        self.next_chunk_id = 0
+        self._next_segment = 0
+        self.migrated = False
+
+    def __len__(self):
+        return sum(segment.count for segment in self.segments)
+
+    def open(self):
+        """读取manifest；旧版本格式的数据会先迁移"""
+        os.makedirs(self.segment_dir, exist_ok=True)
+        manifest_path = os.path.join(self.db_path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            if os.path.exists(os.path.join(self.db_path, LEGACY_CHUNKS_FILE)):
+                self._migrate_legacy()
+            else:
+                self._write_manifest()
+            return
+
+        self._apply_manifest(self._read_manifest())
+        logger.info(f"成功打开向量数据库，包含 {len(self.segments)} 个数据段、{len(self)} 个文档块")
+
+    def reload(self):
+        """重新读取manifest，磁盘上的数据段（例如被其他进程修改）与内存中不一致时更新并返回True
+
+        提交新数据段前调用，避免按过期的编号分配名称和文档块id、覆盖他人刚提交的manifest。
+        """
+        manifest = self._read_manifest()
+        if manifest is None or (manifest['next_chunk_id'] == self.next_chunk_id
+                                and manifest['next_segment'] == self._next_segment
+                                and [info['name'] for info in manifest['segments']]
+                                == [segment.name for segment in self.segments]):
+            return False
+        logger.info(f"manifest已被修改，重新加载: {self.db_path}")
+        self._apply_manifest(manifest)
+        return True
+
+    def _read_manifest(self):
+        manifest_path = os.path.join(self.db_path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _apply_manifest(self, manifest):
+        # 已打开的数据段保留原对象（及其内存映射）
+        opened = {segment.name: segment for segment in self.segments}
+        self.next_chunk_id = manifest['next_chunk_id']
+        self._next_segment = manifest['next_segment']
+        self.segments = [opened.get(info['name']) or Segment(self.segment_dir, info) for info in manifest['segments']]
+
+    def append(self, filename, vectors, chunks, timestamp, pages=None):
+        """写入并提交一个新数据段，返回该数据段
+
+        pages 为每个文档块的 (起始页, 结束页)，没有分页信息时为None
+        """
+        segment = self.write_segment(filename, vectors, chunks, timestamp, pages=pages)
+        self.commit([segment])
+        return segment
+
+    def write_segment(self, filename, vectors, chunks, timestamp, pages=None):
+        """写入一个数据段的文件但不提交，返回该数据段；commit 之后才出现在manifest中
+
+        未提交的数据段使用临时名称，名称和文档块id在提交时分配，因此可以在不持有数据库锁的情况下写入。
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        encoded = [chunk.encode('utf-8') for chunk in chunks]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(data) for data in encoded])
+
+        segment = Segment(self.segment_dir, {
+            'name': f"tmp-{uuid.uuid4().hex}",
+            'filename': filename,
+            'count': len(chunks),
+            'first_id': None,
+            'timestamp': timestamp,
+            'paged': pages is not None,
+            'encoding': self.encoding
+        })
+        # manifest是提交点，中途崩溃只会留下未被引用的文件
+        codec = train_codec(self.encoding, vectors)
+        if codec is not None:
+            atomic_save_npy(segment.path('codes.npy'), codec.encode(vectors))
+            atomic_save_npz(segment.path('codec.npz'), codec.params())
+        if codec is None or self.keep_full_precision:
+            atomic_save_npy(segment.path('vectors.npy'), vectors)
+        atomic_save_npy(segment.path('offsets.npy'), offsets)
+        atomic_write(segment.path('chunks.bin'), b''.join(encoded))
+        if pages is not None:
+            atomic_save_npy(segment.path('pages.npy'), np.asarray(pages, dtype=np.int32).reshape(-1, 2))
+        return segment
+
+    def commit(self, segments, replaced=()):
+        """提交已写入的数据段，同时移除 replaced 中的数据段（同名文档的旧版本），只写一次manifest
+
+        segments 是同一文档按顺序写出的各个部分。先分配名称和文档块id并提交manifest，再删除被替换的文件。
+        """
+        chunk_offset, total_chunks = 0, sum(segment.count for segment in segments)
+        for segment in segments:
+            segment.chunk_offset, segment.total_chunks = chunk_offset, total_chunks
+            chunk_offset += segment.count
+            segment.rename(f"seg-{self._next_segment:06d}")
+            segment.first_id = self.next_chunk_id
+            self.next_chunk_id += segment.count
+            self._next_segment += 1
+        removed = set(id(segment) for segment in replaced)
+        self.segments = [segment for segment in self.segments if id(segment) not in removed] + list(segments)
+        self._write_manifest()
+        for segment in replaced:
+            segment.remove_files()
+
+    def discard(self, segments):
+        """删除未提交的数据段的文件（入库失败时）"""
+        for segment in segments:
+            segment.remove_files()
+
+    def remove(self, segments):
+        """移除数据段：先提交manifest，再删除文件"""
+        self.commit([], replaced=segments)
+
+    def segments_for(self, filename):
+        return [segment for segment in self.segments if segment.filename == filename]
+
+    def locate(self, chunk_id):
+        """根据文档块id找到 (数据段, 段内行号)；数据段按first_id递增排列"""
+        position = bisect.bisect_right([segment.first_id for segment in self.segments], chunk_id) - 1
+        segment = self.segments[position]
+        return segment, chunk_id - segment.first_id
+
+    def _write_manifest(self):
+        manifest = {
+            'version': STORAGE_VERSION,
+            'dimension': self.dimension,
+            'next_chunk_id': self.next_chunk_id,
+            'next_segment': self._next_segment,
+            'segments': [segment.info() for segment in self.segments]
+        }
+        atomic_write(os.path.join(self.db_path, MANIFEST_FILE),
+                     json.dumps(manifest, ensure_ascii=False).encode('utf-8'))
+
+    def _migrate_legacy(self):
+        """把旧版本的 vectors.npy + JSON 文件按文档拆分为数据段"""
+        logger.info(f"检测到旧版本向量数据库，开始迁移: {self.db_path}")
+        vectors = np.load(os.path.join(self.db_path, LEGACY_VECTORS_FILE))
+        with open(os.path.join(self.db_path, LEGACY_CHUNKS_FILE), 'r', encoding='utf-8') as f:
+            chunks = json.load(f)
+        with open(os.path.join(self.db_path, LEGACY_METADATA_FILE), 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+        vectors = vectors.astype(np.float32).reshape(-1, self.dimension) if vectors.size else vectors
+
+        rows_by_file = {}
+        for row, meta in enumerate(metadata):
+            rows_by_file.setdefault(meta['filename'], []).append(row)
+        for filename, rows in rows_by_file.items():
+            self.append(filename, vectors[rows], [chunks[row] for row in rows], metadata[rows[0]]['timestamp'])
+        self._write_manifest()
+        self.migrated = True
+
+        for name in (LEGACY_VECTORS_FILE, LEGACY_CHUNKS_FILE, LEGACY_METADATA_FILE):
+            os.remove(os.path.join(self.db_path, name))
+        logger.info(f"迁移完成，共 {len(self.segments)} 个数据段")
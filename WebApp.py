@@ -0,0 +1,333 @@
+import logging
+import os
+import uuid
+import hashlib
+import json
+import time
+import logging
+from datetime import datetime
+from functools import partial
+
+from flask import Flask, request, jsonify, render_template, send_from_directory, session
+from werkzeug.utils import secure_filename
+
+from QwenThread import QwenThread, QWEN_MODEL_PATH
+from EmbeddingModel import get_embedding_encoder, configure_embedding_encoder, DEFAULT_MODEL_DIR
+from VectorDBCache import VectorDatabaseCache
+from VectorDB import RETRIEVAL_MODES
+from PromptAssembler import PromptAssembler
+from QueryCache import LRUCache
+from EmbeddingCache import EmbeddingCache
+from IngestionQueue import IngestionQueue, IngestionBusyError
+from DocumentParser import iter_document
+from GenerationControl import CancellationToken
+from ModelLoader import ModelLoader
+from ModelServer import ModelServerClient, RemoteQwenThread, RemoteEmbeddingEncoder
+from InferenceProfile import thread_split, configure_interop_threads
+from Metrics import REGISTRY, CONTENT_TYPE, Histogram
+
+app = Flask(__name__, static_folder='static', template_folder='templates')
+app.secret_key = 'doc_knowledge_llm_secret_key'  # 设置密钥，用于会话加密
+
+# 创建上传文件的目录
+UPLOAD_FOLDER = 'uploads'
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+# 创建向量数据库存储目录
+VECTOR_DB_FOLDER = 'vector_db'
+os.makedirs(VECTOR_DB_FOLDER, exist_ok=True)
+
+# 已打开的会话向量数据库缓存（数量上限、空闲淘汰秒数）
+VECTOR_DB_CACHE_SIZE = int(os.environ.get('VECTOR_DB_CACHE_SIZE', 32))
+VECTOR_DB_IDLE_TIMEOUT = int(os.environ.get('VECTOR_DB_IDLE_TIMEOUT', 1800))
+# 检索索引类型：auto（按文档块数量自动选择）、flat、ivf、hnsw
+VECTOR_INDEX_BACKEND = os.environ.get('VECTOR_INDEX_BACKEND', 'auto')
+# 新上传文档的向量编码：float32、float16、int8、pq
+VECTOR_ENCODING = os.environ.get('VECTOR_ENCODING', 'float32')
+# 压缩编码时重新打分的候选倍数，默认0（不重新打分）。大于0时每个压缩编码的数据段还要额外保存一份float32原始向量，
+# 磁盘占用反而比不压缩更大（内存中的索引仍是压缩编码），换来接近float32的召回率；
+# 为0时只用编码得分排序，int8/pq 的召回率略有下降，可用 benchmark/bench_vector_encoding.py 在自己的数据上比较
+VECTOR_RESCORE_FACTOR = int(os.environ.get('VECTOR_RESCORE_FACTOR', 0))
+# 模型文件目录（与QwenThread相同）
+MODEL_DIR = os.environ.get('MODEL_DIR', DEFAULT_MODEL_DIR)
+# 嵌入模型的CPU推理配置（default/int8/bf16）；生成与编码的线程数分开设置，0表示按可用核数自动分配
+EMBEDDING_INFERENCE_PROFILE = os.environ.get('EMBEDDING_INFERENCE_PROFILE', os.environ.get('INFERENCE_PROFILE', 'default'))
+GENERATION_THREADS = int(os.environ.get('GENERATION_THREADS', 0))
+EMBEDDING_THREADS = int(os.environ.get('EMBEDDING_THREADS', 0))
+INTEROP_THREADS = int(os.environ.get('INTEROP_THREADS', 1))
+# 模型服务进程（ModelServer.py）的Unix socket路径；设置后本进程不加载模型，生成和编码请求都转发给模型服务，
+# 多个Web进程可以共用一份模型
+MODEL_SERVER_SOCKET = os.environ.get('MODEL_SERVER_SOCKET')
+# 与模型服务相同的认证密钥；未设置时读取模型服务启动时生成的密钥文件（<socket路径>.key）
+MODEL_SERVER_AUTHKEY = os.environ.get('MODEL_SERVER_AUTHKEY', '').encode() or None
+model_server_client = ModelServerClient(MODEL_SERVER_SOCKET, MODEL_SERVER_AUTHKEY) if MODEL_SERVER_SOCKET else None
+if model_server_client is not None:
+    configure_embedding_encoder(factory=partial(RemoteEmbeddingEncoder, model_server_client))
+else:
+    configure_embedding_encoder(cache_dir=MODEL_DIR,
+                                profile=EMBEDDING_INFERENCE_PROFILE,
+                                num_threads=thread_split(GENERATION_THREADS, EMBEDDING_THREADS)[1])
+# 跨会话共享的文档块嵌入向量缓存的磁盘上限（MB），0表示不启用
+EMBEDDING_CACHE_FOLDER = 'embedding_cache'
+EMBEDDING_CACHE_MB = int(os.environ.get('EMBEDDING_CACHE_MB', 1024))
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_FOLDER, max_bytes=EMBEDDING_CACHE_MB * 1024 * 1024) \
+    if EMBEDDING_CACHE_MB > 0 else None
+# 默认检索方式（dense/sparse/hybrid），单次请求可通过mode参数指定
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'hybrid')
+# 每次检索的候选数，以及拼入提示词的知识库内容token上限
+RETRIEVAL_TOP_K = int(os.environ.get('RETRIEVAL_TOP_K', 8))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 1536))
+# 跨会话共享的查询向量缓存条数、每个会话的检索结果缓存条数
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 4096))
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 256))
+query_cache = LRUCache(QUERY_CACHE_SIZE)
+vector_db_cache = VectorDatabaseCache(max_size=VECTOR_DB_CACHE_SIZE, idle_timeout=VECTOR_DB_IDLE_TIMEOUT,
+                                      index_backend=VECTOR_INDEX_BACKEND, embedding_cache=embedding_cache,
+                                      query_cache=query_cache, result_cache_size=RESULT_CACHE_SIZE,
+                                      vector_encoding=VECTOR_ENCODING, rescore_factor=VECTOR_RESCORE_FACTOR)
+
+MESSAGE_TIME_TO_FIRST_TOKEN = Histogram('message_time_to_first_token_seconds',
+                                        '/message 从收到请求到发出第一段回复文本的时间（含检索、排队和预填充）')
+MESSAGE_RETRIEVAL_SECONDS = Histogram('message_retrieval_seconds', '/message 中检索和拼接提示词的耗时')
+
+# 后台文档入库：并行解析的线程数、未完成任务数上限
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 2))
+INGEST_MAX_PENDING = int(os.environ.get('INGEST_MAX_PENDING', 16))
+# 每累积多少个文档块写出一个数据段，决定入库一个文档时的内存上限
+INGEST_SEGMENT_CHUNKS = int(os.environ.get('INGEST_SEGMENT_CHUNKS', 1024))
+# 大PDF多进程解析的进程数，默认为CPU核数
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', 0)) or None
+ingestion_queue = IngestionQueue(vector_db_cache, max_workers=INGEST_WORKERS, max_pending=INGEST_MAX_PENDING,
+                                 segment_chunks=INGEST_SEGMENT_CHUNKS)
+
+# 生成会话ID
+def get_session_id():
+    if 'session_id' not in session:
+        session['session_id'] = str(uuid.uuid4())
+    return session['session_id']
+
+# 获取会话的向量数据库
+def get_vector_db():
+    session_id = get_session_id()
+    app.logger.info(f"创建或获取会话的向量数据库: {session_id}")
+    return vector_db_cache.get(session_id)
+
+# 加载嵌入模型与QwenThread（在后台线程中执行）
+def load_models(start_stage):
+    global qwenThread, prompt_assembler
+    if model_server_client is not None:
+        # 等待模型服务加载完成，本进程只加载Qwen的分词器
+        start_stage('model_server')
+        model_server_client.wait_ready()
+        qwenThread = RemoteQwenThread(model_server_client, QWEN_MODEL_PATH)
+        get_embedding_encoder()
+    else:
+        start_stage('embedding')
+        get_embedding_encoder()
+        qwenThread = QwenThread(on_stage=start_stage)
+    # 用Qwen的分词器计算知识库内容的token数
+    prompt_assembler = PromptAssembler(qwenThread.tokenizer, context_token_budget=CONTEXT_TOKEN_BUDGET)
+
+model_loader = ModelLoader(load_models, ('model_server',) if model_server_client is not None
+                           else ('embedding', 'download', 'load', 'warmup'))
+# 导入时即开始后台加载：WSGI部署（如gunicorn）不会调用 run()，不能等到第一个请求才加载。
+# 文档解析子进程不导入本模块（见 DocumentParser），不会重复加载模型
+# 算子间并行线程数只能在任何计算开始之前设置
+configure_interop_threads(INTEROP_THREADS)
+model_loader.start()
+# 模型未就绪时建议客户端重试的间隔（秒）
+NOT_READY_RETRY_AFTER = 5
+
+def not_ready():
+    """模型未就绪时立即返回503，不阻塞请求"""
+    response = jsonify(dict(model_loader.to_dict(), error='模型尚未就绪'))
+    response.status_code = 503
+    response.headers['Retry-After'] = str(NOT_READY_RETRY_AFTER)
+    return response
+
+# 定义路由和视图函数
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """存活检查：进程可以响应请求即返回200，同时给出模型加载进度"""
+    return jsonify(model_loader.to_dict())
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """就绪检查：模型加载和预热完成后返回200，否则返回503"""
+    if not model_loader.ready:
+        return not_ready()
+    return jsonify(model_loader.to_dict())
+
+@app.route('/queue', methods=['GET'])
+def queue_status():
+    """生成调度器的队列深度与准入上限"""
+    if not model_loader.ready:
+        return not_ready()
+    return jsonify(qwenThread.stats())
+
+@app.route('/retrieval/stats', methods=['GET'])
+def retrieval_stats():
+    """查询向量缓存、检索结果缓存与文档块嵌入缓存的命中统计"""
+    return jsonify({
+        'query_embedding_cache': query_cache.stats(),
+        'result_cache': vector_db_cache.result_cache_stats(),
+        'embedding_cache': embedding_cache.stats() if embedding_cache is not None else None
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus格式的指标：生成、检索、编码的耗时分布与调度队列深度"""
+    text = REGISTRY.render()
+    if model_server_client is not None and model_loader.ready:
+        # 生成相关的指标在模型服务进程中统计
+        text += model_server_client.call('metrics')
+    return app.response_class(text, content_type=CONTENT_TYPE)
+
+@app.route('/message', methods=['GET'])
+def chat():
+    received = time.perf_counter()
+    app.logger.info("开始")
+    ### 使用url
+    text = request.values.get('text')
+    if text is None:
+        return "请输入信息"
+    if not model_loader.ready:
+        return not_ready()
+    # 对话历史只记录原始问题，不记录拼接了知识库内容的提示词
+    question = text
+    session_id = get_session_id()
+    mode = request.values.get('mode', RETRIEVAL_MODE)
+    if mode not in RETRIEVAL_MODES:
+        return f"不支持的检索方式: {mode}", 400
+    # 单次请求的生成token上限与超时秒数，未指定时使用模型的默认设置
+    try:
+        max_tokens = _positive_param('max_tokens', int)
+        timeout = _positive_param('timeout', float)
+    except ValueError:
+        return "max_tokens 和 timeout 必须是正数", 400
+    
+    # 使用向量数据库检索相关文档内容，按token预算拼入提示词
+    if 'file_mappings' in session and len(session['file_mappings']) > 0:
+        try:
+            # 获取向量数据库
+            vector_db = get_vector_db()
+            
+            # 搜索相关文档块
+            with MESSAGE_RETRIEVAL_SECONDS.time():
+                search_results = vector_db.search(text, top_k=RETRIEVAL_TOP_K, mode=mode)
+                text = prompt_assembler.assemble(text, search_results)
+        except Exception as e:
+            # 检索失败时直接回答问题，不把整个文档放进提示词
+            app.logger.error(f"向量数据库检索错误: {str(e)}")
+    
+    # 客户端断开连接时Flask会关闭 generate()，通过取消标记让调度器在下一个解码步释放该请求
+    cancel_token = CancellationToken()
+
+    # 使用SSE（Server-Sent Events）实现流式响应，返回纯文本格式
+    def generate():
+        first_chunk = True
+        try:  
+            # 然后发送实际的流式响应，直接返回纯文本内容
+            # 确保中文和特殊字符正确编码
+            for chunk in qwenThread.stream_chat(text, session_id=session_id, question=question,
+                                                max_new_tokens=max_tokens, timeout=timeout,
+                                                cancel_token=cancel_token):
+                if first_chunk:
+                    MESSAGE_TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - received)
+                    first_chunk = False
+                # 确保内容是字符串并正确编码
+                chunk_str = str(chunk) if chunk else ''
+                yield f"data: {chunk_str}\n\n"
+        except Exception as e:
+            app.logger.error(f"流式响应错误: {str(e)}")
+            # 返回错误消息
+            error_str = str(e) if e else '未知错误'
+            yield f"data: 发生错误: {error_str}\n\n"
+        finally:
+            cancel_token.cancel()
+    app.logger.info("结束")
+    return app.response_class(generate(), mimetype='text/event-stream')
+
+def _positive_param(name, cast):
+    """读取可选的正数请求参数，未提供时返回None，不是正数时抛出 ValueError"""
+    value = request.values.get(name)
+    if value is None or value == '':
+        return None
+    number = cast(value)
+    if number <= 0:
+        raise ValueError(value)
+    return number
+
+# 解析上传的文件，逐条产出文本记录（在后台入库线程中执行）
+def parse_document(file_path, filename):
+    return iter_document(file_path, filename, max_workers=PARSE_WORKERS)
+
+# 用作磁盘文件名的安全名称；secure_filename 会丢掉中文等字符，此时加上原文件名的哈希避免不同文件重名
+def safe_file_name(filename):
+    name = secure_filename(filename)
+    if name != filename:
+        name = f"{hashlib.sha1(filename.encode('utf-8')).hexdigest()[:12]}-{name or 'file'}"
+    return name
+
+def remove_upload(file_path):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    if 'file' not in request.files:
+        return jsonify({'error': '没有文件部分'}), 400
+    
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': '没有选择文件'}), 400
+    
+    # 保存原始文件：每次上传使用会话目录下的唯一文件名，后台解析前不会被其他上传覆盖，入库任务结束后删除
+    session_id = get_session_id()
+    upload_dir = os.path.join(UPLOAD_FOLDER, secure_filename(session_id) or 'default')
+    os.makedirs(upload_dir, exist_ok=True)
+    file_path = os.path.join(upload_dir, f"{uuid.uuid4().hex}-{safe_file_name(file.filename)}")
+    file.save(file_path)
+    
+    # 解析、分块、编码和写入向量数据库在后台执行，立即返回任务id
+    try:
+        job = ingestion_queue.submit(session_id, file.filename, partial(parse_document, file_path, file.filename),
+                                     on_finish=partial(remove_upload, file_path))
+    except IngestionBusyError as e:
+        remove_upload(file_path)
+        return jsonify({'error': str(e)}), 503
+    
+    # 在会话中只保存文件名的映射关系
+    if 'file_mappings' not in session:
+        session['file_mappings'] = {}
+    
+    # 记录文件映射信息
+    session['file_mappings'][file.filename] = {
+        'original_file': file.filename,
+        'upload_time': datetime.now().isoformat(),
+        'job_id': job.job_id
+    }
+    session.modified = True
+    
+    return jsonify({'success': True, 'filename': file.filename, 'job_id': job.job_id})
+
+@app.route('/upload/status/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    """入库任务的当前阶段、进度与各阶段耗时"""
+    job = ingestion_queue.get(job_id)
+    if job is None or job.session_id != get_session_id():
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job.to_dict())
+
+def run():
+    """以开发服务器方式启动（python main.py）；模型在导入时已开始后台加载，服务立即开始监听，就绪前的对话请求返回503"""
+    logging.getLogger('werkzeug').disabled = True
+    app.logger.setLevel(logging.INFO)
+    app.run(host="0.0.0.0", port=80)
+
@@ -0,0 +1,69 @@
+"""流式输出解码开销基准：每个token全量解码（旧实现） vs 增量解码
+
+在已生成 1k/8k/32k 个token的位置上，分别测量继续输出若干token时每个token的平均解码耗时。
+用法：python benchmark/bench_detokenizer.py --model /model/Qwen/Qwen3-0___6B/ --lengths 1000,8000,32000
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import AutoTokenizer
+
+from TextStreamer import IncrementalDetokenizer
+
+SAMPLE_TEXT = ("基于以下相关知识库内容回答问题：文档知识问答系统支持PDF、Word和文本文件。"
+               "The assistant retrieves relevant chunks and answers in Chinese or English! 😀\n")
+
+
+def legacy_put(tokenizer, state, token):
+    """旧实现：把全部已生成token重新解码，再截取新增部分"""
+    state['tokens'].append(token)
+    text = tokenizer.decode(state['tokens'], skip_special_tokens=True)
+    new_text = text[state['print_len']:]
+    state['print_len'] = len(text)
+    return new_text
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='/model/Qwen/Qwen3-0___6B/')
+    parser.add_argument('--lengths', default='1000,8000,32000')
+    parser.add_argument('--steps', type=int, default=200, help='每个位置测量的token数')
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    sample_ids = tokenizer(SAMPLE_TEXT, add_special_tokens=False).input_ids
+
+    for length in [int(n) for n in args.lengths.split(',')]:
+        # 前缀按样本边界截断，保证前缀末尾不会截断多字节字符
+        length = max(1, length // len(sample_ids)) * len(sample_ids)
+        total = length + args.steps
+        token_ids = (sample_ids * (total // len(sample_ids) + 1))[:total]
+        prefix, measured = token_ids[:length], token_ids[length:]
+        expected_text = tokenizer.decode(token_ids, skip_special_tokens=True)[
+            len(tokenizer.decode(prefix, skip_special_tokens=True)):]
+
+        state = {'tokens': list(prefix), 'print_len': len(tokenizer.decode(prefix, skip_special_tokens=True))}
+        start = time.perf_counter()
+        for token in measured:
+            legacy_put(tokenizer, state, token)
+        legacy = (time.perf_counter() - start) / args.steps
+
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        detokenizer.add(prefix)
+        detokenizer.flush()
+        start = time.perf_counter()
+        incremental_text = "".join(detokenizer.add([token]) for token in measured) + detokenizer.flush()
+        incremental = (time.perf_counter() - start) / args.steps
+
+        # 旧实现在多字节字符被拆分到多个token时会输出替换字符"\ufffd"，这里只校验增量解码
+        assert incremental_text == expected_text, "增量解码结果与全量解码不一致"
+        print(f"已生成 {length:>6} tokens  全量解码 {legacy * 1e6:10.1f} us/token  "
+              f"增量解码 {incremental * 1e6:8.1f} us/token  ({legacy / incremental:6.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""CPU推理配置基准：default / int8 / bf16 下的生成速度（tokens/s）与嵌入编码速度（embeddings/s）
+
+--concurrent 时在后台线程持续批量编码，模拟入库与对话同时进行，测量此时的生成速度。
+嵌入向量同时给出与default配置的平均余弦相似度，用于确认量化后的精度损失。
+用法：python benchmark/bench_inference.py --qwen-model /model/Qwen/Qwen3-0___6B/ --profiles default,int8,bf16 --concurrent
+"""
+import os
+import sys
+import time
+import threading
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from EmbeddingModel import EmbeddingEncoder, DEFAULT_EMBEDDING_MODEL, DEFAULT_MODEL_DIR
+from InferenceProfile import optimize_model, resolve_profile, thread_split, use_threads
+from bench_embedding import make_chunks
+
+PROMPT = "请简要介绍文档知识问答系统的工作流程，包括文档解析、分块、向量检索和回答生成。"
+
+
+def generation_rate(model, tokenizer, new_tokens, num_threads):
+    use_threads(num_threads)
+    inputs = tokenizer(PROMPT, return_tensors='pt')
+    with torch.no_grad():
+        model.generate(**inputs, max_new_tokens=4, do_sample=False)  # 预热
+        start = time.perf_counter()
+        output = model.generate(**inputs, max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=False)
+    generated = output.shape[1] - inputs.input_ids.shape[1]
+    return generated / (time.perf_counter() - start)
+
+
+def embedding_rate(encoder, chunks):
+    encoder.encode_batch(chunks[:8])  # 预热
+    start = time.perf_counter()
+    embeddings = encoder.encode_batch(chunks)
+    return len(chunks) / (time.perf_counter() - start), embeddings
+
+
+def cosine(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return float((a * b).sum(axis=1).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--qwen-model', default='/model/Qwen/Qwen3-0___6B/')
+    parser.add_argument('--model-id', default=DEFAULT_EMBEDDING_MODEL)
+    parser.add_argument('--model-dir', default=DEFAULT_MODEL_DIR)
+    parser.add_argument('--profiles', default='default,int8,bf16')
+    parser.add_argument('--new-tokens', type=int, default=64)
+    parser.add_argument('--chunks', type=int, default=256)
+    parser.add_argument('--generation-threads', type=int, default=0)
+    parser.add_argument('--embedding-threads', type=int, default=0)
+    parser.add_argument('--concurrent', action='store_true', help='生成时在后台线程同时批量编码')
+    args = parser.parse_args()
+
+    generation_threads, embedding_threads = thread_split(args.generation_threads, args.embedding_threads)
+    print(f"线程分配: 生成 {generation_threads}，编码 {embedding_threads}")
+    tokenizer = AutoTokenizer.from_pretrained(args.qwen_model)
+    chunks = make_chunks(args.chunks)
+    reference = None
+
+    for profile in args.profiles.split(','):
+        effective = resolve_profile(profile)
+        if effective != profile:
+            print(f"{profile:<8} 不受支持，跳过")
+            continue
+        model = optimize_model(AutoModelForCausalLM.from_pretrained(args.qwen_model), profile)
+        encoder = EmbeddingEncoder(model_id=args.model_id, cache_dir=args.model_dir, profile=profile,
+                                   num_threads=embedding_threads)
+
+        tokens_per_second = generation_rate(model, tokenizer, args.new_tokens, generation_threads)
+        embeddings_per_second, embeddings = embedding_rate(encoder, chunks)
+        if reference is None:
+            reference = embeddings
+        line = (f"{profile:<8} 生成 {tokens_per_second:7.1f} tokens/s   编码 {embeddings_per_second:7.1f} embeddings/s"
+                f"   与首个配置的余弦相似度 {cosine(embeddings, reference):.4f}")
+
+        if args.concurrent:
+            stop = threading.Event()
+
+            def ingest():
+                while not stop.is_set():
+                    encoder.encode_batch(chunks[:64])
+
+            worker = threading.Thread(target=ingest, daemon=True)
+            worker.start()
+            try:
+                busy_rate = generation_rate(model, tokenizer, args.new_tokens, generation_threads)
+            finally:
+                stop.set()
+                worker.join()
+            line += f"   编码并发时生成 {busy_rate:7.1f} tokens/s"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
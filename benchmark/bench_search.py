@@ -0,0 +1,64 @@
+"""精确检索微基准：差值矩阵+全排序（旧实现） vs 范数缓存+矩阵乘法+argpartition
+
+用法：python benchmark/bench_search.py --sizes 10000,100000,1000000 --dimension 768
+注意：100万×768的float32向量约占3GB内存，旧实现还需要同样大小的临时差值矩阵。
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from VectorIndex import FlatIndex
+
+
+def legacy_search(vectors, query, k):
+    distances = np.linalg.norm(vectors - query, axis=1)
+    indices = np.argsort(distances)[:k]
+    return distances[indices], indices
+
+
+def timeit(fn, repeat):
+    fn()  # 预热
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=64, help='search_many 的批量查询数')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for size in [int(s) for s in args.sizes.split(',')]:
+        vectors = rng.standard_normal((size, args.dimension), dtype=np.float32)
+        queries = rng.standard_normal((args.queries, args.dimension), dtype=np.float32)
+        index = FlatIndex(args.dimension)
+        index.add(vectors, np.arange(size))
+
+        legacy = timeit(lambda: legacy_search(vectors, queries[0], args.top_k), args.repeat)
+        single = timeit(lambda: index.search(queries[0], args.top_k), args.repeat)
+        batched = timeit(lambda: index.search(queries, args.top_k), args.repeat) / args.queries
+
+        # 校验结果一致
+        _, expected = legacy_search(vectors, queries[0], args.top_k)
+        _, actual = index.search(queries[0], args.top_k)
+        assert set(expected) == set(actual[0]), "检索结果与旧实现不一致"
+
+        print(f"N={size:>8}  旧实现 {legacy * 1000:8.2f} ms/查询  "
+              f"单条 {single * 1000:8.2f} ms/查询 ({legacy / single:5.1f}x)  "
+              f"批量 {batched * 1000:8.2f} ms/查询 ({legacy / batched:5.1f}x)")
+        del vectors, index
+
+
+if __name__ == '__main__':
+    main()
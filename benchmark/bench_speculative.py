@@ -0,0 +1,117 @@
+"""提示词查找投机解码基准：同一RAG风格提示词分别用逐个贪心解码和投机解码生成，
+比较解码速度（tokens/s）并给出候选token的接受率
+
+以 model.generate(do_sample=False) 的贪心输出为准，调度器的逐个解码和投机解码都必须与之完全相同，不同时以非零状态退出。
+用法：python benchmark/bench_speculative.py --qwen-model /model/Qwen/Qwen3-0___6B/ --speculative-tokens 4,8
+"""
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from BatchScheduler import ContinuousBatchScheduler
+from InferenceProfile import optimize_model, thread_split
+from stub_models import synthetic_sentence
+
+QUESTION = "请根据上面的文档内容，原样列出其中提到的处理步骤。"
+
+
+class TokenCollector:
+    """只记录输出token的streamer"""
+
+    def __init__(self):
+        self.tokens = []
+
+    def put(self, value):
+        self.tokens.extend(value.tolist())
+
+    def end(self):
+        pass
+
+
+def rag_prompt(tokenizer, num_chunks, seed=0):
+    rng = random.Random(seed)
+    chunks = [" ".join(synthetic_sentence(rng) for _ in range(4)) for _ in range(num_chunks)]
+    context = "\n\n".join(f"[片段{i + 1}] {chunk}" for i, chunk in enumerate(chunks))
+    messages = [{'role': 'user', 'content': f"基于以下相关知识库内容回答问题：\n{context}\n\n问题：{QUESTION}"}]
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True, enable_thinking=False)
+    return tokenizer(text).input_ids
+
+
+def run(scheduler, prompt, new_tokens):
+    """返回 (输出token, 第一个token之后的解码速度)"""
+    collector = TokenCollector()
+    request = scheduler.submit(prompt, collector, max_new_tokens=new_tokens)
+    request.done.wait()
+    if request.error is not None:
+        raise request.error
+    decode_seconds = request.finished_at - request.first_token_at
+    return request.generated, (len(request.generated) - 1) / decode_seconds if decode_seconds > 0 else 0.0
+
+
+def greedy_reference(model, prompt, new_tokens):
+    """transformers自带的贪心解码结果，作为输出一致性的基准"""
+    input_ids = torch.tensor([prompt], dtype=torch.long)
+    with torch.no_grad():
+        output = model.generate(input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=new_tokens,
+                                do_sample=False)
+    return output[0, len(prompt):].tolist()
+
+
+def matches(tokens, reference):
+    """generate 在EOS处停止且不会补齐，调度器输出的EOS也计入生成结果，按较短的一方比较"""
+    length = min(len(tokens), len(reference))
+    return length > 0 and tokens[:length] == reference[:length]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--qwen-model', default='/model/Qwen/Qwen3-0___6B/')
+    parser.add_argument('--profile', default='default')
+    parser.add_argument('--speculative-tokens', default='4,8', help='逗号分隔的每步最大候选token数')
+    parser.add_argument('--new-tokens', type=int, default=128)
+    parser.add_argument('--chunks', type=int, default=4, help='提示词中的文档片段数')
+    parser.add_argument('--repeat', type=int, default=3, help='每种配置重复次数，取最快的一次')
+    parser.add_argument('--generation-threads', type=int, default=0)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.qwen_model)
+    model = optimize_model(AutoModelForCausalLM.from_pretrained(args.qwen_model), args.profile)
+    num_threads = thread_split(args.generation_threads, 0)[0]
+    prompt = rag_prompt(tokenizer, args.chunks)
+    print(f"提示词 {len(prompt)} tokens，生成上限 {args.new_tokens} tokens，线程 {num_threads}")
+
+    reference = greedy_reference(model, prompt, args.new_tokens)
+    baseline = ContinuousBatchScheduler(model, tokenizer, max_batch_size=1, num_threads=num_threads)
+    baseline.do_sample = False
+    run(baseline, prompt, 4)  # 预热
+    results = [run(baseline, prompt, args.new_tokens) for _ in range(args.repeat)]
+    baseline_rate = max(rate for _, rate in results)
+    same = all(matches(tokens, reference) for tokens, _ in results)
+    mismatched = not same
+    print(f"{'贪心':<10} {baseline_rate:8.1f} tokens/s   输出 {len(results[0][0])} tokens   "
+          f"与generate{'一致' if same else '不一致'}")
+
+    for k in (int(value) for value in args.speculative_tokens.split(',')):
+        scheduler = ContinuousBatchScheduler(model, tokenizer, max_batch_size=1, num_threads=num_threads,
+                                             speculative_tokens=k)
+        run(scheduler, prompt, 4)
+        results = [run(scheduler, prompt, args.new_tokens) for _ in range(args.repeat)]
+        rate = max(rate for _, rate in results)
+        same = all(matches(tokens, reference) for tokens, _ in results)
+        mismatched |= not same
+        speculative = scheduler.stats()['speculative']
+        print(f"{f'投机 k={k}':<10} {rate:8.1f} tokens/s   加速 {rate / baseline_rate:5.2f}x   "
+              f"接受率 {speculative['acceptance_rate']:.2%}   "
+              f"平均每步 {(speculative['accepted_tokens'] + speculative['steps']) / max(speculative['steps'], 1):.2f} "
+              f"tokens   与generate{'一致' if same else '不一致'}")
+    sys.exit(1 if mismatched else 0)
+
+
+if __name__ == '__main__':
+    main()
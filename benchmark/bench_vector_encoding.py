@@ -0,0 +1,105 @@
+"""向量编码基准：float32 / float16 / int8 / pq 的召回率、内存与磁盘占用和检索耗时
+
+向量按文档拆成若干数据段，通过 SegmentStorage 写入临时目录后用精确索引检索，与实际会话的路径相同。
+召回率以float32精确检索的前k个结果为准；rescore 列为重新打分的候选倍数（0表示只用编码得分）。
+内存一列是检索时访问的编码和码本大小（数据段以内存映射方式打开），重新打分时另外只读取候选行的原始向量。
+默认使用带聚类结构的合成向量，--embeddings 可指定真实嵌入向量（.npy，形状为 (N, 维数)）。
+用法：python benchmark/bench_vector_encoding.py --vectors 20000 --dimension 768 --rescore 0,8
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from VectorCodec import ENCODINGS
+from VectorIndex import build_index
+from VectorStorage import SegmentStorage
+
+
+def synthetic_embeddings(count, dimension, clusters=64, seed=0):
+    """围绕若干主题中心分布的单位向量，比各向同性的随机向量更接近真实嵌入"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension), dtype=np.float32)
+    vectors = centers[rng.integers(0, clusters, count)] + 0.6 * rng.standard_normal((count, dimension),
+                                                                                        dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def build(db_path, vectors, encoding, keep_full_precision, segment_size, rescore_factor):
+    storage = SegmentStorage(db_path, vectors.shape[1], encoding=encoding, keep_full_precision=keep_full_precision)
+    storage.open()
+    start = time.perf_counter()
+    for i in range(0, len(vectors), segment_size):
+        block = vectors[i:i + segment_size]
+        storage.append(f"doc-{i // segment_size}", block, [""] * len(block), "")
+    encode_seconds = time.perf_counter() - start
+    blocks = [(segment.vectors, segment.ids, segment.full_vectors) for segment in storage.segments]
+    index = build_index('flat', vectors.shape[1], blocks, rescore_factor=rescore_factor)
+    memory = sum(vectors.nbytes for vectors, _, _ in blocks)
+    return index, memory, encode_seconds
+
+
+def recall(expected, actual):
+    return float(np.mean([len(set(e) & set(a)) / len(e) for e, a in zip(expected, actual)]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vectors', type=int, default=20000)
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--embeddings', help='真实嵌入向量的.npy文件，指定后忽略 --vectors/--dimension')
+    parser.add_argument('--segment-size', type=int, default=2000, help='每个数据段（文档）的向量数')
+    parser.add_argument('--encodings', default=','.join(ENCODINGS))
+    parser.add_argument('--rescore', default='0,8', help='逗号分隔的重新打分候选倍数')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.embeddings:
+        vectors = np.load(args.embeddings).astype(np.float32)
+    else:
+        vectors = synthetic_embeddings(args.vectors, args.dimension)
+    # 查询取自数据本身并加噪声，近邻不是查询向量自身
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.choice(len(vectors), args.queries, replace=False)]
+    queries = queries + 0.05 * rng.standard_normal(queries.shape, dtype=np.float32)
+    print(f"向量 {vectors.shape[0]}×{vectors.shape[1]}，每段 {args.segment_size} 个，查询 {len(queries)}，k={args.top_k}")
+
+    workdir = tempfile.mkdtemp(prefix='bench_vector_encoding_')
+    try:
+        reference, reference_memory, _ = build(os.path.join(workdir, 'reference'), vectors, 'float32', False,
+                                               args.segment_size, 0)
+        _, expected = reference.search(queries, args.top_k)
+        print(f"{'编码':<8} {'rescore':>7} {'召回率':>8} {'内存':>10} {'压缩比':>7} {'磁盘':>10} "
+              f"{'编码耗时':>9} {'检索':>12}")
+        for encoding in args.encodings.split(','):
+            for rescore_factor in (int(value) for value in args.rescore.split(',')):
+                if encoding == 'float32' and rescore_factor > 0:
+                    continue  # 原始精度无需重新打分
+                db_path = os.path.join(workdir, f"{encoding}-{rescore_factor}")
+                index, memory, encode_seconds = build(db_path, vectors, encoding, rescore_factor > 0,
+                                                      args.segment_size, rescore_factor)
+                index.search(queries[:8], args.top_k)  # 预热，计算范数缓存
+                start = time.perf_counter()
+                _, actual = index.search(queries, args.top_k)
+                search_ms = (time.perf_counter() - start) * 1000 / len(queries)
+                print(f"{encoding:<8} {rescore_factor:>7} {recall(expected, actual):>8.4f} "
+                      f"{memory / 2 ** 20:>8.1f}MB {reference_memory / memory:>6.1f}x "
+                      f"{directory_bytes(os.path.join(db_path, 'segments')) / 2 ** 20:>8.1f}MB "
+                      f"{encode_seconds:>8.2f}s {search_ms:>8.3f}ms/查询")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
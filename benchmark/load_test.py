@@ -0,0 +1,313 @@
+"""离线负载测试：用小模型启动完整的Flask服务，测量文档入库与并发SSE对话的吞吐量、延迟分位数和内存峰值
+
+不需要下载Qwen3-0.6B和CoROM：先在 --model-dir 生成随机初始化的小模型（见 stub_models.py），
+再在 --work-dir 中启动服务（上传文件、向量数据库等都写在该目录下）。
+1. 入库：每种格式上传 --docs-per-format 个约 --doc-size-kb 的合成文档，轮询 /upload/status 直到完成；
+2. 对话：--clients 个客户端各自上传一个小文档后，并发发送 --requests-per-client 个 /message 请求。
+结果中的分位数单位为秒；--json 把结果写入文件，便于与上一次的结果对比。
+用法：python benchmark/load_test.py --formats txt,docx,pdf --doc-size-kb 256 --clients 8 --json result.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import tempfile
+import argparse
+import threading
+import http.client
+from urllib.parse import urlencode
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from stub_models import build_stub_models
+from synthetic_docs import make_document
+
+QUESTIONS = ["How does the model retrieve document chunks?", "文档知识问答系统支持哪些文件？",
+             "What is stored in the vector database?", "上传的文件会被如何处理？"]
+
+
+class PeakRSS:
+    """后台线程定时读取本进程的常驻内存（服务与测试客户端在同一进程中），记录每个阶段的峰值"""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def reset(self):
+        """返回上次重置以来的峰值（字节）并重新开始统计"""
+        peak, self.peak = self.peak, _current_rss()
+        return max(peak, self.peak)
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _current_rss())
+
+
+def _current_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class Client:
+    """一个浏览器会话：保存Flask的session cookie，每次请求新建连接"""
+
+    def __init__(self, port):
+        self.port = port
+        self.cookie = None
+
+    def request(self, method, path, body=None, headers=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+        try:
+            connection.request(method, path, body=body, headers=self._headers(headers))
+            response = connection.getresponse()
+            data = response.read()
+            self._update_cookie(response)
+            return response.status, data
+        finally:
+            connection.close()
+
+    def json(self, method, path, body=None, headers=None):
+        status, data = self.request(method, path, body, headers)
+        return status, json.loads(data) if data else None
+
+    def upload(self, path):
+        boundary = uuid.uuid4().hex
+        with open(path, 'rb') as f:
+            content = f.read()
+        body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; "
+                f"filename=\"{os.path.basename(path)}\"\r\nContent-Type: application/octet-stream\r\n\r\n").encode()
+        body += content + f"\r\n--{boundary}--\r\n".encode()
+        return self.json('POST', '/upload', body, {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+
+    def wait_job(self, job_id, poll_interval=0.02):
+        while True:
+            status, job = self.json('GET', f'/upload/status/{job_id}')
+            if status != 200 or job['status'] in ('done', 'failed'):
+                return job
+            time.sleep(poll_interval)
+
+    def stream_message(self, text, max_tokens):
+        """发送 /message 并读完SSE流，返回 (首段文本延迟, 总延迟, 事件数, 是否出错)"""
+        start = time.perf_counter()
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+        first, events, error = None, 0, False
+        try:
+            connection.request('GET', '/message?' + urlencode({'text': text, 'max_tokens': max_tokens}),
+                               headers=self._headers())
+            response = connection.getresponse()
+            if response.status != 200:
+                response.read()
+                return None, time.perf_counter() - start, 0, True
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                if line.startswith(b'data: '):
+                    if first is None:
+                        first = time.perf_counter() - start
+                    events += 1
+                    error = error or line.startswith('data: 发生错误'.encode('utf-8'))
+        finally:
+            connection.close()
+        return first, time.perf_counter() - start, events, error
+
+    def _headers(self, headers=None):
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        return headers
+
+    def _update_cookie(self, response):
+        for header in response.headers.get_all('Set-Cookie') or []:
+            if header.startswith('session='):
+                self.cookie = header.split(';', 1)[0]
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': round(float(p50), 4), 'p95': round(float(p95), 4), 'p99': round(float(p99), 4)}
+
+
+def start_server(args):
+    """在工作目录中导入 WebApp（导入时开始加载模型）并启动多线程的WSGI服务，返回端口"""
+    os.environ['MODEL_DIR'] = os.path.abspath(args.model_dir)
+    os.environ.setdefault('QWEN_WARMUP_TOKENS', '2')
+    os.chdir(args.work_dir)
+    import WebApp
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', args.port, WebApp.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_port, WebApp.model_loader
+
+
+def run_ingestion(port, args):
+    """所有合成文档一次性提交，测量每个文档从上传到入库完成的时间以及整体吞吐量"""
+    docs_dir = os.path.join(args.work_dir, 'synthetic_docs')
+    os.makedirs(docs_dir, exist_ok=True)
+    paths = []
+    for fmt in args.formats.split(','):
+        for i in range(args.docs_per_format):
+            path = os.path.join(docs_dir, f"doc_{i}.{fmt}")
+            make_document(path, fmt, args.doc_size_kb * 1024, seed=i)
+            paths.append((fmt, path))
+
+    client = Client(port)
+    start = time.perf_counter()
+    submitted = []
+    for fmt, path in paths:
+        submit_time = time.perf_counter()
+        status, result = client.upload(path)
+        if status != 200:
+            raise RuntimeError(f"上传失败 {path}: {status} {result}")
+        submitted.append((fmt, path, submit_time, result['job_id']))
+
+    # 轮询所有未完成的任务，每个任务在第一次查询到完成时记录耗时
+    per_format = {}
+    total_chunks, total_bytes = 0, 0
+    pending = submitted
+    while pending:
+        remaining = []
+        for fmt, path, submit_time, job_id in pending:
+            status, job = client.json('GET', f'/upload/status/{job_id}')
+            if status != 200 or job['status'] == 'failed':
+                raise RuntimeError(f"入库失败 {path}: {job}")
+            if job['status'] != 'done':
+                remaining.append((fmt, path, submit_time, job_id))
+                continue
+            stats = per_format.setdefault(fmt, {'latencies': [], 'chunks': 0, 'bytes': 0})
+            stats['latencies'].append(time.perf_counter() - submit_time)
+            stats['chunks'] += job['chunks']
+            stats['bytes'] += os.path.getsize(path)
+            total_chunks += job['chunks']
+            total_bytes += os.path.getsize(path)
+        pending = remaining
+        if pending:
+            time.sleep(0.02)
+    seconds = time.perf_counter() - start
+
+    return {
+        'documents': len(submitted),
+        'seconds': round(seconds, 3),
+        'mb_per_second': round(total_bytes / 1024 / 1024 / seconds, 3),
+        'chunks_per_second': round(total_chunks / seconds, 1),
+        'formats': {fmt: dict(percentiles(stats['latencies']), documents=len(stats['latencies']),
+                              chunks=stats['chunks'], mb=round(stats['bytes'] / 1024 / 1024, 3))
+                    for fmt, stats in per_format.items()}
+    }
+
+
+def run_chat(port, args):
+    """每个客户端先上传一个小文档（使检索生效），再并发发送对话请求"""
+    clients = [Client(port) for _ in range(args.clients)]
+    docs_dir = os.path.join(args.work_dir, 'synthetic_docs')
+    for i, client in enumerate(clients):
+        path = os.path.join(docs_dir, f"client_{i}.txt")
+        make_document(path, 'txt', 16 * 1024, seed=1000 + i)
+        status, result = client.upload(path)
+        if status != 200 or client.wait_job(result['job_id'])['status'] != 'done':
+            raise RuntimeError(f"客户端 {i} 上传文档失败")
+
+    ttft, latency, events, errors = [], [], [0], [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(len(clients) + 1)
+
+    def worker(i, client):
+        barrier.wait()
+        for j in range(args.requests_per_client):
+            first, total, count, error = client.stream_message(QUESTIONS[(i + j) % len(QUESTIONS)], args.max_tokens)
+            with lock:
+                if first is not None:
+                    ttft.append(first)
+                latency.append(total)
+                events[0] += count
+                errors[0] += int(error)
+
+    threads = [threading.Thread(target=worker, args=(i, client)) for i, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    return {
+        'clients': args.clients,
+        'requests': len(latency),
+        'errors': errors[0],
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(len(latency) / seconds, 3),
+        'events_per_second': round(events[0] / seconds, 1),
+        'time_to_first_token': percentiles(ttft),
+        'latency': percentiles(latency)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-dir', default=os.path.join(tempfile.gettempdir(), 'stub_models'))
+    parser.add_argument('--work-dir', default=None, help='服务的工作目录，默认新建临时目录')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--formats', default='txt,docx,pdf')
+    parser.add_argument('--docs-per-format', type=int, default=2)
+    parser.add_argument('--doc-size-kb', type=int, default=256)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--requests-per-client', type=int, default=5)
+    parser.add_argument('--max-tokens', type=int, default=32, help='每次对话生成的token上限')
+    parser.add_argument('--ready-timeout', type=float, default=300)
+    parser.add_argument('--json', default=None, help='结果写入的JSON文件')
+    args = parser.parse_args()
+    args.model_dir = os.path.abspath(args.model_dir)
+    args.json = os.path.abspath(args.json) if args.json else None
+    args.work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix='load_test_'))
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    build_stub_models(args.model_dir)
+    rss = PeakRSS()
+    start = time.perf_counter()
+    port, model_loader = start_server(args)
+    if not model_loader.wait(args.ready_timeout):
+        raise RuntimeError(f"模型未能就绪: {model_loader.to_dict()}")
+    result = {'startup': {'seconds': round(time.perf_counter() - start, 3), 'peak_rss_mb': round(rss.reset() / 2 ** 20, 1)}}
+
+    result['ingestion'] = run_ingestion(port, args)
+    result['ingestion']['peak_rss_mb'] = round(rss.reset() / 2 ** 20, 1)
+    result['chat'] = run_chat(port, args)
+    result['chat']['peak_rss_mb'] = round(rss.reset() / 2 ** 20, 1)
+    rss.stop()
+
+    startup, ingestion, chat = result['startup'], result['ingestion'], result['chat']
+    print(f"启动：{startup['seconds']:.1f} 秒，内存峰值 {startup['peak_rss_mb']:.0f} MB")
+    print(f"入库：{ingestion['documents']} 个文档，{ingestion['seconds']:.2f} 秒，{ingestion['mb_per_second']:.2f} MB/s，"
+          f"{ingestion['chunks_per_second']:.0f} 块/秒，内存峰值 {ingestion['peak_rss_mb']:.0f} MB")
+    for fmt, stats in ingestion['formats'].items():
+        print(f"  {fmt:<5} {stats['documents']} 个 {stats['mb']:.2f} MB {stats['chunks']} 块  "
+              f"耗时 p50 {stats['p50']:.3f}  p95 {stats['p95']:.3f}  p99 {stats['p99']:.3f}")
+    print(f"对话：{chat['clients']} 个并发客户端，{chat['requests']} 个请求（{chat['errors']} 个出错），"
+          f"{chat['requests_per_second']:.2f} 请求/秒，{chat['events_per_second']:.0f} 事件/秒，"
+          f"内存峰值 {chat['peak_rss_mb']:.0f} MB")
+    for name in ('time_to_first_token', 'latency'):
+        stats = chat[name]
+        if stats['p50'] is not None:
+            print(f"  {name:<20} p50 {stats['p50']:.3f}  p95 {stats['p95']:.3f}  p99 {stats['p99']:.3f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""离线基准测试用的小模型：随机初始化的Qwen3与BERT，以及在合成语料上训练的BPE分词器
+
+目录结构与正式部署一致（<model_dir>/Qwen/Qwen3-0___6B 与 <model_dir>/damo/...），
+设置环境变量 MODEL_DIR=<model_dir> 后无需下载即可启动整个服务。固定随机种子，多次生成的模型完全相同。
+用法：python benchmark/stub_models.py --model-dir /tmp/stub_models
+"""
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+from transformers import BertConfig, BertModel, PreTrainedTokenizerFast, Qwen3Config, Qwen3ForCausalLM
+
+from EmbeddingModel import DEFAULT_EMBEDDING_MODEL
+
+QWEN_SUBDIR = os.path.join('Qwen', 'Qwen3-0___6B')
+CHAT_TEMPLATE = ("{% for m in messages %}<|im_start|>{{ m['role'] }}\n{{ m['content'] }}<|im_end|>\n{% endfor %}"
+                 "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}")
+
+WORDS = ("the model retrieves relevant document chunks and answers questions about uploaded files "
+         "using a vector database with hybrid search over pages sections and tables").split()
+CJK_SENTENCES = ["文档知识问答系统支持PDF、Word和文本文件。", "上传的文件会被解析、分块并生成嵌入向量！",
+                 "检索到的文档片段会作为上下文提供给模型？", "基于以下相关知识库内容回答问题：", "问题：1+1等于几？测试"]
+
+
+def synthetic_sentence(rng):
+    """合成语料中的一句话：英文单词序列或中文句子"""
+    if rng.random() < 0.3:
+        return rng.choice(CJK_SENTENCES)
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 18))]
+    return " ".join(words).capitalize() + rng.choice(".?!")
+
+
+def _train_tokenizer(special_tokens, vocab_size, seed):
+    rng = random.Random(seed)
+    corpus = [synthetic_sentence(rng) for _ in range(2000)]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=special_tokens,
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(corpus, trainer)
+    return tokenizer
+
+
+def build_qwen(path, hidden_size=64, num_layers=2, vocab_size=1024, seed=0):
+    torch.manual_seed(seed)
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=_train_tokenizer(["<|endoftext|>", "<|im_start|>", "<|im_end|>"], vocab_size, seed),
+        eos_token="<|im_end|>", pad_token="<|endoftext|>")
+    tokenizer.chat_template = CHAT_TEMPLATE
+    tokenizer.save_pretrained(path)
+    config = Qwen3Config(vocab_size=len(tokenizer), hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+                         num_hidden_layers=num_layers, num_attention_heads=4, num_key_value_heads=2,
+                         head_dim=hidden_size // 4, eos_token_id=tokenizer.eos_token_id,
+                         pad_token_id=tokenizer.pad_token_id)
+    Qwen3ForCausalLM(config).save_pretrained(path)
+
+
+def build_encoder(path, hidden_size=768, num_layers=1, vocab_size=1024, seed=0):
+    torch.manual_seed(seed)
+    backend = _train_tokenizer(["[PAD]", "[UNK]", "[CLS]", "[SEP]"], vocab_size, seed)
+    backend.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]", special_tokens=[("[CLS]", backend.token_to_id("[CLS]")),
+                                                 ("[SEP]", backend.token_to_id("[SEP]"))])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, pad_token="[PAD]", unk_token="[UNK]",
+                                        cls_token="[CLS]", sep_token="[SEP]")
+    tokenizer.save_pretrained(path)
+    config = BertConfig(vocab_size=len(tokenizer), hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=4, intermediate_size=hidden_size // 2)
+    BertModel(config).save_pretrained(path)
+
+
+def build_stub_models(model_dir, qwen_hidden_size=64, qwen_layers=2, encoder_hidden_size=768, encoder_layers=1,
+                      seed=0):
+    """在 model_dir 下生成两个小模型，已存在的目录不重新生成，返回 model_dir"""
+    qwen_path = os.path.join(model_dir, QWEN_SUBDIR)
+    if not os.path.exists(os.path.join(qwen_path, 'model.safetensors')):
+        os.makedirs(qwen_path, exist_ok=True)
+        build_qwen(qwen_path, qwen_hidden_size, qwen_layers, seed=seed)
+    encoder_path = os.path.join(model_dir, DEFAULT_EMBEDDING_MODEL)
+    if not os.path.exists(os.path.join(encoder_path, 'model.safetensors')):
+        os.makedirs(encoder_path, exist_ok=True)
+        build_encoder(encoder_path, encoder_hidden_size, encoder_layers, seed=seed)
+    return model_dir
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-dir', default='/tmp/stub_models')
+    parser.add_argument('--qwen-hidden-size', type=int, default=64)
+    parser.add_argument('--qwen-layers', type=int, default=2)
+    parser.add_argument('--encoder-hidden-size', type=int, default=768)
+    parser.add_argument('--encoder-layers', type=int, default=1)
+    args = parser.parse_args()
+    build_stub_models(args.model_dir, args.qwen_hidden_size, args.qwen_layers, args.encoder_hidden_size,
+                      args.encoder_layers)
+    print(f"小模型已生成: {args.model_dir}")
+
+
+if __name__ == '__main__':
+    main()
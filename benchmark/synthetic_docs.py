@@ -0,0 +1,89 @@
+"""生成指定大小的合成文档（TXT/DOCX/PDF），用于入库基准测试
+
+PDF直接按文件格式写出（每页若干行Helvetica文本），不依赖额外的PDF生成库；DOCX使用python-docx。
+"""
+import random
+
+from stub_models import synthetic_sentence, WORDS
+
+FORMATS = ('txt', 'docx', 'pdf')
+PDF_LINES_PER_PAGE = 40
+
+
+def paragraphs(size_bytes, seed=0, ascii_only=False):
+    """产出合成段落，总长度（UTF-8字节）约为 size_bytes"""
+    rng = random.Random(seed)
+    total = 0
+    while total < size_bytes:
+        if ascii_only:
+            sentences = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 18))).capitalize() + "."
+                         for _ in range(rng.randint(3, 8))]
+        else:
+            sentences = [synthetic_sentence(rng) for _ in range(rng.randint(3, 8))]
+        paragraph = " ".join(sentences)
+        total += len(paragraph.encode('utf-8')) + 1
+        yield paragraph
+
+
+def make_txt(path, size_bytes, seed=0):
+    with open(path, 'w', encoding='utf-8') as f:
+        for paragraph in paragraphs(size_bytes, seed):
+            f.write(paragraph + "\n")
+
+
+def make_docx(path, size_bytes, seed=0):
+    import docx
+    document = docx.Document()
+    for paragraph in paragraphs(size_bytes, seed):
+        document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def make_pdf(path, size_bytes, seed=0):
+    """按文本量生成多页PDF，每行约80个字符"""
+    lines = []
+    for paragraph in paragraphs(size_bytes, seed, ascii_only=True):
+        words, line = paragraph.split(), ""
+        for word in words:
+            if len(line) + len(word) + 1 > 80:
+                lines.append(line)
+                line = ""
+            line = f"{line} {word}" if line else word
+        if line:
+            lines.append(line)
+    pages = [lines[i:i + PDF_LINES_PER_PAGE] for i in range(0, len(lines), PDF_LINES_PER_PAGE)] or [[]]
+
+    # 对象编号：1 目录，2 页面树，3 字体，之后每页依次为页面对象和内容流
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for page_lines in pages:
+        text = "".join(f"({_pdf_escape(line)}) Tj T* " for line in page_lines)
+        stream = f"BT /F1 10 Tf 14 TL 50 760 Td {text}ET".encode('latin-1')
+        page_ids.append(len(objects) + 1)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects) + 2} 0 R >>".encode())
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode()
+
+    with open(path, 'wb') as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return len(pages)
+
+
+def make_document(path, fmt, size_bytes, seed=0):
+    {'txt': make_txt, 'docx': make_docx, 'pdf': make_pdf}[fmt](path, size_bytes, seed)
+
+
+def _pdf_escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
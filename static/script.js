@@ -105,27 +105,10 @@ document.addEventListener('DOMContentLoaded', function() {
         .then(response => response.json())
         .then(data => {
             if (data.success) {
-                // 添加到已上传文件列表
-                uploadedFiles.push(data.filename);
-                
-                uploadStatus.textContent = `知识库文件 ${data.filename} 上传成功！`;
-                uploadStatus.className = 'upload-status success';
-                
-                // 启用聊天功能
-                messageInput.disabled = false;
-                sendButton.disabled = false;
-                messageInput.placeholder = "请输入您的问题...";
-                
-                // 添加系统消息
-                const message = uploadedFiles.length === 1 
-                    ? `知识库文件 ${data.filename} 已上传，您可以开始提问了。` 
-                    : `知识库文件 ${data.filename} 已上传，当前共上传了 ${uploadedFiles.length} 个文件。`;
-                addMessage('system', message);
-                
-                // 3秒后清除上传状态
-                setTimeout(() => {
-                    uploadStatus.textContent = '';
-                }, 3000);
+                // 文件已保存，后台解析和入库，轮询任务状态
+                uploadStatus.textContent = `处理中: ${data.filename}`;
+                uploadStatus.className = 'upload-status';
+                pollIngestion(data.job_id, data.filename);
             } else {
                 uploadStatus.textContent = `上传失败: ${data.error || '未知错误'}`;
                 uploadStatus.className = 'upload-status error';
@@ -138,6 +121,60 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    // 入库阶段的显示名称
+    const stageNames = {parse: '解析', chunk: '分块', embed: '向量化', index: '建立索引'};
+    
+    // 轮询入库任务状态，完成后启用聊天
+    function pollIngestion(jobId, filename) {
+        fetch(`/upload/status/${jobId}`)
+        .then(response => response.json())
+        .then(job => {
+            if (job.status === 'done') {
+                onIngested(filename);
+            } else if (job.status === 'failed' || job.error) {
+                uploadStatus.textContent = `文件 ${filename} 处理失败: ${job.error || '未知错误'}`;
+                uploadStatus.className = 'upload-status error';
+            } else {
+                let progress = job.stage ? (stageNames[job.stage] || job.stage) : '排队中';
+                if (job.stage === 'embed' && job.chunks) {
+                    progress += ` ${job.embedded}/${job.chunks}`;
+                }
+                uploadStatus.textContent = `处理中: ${filename}（${progress}）`;
+                setTimeout(() => pollIngestion(jobId, filename), 1000);
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            uploadStatus.textContent = `查询文件 ${filename} 处理状态时发生错误`;
+            uploadStatus.className = 'upload-status error';
+        });
+    }
+    
+    // 文件入库完成
+    function onIngested(filename) {
+        // 添加到已上传文件列表
+        uploadedFiles.push(filename);
+        
+        uploadStatus.textContent = `知识库文件 ${filename} 上传成功！`;
+        uploadStatus.className = 'upload-status success';
+        
+        // 启用聊天功能
+        messageInput.disabled = false;
+        sendButton.disabled = false;
+        messageInput.placeholder = "请输入您的问题...";
+        
+        // 添加系统消息
+        const message = uploadedFiles.length === 1 
+            ? `知识库文件 ${filename} 已上传，您可以开始提问了。` 
+            : `知识库文件 ${filename} 已上传，当前共上传了 ${uploadedFiles.length} 个文件。`;
+        addMessage('system', message);
+        
+        // 3秒后清除上传状态
+        setTimeout(() => {
+            uploadStatus.textContent = '';
+        }, 3000);
+    }
+    
     // 聊天相关功能
     sendButton.addEventListener('click', sendMessage);
     
@@ -0,0 +1,88 @@
+"""前缀KV缓存：下一轮对话的预填充复用上一轮缓存的对话历史，输出与不使用缓存时完全相同
+
+使用 benchmark/stub_models.py 生成的随机初始化小模型，不需要下载模型。
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmark'))
+
+pytest.importorskip('torch')
+
+from Qwen import QwenChatbot
+from PromptAssembler import PROMPT_HEADER
+from stub_models import build_qwen
+
+QUESTIONS = [
+    "the model retrieves relevant document chunks and answers questions about uploaded files",
+    "using a vector database with hybrid search over pages sections and tables",
+    "上传的文件会被解析、分块并生成嵌入向量！检索到的文档片段会作为上下文提供给模型？",
+]
+CONTEXTS = [
+    "文档知识问答系统支持PDF、Word和文本文件。 the model answers questions about tables",
+    "hybrid search over pages sections and tables uses a vector database",
+    "检索到的文档片段会作为上下文提供给模型？ relevant document chunks",
+]
+
+
+@pytest.fixture(scope='module')
+def model_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('qwen'))
+    build_qwen(path)
+    return path
+
+
+def make_chatbot(model_path, prefix_cache_bytes=None):
+    chatbot = QwenChatbot(model_name=model_path, max_batch_size=1, prefix_cache_bytes=prefix_cache_bytes)
+    chatbot.scheduler.do_sample = False
+    return chatbot
+
+
+def ask(chatbot, question, context=None):
+    """进行一轮对话，返回 (回答, 本轮复用的前缀token数)"""
+    user_input = f"{PROMPT_HEADER}{context}\n\n问题：{question}" if context else question
+    reused = chatbot.prefix_cache.reused_tokens if chatbot.prefix_cache is not None else 0
+    answer = "".join(chatbot.stream_generate_response(user_input, session_id='session', question=question,
+                                                      max_new_tokens=12))
+    return answer, (chatbot.prefix_cache.reused_tokens if chatbot.prefix_cache is not None else 0) - reused
+
+
+def history_tokens(chatbot, turns):
+    """对话历史部分（不含本轮问题）经聊天模板渲染后的token数"""
+    messages = []
+    for question, answer in turns:
+        messages += [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+    text = chatbot.tokenizer.apply_chat_template(messages, tokenize=False, enable_thinking=False)
+    return len(chatbot.tokenizer(text).input_ids)
+
+
+def test_next_turn_reuses_history_with_rag_context(model_path):
+    chatbot = make_chatbot(model_path)
+    reference = make_chatbot(model_path, prefix_cache_bytes=0)
+    turns = []
+    for i, (question, context) in enumerate(zip(QUESTIONS, CONTEXTS)):
+        answer, reused = ask(chatbot, question, context)
+        assert answer == ask(reference, question, context)[0]
+        if i >= 2:
+            # 上一轮缓存了其问题之前的对话历史；本轮的知识库内容不同，上一轮的问题和回答需要预填充，此前的历史直接命中
+            assert reused >= history_tokens(chatbot, turns[:i - 1])
+        turns.append((question, answer))
+    assert chatbot.prefix_cache.stats()['hits'] >= 1
+
+
+def test_next_turn_reuses_previous_prompt_and_answer_without_context(model_path):
+    chatbot = make_chatbot(model_path)
+    reference = make_chatbot(model_path, prefix_cache_bytes=0)
+    first, _ = ask(chatbot, QUESTIONS[0])
+    assert first == ask(reference, QUESTIONS[0])[0]
+    first_prompt = chatbot.tokenizer.apply_chat_template([{"role": "user", "content": QUESTIONS[0]}], tokenize=False,
+                                                         add_generation_prompt=True, enable_thinking=False)
+
+    second, reused = ask(chatbot, QUESTIONS[1])
+    assert second == ask(reference, QUESTIONS[1])[0]
+    # 没有知识库内容时上一轮的整个提示词（以及生成的回答）都已缓存
+    assert reused >= len(chatbot.tokenizer(first_prompt).input_ids)